@@ -0,0 +1,59 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks.synthetic import AUTHORS, write_export
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Run a command to completion and return its wall time and peak RSS in MiB
+def measure(command, cwd):
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    if status != 0:
+        raise RuntimeError(f"{' '.join(command)} failed with status {status}")
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return elapsed, usage.ru_maxrss / divisor
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak memory of ingesting a large synthetic Discord export")
+    parser.add_argument('--size-mb', type=int, default=2048, help='Total size of the two generated messages.json files')
+    parser.add_argument('--workdir', type=str, default='benchmarks/data/ingest_memory', help='Where the export and database are written')
+    parser.add_argument('--compare-json-load', action='store_true', help='Also measure json.load of the export, the old ingest approach')
+    args = parser.parse_args()
+
+    workdir = os.path.abspath(args.workdir)
+    os.makedirs(workdir, exist_ok=True)
+    marker = os.path.join(workdir, f"export-{args.size_mb}mb")
+    paths = [os.path.join(workdir, f"{author}.json") for author in AUTHORS]
+    if not os.path.exists(marker):
+        print(f"Generating a {args.size_mb} MiB export in {workdir}...")
+        _, count = write_export(workdir, max_bytes=args.size_mb * 1024 * 1024)
+        with open(marker, 'w') as f:
+            f.write(str(count))
+    with open(marker) as f:
+        count = int(f.read())
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump({"id_to_name": {}}, f)
+    print(f"Export: {count} messages, {sum(os.path.getsize(path) for path in paths) / 2**20:.0f} MiB")
+
+    elapsed, peak = measure([sys.executable, '-m', 'src.ingest_messages', *paths], workdir)
+    print(f"Streaming ingest: {elapsed:.1f}s, peak RSS {peak:.0f} MiB, {count / elapsed:.0f} rows/sec")
+
+    if args.compare_json_load:
+        load_script = f"import json\nfor path in {paths!r}:\n    data = json.load(open(path))\n    del data\n"
+        elapsed, peak = measure([sys.executable, '-c', load_script], workdir)
+        print(f"json.load of each file alone: {elapsed:.1f}s, peak RSS {peak:.0f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import argparse
+import random
+import time
+
+from benchmarks.synthetic import generate_messages
+from src.utils import make_mention_rewriter
+
+
+# convert_mentions as it was before the compiled pattern, kept here as the baseline
+def replace_loop_rewriter(id_to_name):
+    def rewrite(contents):
+        for user_id, name in id_to_name.items():
+            contents = contents.replace(f'<@{user_id}>', f'@{name}')
+        return contents
+    return rewrite
+
+
+def time_rewriter(rewrite, texts):
+    start = time.perf_counter()
+    for text in texts:
+        rewrite(text)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mention rewriting throughput, str.replace loop vs one compiled pattern")
+    parser.add_argument('--messages', type=int, default=200000, help='Number of synthetic messages')
+    parser.add_argument('--users', type=int, nargs='+', default=[2, 20, 200], help='Sizes of id_to_name to try')
+    parser.add_argument('--mention-rate', type=float, default=0.05, help='Fraction of messages that mention a known user')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    for user_count in args.users:
+        id_to_name = {rng.randint(10**17, 10**18 - 1): f"User{i}" for i in range(user_count)}
+        user_ids = list(id_to_name)
+        texts = []
+        for message in generate_messages(args.messages):
+            text = message["Contents"]
+            if rng.random() < args.mention_rate:
+                text = f"<@{rng.choice(user_ids)}> {text} <@!{rng.choice(user_ids)}>"
+            texts.append(text)
+
+        loop_time = time_rewriter(replace_loop_rewriter(id_to_name), texts)
+        pattern_time = time_rewriter(make_mention_rewriter(id_to_name), texts)
+        print(f"{user_count} known users: replace loop {args.messages / loop_time:,.0f} msg/s, "
+              f"compiled pattern {args.messages / pattern_time:,.0f} msg/s ({loop_time / pattern_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+from benchmarks.bench_ingest_memory import measure
+from benchmarks.stub_openai import VOCABULARY, start_in_thread
+from benchmarks.synthetic import AUTHORS, write_export
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEARCH_TERM = "What did they plan for the trip?"
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Generate the export once per size, the database is rebuilt from it on every run
+def prepare_workdir(workdir, size):
+    os.makedirs(workdir, exist_ok=True)
+    paths = [os.path.join(workdir, f"{author}.json") for author in AUTHORS]
+    marker = os.path.join(workdir, 'export-complete')
+    if not os.path.exists(marker):
+        print(f"Generating {size} synthetic messages in {workdir}...")
+        write_export(workdir, count=size)
+        open(marker, 'w').close()
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump({"id_to_name": {str(i + 1): author for i, author in enumerate(AUTHORS)}}, f)
+    shutil.rmtree(os.path.join(workdir, 'database'), ignore_errors=True)
+    return paths
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def bench_size(size, args):
+    workdir = os.path.abspath(os.path.join(args.workdir, str(size)))
+    paths = prepare_workdir(workdir, size)
+    results = []
+
+    seconds, peak = measure([sys.executable, '-m', 'src.ingest_messages', *paths], workdir)
+    results.append({'benchmark': 'ingest', 'seconds': seconds, 'peak_rss_mib': round(peak), 'rows_per_second': round(size / seconds)})
+
+    # The pipelines use paths relative to the working directory and read config.json from it
+    previous = os.getcwd()
+    os.chdir(workdir)
+    try:
+        from src import metrics, query_cache, search_messages, summarize_discord
+
+        keywords = random.Random(size).sample(VOCABULARY[1000:3000], 50)
+        timings = [timed(search_messages.search_index, keywords)[0] for _ in range(args.repeat)]
+        results.append({'benchmark': 'search_index', 'seconds': statistics.median(timings), 'keywords': len(keywords)})
+
+        # Cold embeds every candidate through the stub, warm finds them in database/embeddings.db
+        for label in ('cold', 'warm'):
+            for cache in (query_cache.keywords, query_cache.query_embeddings, query_cache.relevant_ids, query_cache.answers):
+                cache.clear()
+            with metrics.run('search') as profile:
+                seconds, _ = timed(search_messages.process_query, SEARCH_TERM)
+            stages = {record['stage']: record['seconds'] for record in profile.records() if record['stage'] != 'total'}
+            results.append({'benchmark': f'process_query_{label}', 'seconds': seconds, 'stages': stages})
+
+        with metrics.run('summarize') as profile:
+            seconds, _ = timed(summarize_discord.main, None, args.summarize_days, 1000, 120000, args.workers)
+        stages = {record['stage']: record['seconds'] for record in profile.records() if record['stage'] != 'total'}
+        results.append({'benchmark': 'summarize', 'seconds': seconds, 'days': args.summarize_days, 'stages': stages})
+    finally:
+        os.chdir(previous)
+    return results
+
+
+def load_previous(output):
+    previous = {}
+    if os.path.exists(output):
+        with open(output) as f:
+            for line in f:
+                record = json.loads(line)
+                previous[(record['messages'], record['benchmark'])] = record
+    return previous
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end timings of ingest, search and summarize against a stub OpenAI server")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help='Corpus sizes in messages')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs of search_index, the median is reported')
+    parser.add_argument('--summarize-days', type=int, default=14, help='Days passed to summarize_discord.main')
+    parser.add_argument('--workers', type=int, default=4, help='Chunks summarized at the same time')
+    parser.add_argument('--chat-latency', type=float, default=0.5, help='Seconds each stub chat completion takes')
+    parser.add_argument('--embedding-latency', type=float, default=0.1, help='Seconds each stub embeddings request takes')
+    parser.add_argument('--dimensions', type=int, default=256, help='Stub embedding size, text-embedding-3-large is 3072')
+    parser.add_argument('--workdir', type=str, default='benchmarks/data/pipeline', help='Where exports and databases are written')
+    parser.add_argument('--output', type=str, default='benchmarks/data/pipeline_results.jsonl', help='Results are appended here and compared with the last run')
+    args = parser.parse_args()
+
+    server, base_url = start_in_thread(chat_latency=args.chat_latency, embedding_latency=args.embedding_latency, dimensions=args.dimensions)
+    # Read by the openai client, every pipeline call goes to the stub
+    os.environ['OPENAI_BASE_URL'] = base_url
+    os.environ['OPENAI_KEY'] = 'benchmark'
+
+    output = os.path.abspath(args.output)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    previous = load_previous(output)
+    run = {'date': datetime.now().isoformat(timespec='seconds'), 'commit': current_commit(), 'chat_latency': args.chat_latency, 'embedding_latency': args.embedding_latency}
+
+    try:
+        for size in args.sizes:
+            for result in bench_size(size, args):
+                record = {**run, 'messages': size, **result}
+                with open(output, 'a') as f:
+                    f.write(json.dumps(record) + "\n")
+                before = previous.get((size, result['benchmark']))
+                change = f" ({(result['seconds'] / before['seconds'] - 1) * 100:+.0f}% vs {before['commit']})" if before else ""
+                print(f"{size:>9} messages  {result['benchmark']:<20} {result['seconds']:8.2f}s{change}")
+    finally:
+        server.shutdown()
+    print(f"Results appended to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
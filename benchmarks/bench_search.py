@@ -0,0 +1,55 @@
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import time
+
+from benchmarks.synthetic import make_vocabulary, populate_database
+from src.ingest_messages import create_database
+from src.search_messages import search_fts, search_like
+
+
+def time_search(search, cursor, keywords, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = search(cursor, keywords)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), len(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare FTS5 MATCH against the LIKE scan in search_index")
+    parser.add_argument('--messages', type=int, default=1000000, help='Number of synthetic messages')
+    parser.add_argument('--keywords', type=int, default=50, help='Number of keywords per query')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per search, the median is reported')
+    parser.add_argument('--db', type=str, default=None, help='Where to keep the synthetic database')
+    args = parser.parse_args()
+
+    db_path = args.db or f"benchmarks/data/search_{args.messages}.db"
+    if not os.path.exists(db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        print(f"Generating {args.messages} synthetic messages into {db_path}...")
+        start = time.perf_counter()
+        create_database(db_path)
+        populate_database(db_path, args.messages)
+        print(f"Generated in {time.perf_counter() - start:.1f}s")
+
+    # Mid-frequency words, like the ~50 keywords gpt-4o hands back
+    vocabulary = make_vocabulary()
+    keywords = random.Random(1).sample(vocabulary[50:1000], args.keywords)
+
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    like_time, like_rows = time_search(search_like, cursor, keywords, args.repeat)
+    fts_time, fts_rows = time_search(search_fts, cursor, keywords, args.repeat)
+    conn.close()
+
+    print(f"LIKE scan: {like_time * 1000:.1f} ms, {like_rows} rows")
+    print(f"FTS5 MATCH: {fts_time * 1000:.1f} ms, {fts_rows} rows")
+    print(f"Speedup: {like_time / fts_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import argparse
+import statistics
+import time
+
+import numpy as np
+
+from src.similarity import calculate_similarity, embedding_matrix, top_k_indices
+
+
+# The re-rank stage as it was before src.similarity, kept here as the baseline
+def python_rerank(embeddings, query_embedding, k):
+    def dot_product(v1, v2):
+        return sum(x*y for x, y in zip(v1, v2))
+    similarities = [dot_product(embed, query_embedding) for embed in embeddings]
+    return sorted(range(len(similarities)), key=lambda i: similarities[i], reverse=True)[:k]
+
+
+def numpy_rerank(embeddings, query_embedding, k):
+    return top_k_indices(calculate_similarity(embeddings, query_embedding), k)
+
+
+def median_time(function, repeat, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the pure Python and NumPy embedding re-rank")
+    parser.add_argument('--candidates', type=int, default=5000, help='Number of keyword hits to re-rank')
+    parser.add_argument('--dimensions', type=int, default=3072, help='Embedding size, 3072 for text-embedding-3-large')
+    parser.add_argument('--top-k', type=int, default=200, help='Candidates kept for the LLM selection step')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per implementation, the median is reported')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    matrix = rng.standard_normal((args.candidates, args.dimensions)).astype(np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    query = matrix[0] + 0.1 * rng.standard_normal(args.dimensions).astype(np.float32)
+    query /= np.linalg.norm(query)
+    # process_query gets embeddings as Python lists from the API, or as arrays from the store
+    embeddings = matrix.tolist()
+    query_embedding = query.tolist()
+
+    python_time, python_top = median_time(python_rerank, args.repeat, embeddings, query_embedding, args.top_k)
+    numpy_time, numpy_top = median_time(numpy_rerank, args.repeat, embeddings, query_embedding, args.top_k)
+    stored = [row for row in matrix]
+    stored_time, _ = median_time(numpy_rerank, args.repeat, stored, query_embedding, args.top_k)
+    packed = embedding_matrix(embeddings)
+    packed_time, _ = median_time(numpy_rerank, args.repeat, packed, query_embedding, args.top_k)
+
+    assert list(python_top[:10]) == list(numpy_top[:10])
+    print(f"{args.candidates} candidates x {args.dimensions} dimensions, top {args.top_k}")
+    print(f"Pure Python: {python_time * 1000:.1f} ms")
+    print(f"NumPy from lists: {numpy_time * 1000:.1f} ms ({python_time / numpy_time:.0f}x)")
+    print(f"NumPy from stored float32 vectors: {stored_time * 1000:.1f} ms ({python_time / stored_time:.0f}x)")
+    print(f"NumPy on a packed matrix: {packed_time * 1000:.1f} ms ({python_time / packed_time:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
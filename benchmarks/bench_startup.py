@@ -0,0 +1,69 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ['src.bot', 'src.search_messages', 'src.summarize_discord', 'src.summary_cache', 'src.ingest_messages', 'src.embedding_store']
+
+
+# Import a module in a fresh interpreter under -X importtime. Returns the module's cumulative
+# import time and the heaviest top level imports underneath it, in seconds.
+def import_profile(module, cwd):
+    env = {key: value for key, value in os.environ.items() if key != 'OPENAI_KEY'}
+    env['PYTHONPATH'] = REPO_ROOT
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=cwd, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+    lines = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        lines.append((int(cumulative) / 1e6, name.strip(), len(name) - len(name.lstrip())))
+    # A module's imports are listed before it, indented two more spaces per level
+    index = next(i for i, (_, name, _) in enumerate(lines) if name == module)
+    total, _, depth = lines[index]
+    children = []
+    for seconds, name, child_depth in reversed(lines[:index]):
+        if child_depth <= depth:
+            break
+        if child_depth == depth + 2:
+            children.append((seconds, name))
+    return total, sorted(children, reverse=True)[:5]
+
+
+def time_command(command, cwd, repeat):
+    env = {key: value for key, value in os.environ.items() if key != 'OPENAI_KEY'}
+    env['PYTHONPATH'] = REPO_ROOT
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=cwd, env=env, capture_output=True, check=True)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import and --help start-up time of the entry points, measured with python -X importtime")
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per --help timing, the median is reported')
+    args = parser.parse_args()
+
+    # An empty directory with no config.json and no OPENAI_KEY: imports must not need either
+    with tempfile.TemporaryDirectory() as cwd:
+        for module in MODULES:
+            total, heaviest = import_profile(module, cwd)
+            print(f"import {module}: {total * 1000:.0f} ms")
+            for seconds, name in heaviest:
+                print(f"    {name:<30} {seconds * 1000:6.0f} ms")
+
+        for module in ['src.ingest_messages', 'src.search_messages', 'src.summarize_discord']:
+            seconds = time_command([sys.executable, '-m', module, '--help'], cwd, args.repeat)
+            print(f"python -m {module} --help: {seconds * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
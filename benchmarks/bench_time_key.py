@@ -0,0 +1,136 @@
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from benchmarks.synthetic import populate_database
+from src import db
+from src.ingest_messages import build_indexes, create_database, sessionize
+from src.utils import merge_intervals
+
+# Range queries and context expansion keyed on the TEXT timestamp, the way they worked before
+# messages.time_ms, against the integer time key and the sessions built at ingest.
+
+# The rows the text queries used to return
+TextContextMessage = namedtuple('TextContextMessage', 'message_id name timestamp contents attachments token_count')
+
+
+def text_messages_between(conn, start_date, end_date):
+    rows = conn.execute('''
+    SELECT message_id, name, timestamp, contents, attachments, token_count
+    FROM messages
+    WHERE timestamp BETWEEN ? AND ?
+    ORDER BY timestamp ASC
+    ''', (start_date, end_date))
+    return [TextContextMessage._make(row) for row in rows]
+
+
+def text_expansion(conn, hits, minutes_nearby=60):
+    windows = []
+    for priority, message in enumerate(hits):
+        timestamp_dt = datetime.strptime(message[2], "%Y-%m-%d %H:%M:%S")
+        start_timestamp = (timestamp_dt - timedelta(minutes=minutes_nearby)).strftime("%Y-%m-%d %H:%M:%S")
+        end_timestamp = (timestamp_dt + timedelta(minutes=minutes_nearby)).strftime("%Y-%m-%d %H:%M:%S")
+        windows.append((start_timestamp, end_timestamp, priority))
+    merged = sorted(merge_intervals(windows), key=lambda window: window[2])
+    values = ", ".join("(?, ?, ?)" for _ in merged)
+    params = [value for i, (start, end, _) in enumerate(merged) for value in (i, start, end)]
+    groups = [[] for _ in merged]
+    rows = conn.execute(f'''
+    WITH ranges (range_index, start_timestamp, end_timestamp) AS (VALUES {values})
+    SELECT r.range_index, m.message_id, m.name, m.timestamp, m.contents, m.attachments, m.token_count
+    FROM ranges r
+    JOIN messages m ON m.timestamp >= r.start_timestamp AND m.timestamp <= r.end_timestamp
+    ORDER BY r.range_index, m.timestamp
+    ''', params)
+    for row in rows:
+        groups[row[0]].append(TextContextMessage._make(row[1:]))
+    return groups
+
+
+def integer_expansion(conn, hits, minutes_nearby=60):
+    nearby_ms = minutes_nearby * 60 * 1000
+    windows = [(hit.time_ms - nearby_ms, hit.time_ms + nearby_ms, priority) for priority, hit in enumerate(hits)]
+    merged = sorted(merge_intervals(windows), key=lambda window: window[2])
+    return db.messages_in_ranges(conn, [(start, end) for start, end, _ in merged])
+
+
+def session_expansion(conn, hits):
+    sessions = db.session_ids(conn, [hit.message_id for hit in hits])
+    return db.messages_in_sessions(conn, list(dict.fromkeys(sessions)))
+
+
+def timed(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
+
+
+def report(label, seconds, count, unit):
+    print(f"{label:<32} {seconds * 1000:9.1f} ms  {count / seconds:12.0f} {unit}/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare TEXT timestamp and integer time key range queries and context expansion")
+    parser.add_argument('--messages', type=int, default=1000000, help='Number of synthetic messages')
+    parser.add_argument('--ranges', type=int, default=200, help='Day long ranges queried per run')
+    parser.add_argument('--hits', type=int, default=30, help='Messages expanded per run, like a relevance selection')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs of each, the median is reported')
+    parser.add_argument('--db', type=str, default=None, help='Where to keep the synthetic database')
+    args = parser.parse_args()
+
+    db_path = args.db or f"benchmarks/data/time_key_{args.messages}.db"
+    if not os.path.exists(db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        print(f"Generating {args.messages} synthetic messages into {db_path}...")
+        start = time.perf_counter()
+        create_database(db_path, defer_indexes=True)
+        populate_database(db_path, args.messages)
+        build_indexes(db_path)
+        sessionize(db_path)
+        print(f"Generated in {time.perf_counter() - start:.1f}s")
+
+    # The text queries need the old timestamp index, it's dropped again afterwards
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_timestamp ON messages (timestamp)')
+    conn.commit()
+    try:
+        rng = random.Random(1)
+        first, last = db.time_span(conn)
+        day = 24 * 3600 * 1000
+        starts = [rng.randrange(first, last - day) for _ in range(args.ranges)]
+        text_ranges = [(db.from_time_ms(start).strftime('%Y-%m-%d %H:%M:%S'), db.from_time_ms(start + day).strftime('%Y-%m-%d %H:%M:%S')) for start in starts]
+
+        text_seconds, text_rows = timed(lambda: sum(len(text_messages_between(conn, start, end)) for start, end in text_ranges), args.repeat)
+        integer_seconds, integer_rows = timed(lambda: sum(len(db.messages_between(conn, start, start + day)) for start in starts), args.repeat)
+        print(f"{args.ranges} day ranges, {integer_rows} rows per run (text found {text_rows})")
+        report("TEXT timestamp BETWEEN", text_seconds, args.ranges, 'ranges')
+        report("integer time_ms range", integer_seconds, args.ranges, 'ranges')
+
+        ids = [row[0] for row in conn.execute('SELECT message_id FROM messages ORDER BY random() LIMIT ?', (args.hits * args.repeat,))]
+        hit_sets = [db.messages_by_ids(conn, ids[i:i + args.hits]) for i in range(0, len(ids), args.hits)]
+        expansions = [
+            ("TEXT strptime windows", lambda hits: text_expansion(conn, hits)),
+            ("integer windows", lambda hits: integer_expansion(conn, hits)),
+            ("sessions", lambda hits: session_expansion(conn, hits)),
+        ]
+        print(f"Expanding {args.hits} hits")
+        for label, expand in expansions:
+            rounds = iter(hit_sets * 2)
+            seconds, rows = timed(lambda: expand(next(rounds)), args.repeat)
+            report(f"{label} ({sum(len(group) for group in rows)} rows)", seconds, args.hits, 'hits')
+    finally:
+        conn.execute('DROP INDEX IF EXISTS idx_timestamp')
+        conn.commit()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
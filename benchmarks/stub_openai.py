@@ -0,0 +1,199 @@
+import argparse
+import base64
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from benchmarks.synthetic import make_vocabulary
+
+# A local stand-in for the two OpenAI endpoints the pipelines use, so they can be timed end to end
+# without a key or network. Point the openai client at it with OPENAI_BASE_URL=http://host:port/v1.
+# Answers are deterministic for a given prompt and shaped like what gpt-4o sends back for each of
+# the pipelines' prompts: keyword JSON, selected message numbers, or a summary paragraph.
+
+VOCABULARY = make_vocabulary()
+
+
+def seed_for(text):
+    return zlib.crc32(text.encode('utf-8'))
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+def chat_reply(prompt):
+    rng = random.Random(seed_for(prompt))
+    if 'JSON blob of keywords' in prompt:
+        # Fairly rare words, real keyword lists mostly hit a few hundred messages each
+        return json.dumps({'keywords': rng.sample(VOCABULARY[1000:3000], 50)})
+    if 'ONLY RESPOND WITH THE MESSAGE NUMBERS' in prompt:
+        numbers = [int(number) for number in re.findall(r'^(\d+) ', prompt, re.MULTILINE)]
+        return json.dumps(sorted(rng.sample(numbers, min(30, len(numbers)))))
+    if 'Summaries follow' in prompt:
+        return f"# Digest\nMerged {prompt.count('Part ')} summaries. " + " ".join(rng.choices(VOCABULARY, k=120))
+    return "# Summary\n" + " ".join(rng.choices(VOCABULARY, k=200))
+
+
+def embedding_for(text, dimensions):
+    vector = np.random.default_rng(seed_for(text)).standard_normal(dimensions, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # One handler per connection, it serves every request sent on it
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+            status = self.server.fail_statuses.pop(0) if self.server.fail_statuses else None
+        try:
+            self.respond(status)
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def respond(self, status):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if status is not None:
+            # Injected failure, e.g. 429 or 500, with retry-after: 0 so retries don't wait
+            self.send_json(status, {'error': {'message': f'Injected {status}', 'type': 'stub_error'}}, {'retry-after': '0'})
+            return
+        if self.path.endswith('/chat/completions'):
+            time.sleep(self.server.chat_latency)
+            response = self.chat_completion(body)
+            if body.get('stream'):
+                self.send_stream(response, body)
+                return
+        elif self.path.endswith('/embeddings'):
+            time.sleep(self.server.embedding_latency)
+            response = self.embeddings(body)
+        else:
+            self.send_json(404, {'error': {'message': f'Unknown endpoint {self.path}', 'type': 'invalid_request_error'}})
+            return
+        self.send_json(200, response)
+
+    def chat_completion(self, body):
+        prompt = "\n".join(message.get('content', '') for message in body.get('messages', []))
+        reply = chat_reply(prompt)
+        prompt_tokens, completion_tokens = estimate_tokens(prompt), estimate_tokens(reply)
+        return {
+            'id': f'chatcmpl-stub-{seed_for(prompt)}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'gpt-4o'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': reply}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens},
+        }
+
+    def embeddings(self, body):
+        texts = body.get('input', [])
+        if isinstance(texts, str):
+            texts = [texts]
+        dimensions = body.get('dimensions') or self.server.dimensions
+        data = []
+        for index, text in enumerate(texts):
+            vector = embedding_for(text, dimensions)
+            if body.get('encoding_format') == 'base64':
+                embedding = base64.b64encode(vector.tobytes()).decode('ascii')
+            else:
+                embedding = vector.tolist()
+            data.append({'object': 'embedding', 'index': index, 'embedding': embedding})
+        prompt_tokens = sum(estimate_tokens(text) for text in texts)
+        return {
+            'object': 'list',
+            'data': data,
+            'model': body.get('model', 'text-embedding-3-large'),
+            'usage': {'prompt_tokens': prompt_tokens, 'total_tokens': prompt_tokens},
+        }
+
+    # Server-sent events the way the API streams them, a word per chunk and the usage last if asked for
+    def send_stream(self, response, body):
+        words = re.findall(r'\S+\s*', response['choices'][0]['message']['content'])
+        base = {key: response[key] for key in ('id', 'created', 'model')}
+        base['object'] = 'chat.completion.chunk'
+        chunks = [{**base, 'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': word}, 'finish_reason': None}]} for word in words]
+        chunks.append({**base, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})
+        if (body.get('stream_options') or {}).get('include_usage'):
+            chunks.append({**base, 'choices': [], 'usage': response['usage']})
+        encoded = "".join(f"data: {json.dumps(chunk)}\n\n" for chunk in chunks).encode('utf-8') + b"data: [DONE]\n\n"
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Content-Length', str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def send_json(self, status, payload, headers=None):
+        encoded = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(encoded)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(host='127.0.0.1', port=0, chat_latency=0.0, embedding_latency=0.0, dimensions=256):
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.chat_latency = chat_latency
+    server.embedding_latency = embedding_latency
+    server.dimensions = dimensions
+    # Statuses to answer the next requests with instead of a result, for testing retries
+    server.fail_statuses = []
+    # Counters for tests, kept under the lock since every connection has its own thread
+    server.lock = threading.Lock()
+    server.connections = 0
+    server.requests = 0
+    server.in_flight = 0
+    server.max_in_flight = 0
+    return server
+
+
+# Serve from a background thread, for tests. Returns the server and its base URL.
+def start_in_thread(**kwargs):
+    server = make_server(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    return server, f"http://{host}:{port}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve stub OpenAI chat and embeddings endpoints for benchmarks")
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--chat-latency', type=float, default=0.5, help='Seconds each chat completion takes')
+    parser.add_argument('--embedding-latency', type=float, default=0.1, help='Seconds each embeddings request takes')
+    parser.add_argument('--dimensions', type=int, default=256, help='Embedding size, text-embedding-3-large is 3072')
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.chat_latency, args.embedding_latency, args.dimensions)
+    print(f"Stub OpenAI API on http://{args.host}:{server.server_address[1]}/v1", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import itertools
+import json
+import random
+import sqlite3
+from datetime import datetime, timezone
+
+from src import db
+
+# Deterministic synthetic Discord DM history for benchmarks
+
+DISCORD_EPOCH_MS = 1420070400000
+CHANNEL_ID = 383761744830529537
+AUTHORS = ["Person1", "Person2"]
+
+SYLLABLES = ["ka", "lo", "mi", "ter", "an", "de", "ro", "su", "vel", "ni", "po", "gra", "ish", "um", "bo", "zen", "ty", "qua"]
+COMMON_WORDS = ["the", "a", "to", "and", "i", "you", "it", "is", "that", "lol", "yeah", "what", "for", "on", "with", "just", "so", "but", "like", "we"]
+
+
+def make_vocabulary(size=5000, seed=0):
+    rng = random.Random(seed)
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def snowflake_for(ms, sequence):
+    return ((ms - DISCORD_EPOCH_MS) << 22) | (sequence & 0x3FFFFF)
+
+
+def generate_messages(count, seed=0, start=datetime(2018, 1, 1, tzinfo=timezone.utc), vocabulary=None):
+    rng = random.Random(seed)
+    vocabulary = vocabulary or make_vocabulary(seed=seed)
+    # Zipf-ish weights so some words are common and most are rare, like real chat
+    cum_weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(len(vocabulary))))
+    # About four minutes per message on average, a million messages is roughly eight years.
+    # Bigger corpora are squeezed so snowflakes stay inside their 42 bits of milliseconds.
+    time_scale = min(1.0, 1000000 / max(count, 1))
+    ms = int(start.timestamp() * 1000)
+    for sequence in range(count):
+        # Bursty timestamps: mostly seconds apart, occasionally hours or days of silence
+        roll = rng.random()
+        if roll < 0.9:
+            gap = rng.randint(1, 90) * 1000
+        elif roll < 0.995:
+            gap = rng.randint(10, 180) * 60 * 1000
+        else:
+            gap = rng.randint(1, 3) * 24 * 3600 * 1000
+        ms += max(1, int(gap * time_scale))
+        words = rng.choices(COMMON_WORDS, k=rng.randint(0, 6)) + rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(1, 10))
+        rng.shuffle(words)
+        if rng.random() < 0.02:
+            words.append(f"<@{rng.randint(10**17, 10**18 - 1)}>")
+        yield {
+            "ID": snowflake_for(ms, sequence),
+            "Timestamp": datetime.fromtimestamp(ms / 1000, tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+            "Contents": " ".join(words),
+            "Attachments": "",
+            "Author": AUTHORS[0] if rng.random() < 0.5 else AUTHORS[1],
+        }
+
+
+def populate_database(db_path, count, seed=0, batch_size=50000):
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode = MEMORY")
+    conn.execute("PRAGMA synchronous = OFF")
+    batch = []
+    for message in generate_messages(count, seed=seed):
+        link = f"https://discord.com/channels/@me/{CHANNEL_ID}/{message['ID']}"
+        batch.append((message["ID"], message["Author"], message["Timestamp"], message["Contents"], message["Attachments"], link, db.message_time_ms(message["ID"], message["Timestamp"])))
+        if len(batch) >= batch_size:
+            conn.executemany("INSERT INTO messages (message_id, name, timestamp, contents, attachments, link, time_ms) VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+            batch = []
+    if batch:
+        conn.executemany("INSERT INTO messages (message_id, name, timestamp, contents, attachments, link, time_ms) VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+    conn.commit()
+    conn.close()
+
+
+# Write a Discord data package style messages.json per author, streaming so the generator
+# itself stays small. Stops once the files reach max_bytes in total or count messages.
+def write_export(directory, count=None, max_bytes=None, seed=0):
+    paths = {author: f"{directory}/{author}.json" for author in AUTHORS}
+    files = {author: open(path, 'w', encoding='utf-8') for author, path in paths.items()}
+    written = {author: 0 for author in AUTHORS}
+    total_bytes = 0
+    try:
+        for f in files.values():
+            f.write('[')
+        # About 150 bytes per message when only a size is given
+        for message in generate_messages(count if count is not None else max_bytes // 150, seed=seed):
+            author = message.pop("Author")
+            text = ('' if written[author] == 0 else ',\n') + json.dumps(message)
+            files[author].write(text)
+            written[author] += 1
+            total_bytes += len(text)
+            if max_bytes is not None and total_bytes >= max_bytes:
+                break
+        for f in files.values():
+            f.write(']')
+    finally:
+        for f in files.values():
+            f.close()
+    return [paths[author] for author in AUTHORS], sum(written.values())
@@ -19,6 +19,7 @@ sudo docker run --name discord-dm-searcher \
   -v "$current_dir/summaries:/app/summaries" \
   -v "$current_dir/searches:/app/searches" \
   -v "$current_dir/import:/app/import" \
+  -v "$current_dir/database:/app/database" \
   -v "$current_dir/OPENAI_KEY.txt:/app/OPENAI_KEY.txt:ro" \
   -v "$current_dir/DISCORD_TOKEN.txt:/app/DISCORD_TOKEN.txt:ro" \
   discord-dm-searcher
@@ -1,16 +1,128 @@
+import asyncio
+import time
 import discord
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from discord import app_commands
 from discord.ext import commands
 import os
 
-from src.search_messages import process_query
-from src.utils import load_config
-from src.summarize_discord import main as summarize_main
+from src.search_messages import process_query_events
+from src.utils import get_config
+from src.summarize_discord import summarize_events
 
-config = load_config()
 intents = discord.Intents.default()
 bot = commands.Bot(command_prefix='!', intents=intents)
 
+# The search and summarize pipelines are blocking, so they run on a small thread pool instead of
+# the event loop, which keeps the gateway heartbeat going and lets several commands run at once.
+# A global limit caps the pool (and the load on OpenAI), a per-user limit stops one person queueing everything.
+class JobQueue:
+    def __init__(self, max_concurrent_jobs, max_jobs_per_user):
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.max_jobs_per_user = max_jobs_per_user
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent_jobs, thread_name_prefix='pipeline')
+        # Created on first use so it belongs to the loop bot.run starts
+        self.semaphore = None
+        self.jobs_by_user = Counter()
+        self.active_jobs = 0
+
+    # Returns the job's place in the queue (0 if it can start right away), or None if the user is at their limit
+    def reserve(self, user_id):
+        if self.jobs_by_user[user_id] >= self.max_jobs_per_user:
+            return None
+        self.jobs_by_user[user_id] += 1
+        self.active_jobs += 1
+        return max(0, self.active_jobs - self.max_concurrent_jobs)
+
+    def release(self, user_id):
+        self.jobs_by_user[user_id] -= 1
+        self.active_jobs -= 1
+
+    # Run a pipeline's event generator on the pool and hand its events over as they come.
+    # The whole generator runs on one worker thread, like a plain job.
+    async def stream(self, func, *args, **kwargs):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrent_jobs)
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            events = asyncio.Queue()
+            done = object()
+
+            def produce():
+                try:
+                    for event in func(*args, **kwargs):
+                        loop.call_soon_threadsafe(events.put_nowait, event)
+                finally:
+                    loop.call_soon_threadsafe(events.put_nowait, done)
+
+            future = loop.run_in_executor(self.executor, produce)
+            while True:
+                event = await events.get()
+                if event is done:
+                    break
+                yield event
+            # Raises whatever stopped the pipeline
+            await future
+
+@lru_cache(maxsize=None)
+def get_jobs():
+    config = get_config()
+    return JobQueue(config['max_concurrent_jobs'], config['max_jobs_per_user'])
+
+def queue_note(position):
+    return f" You're #{position} in the queue." if position else ""
+
+# Discord rate limits message edits, partial output is sent at most this often
+EDIT_INTERVAL_SECONDS = 1.5
+
+# Shows a pipeline's progress on the command's first message and writes its answer into follow-up
+# messages as it arrives, editing the last one until it's full and then starting the next
+class StreamingReply:
+    def __init__(self, interaction, heading):
+        self.interaction = interaction
+        self.heading = heading
+        self.messages = []
+        self.text = ""
+        self.last_flush = 0.0
+
+    async def status(self, text):
+        await self.interaction.edit_original_response(content=f"{self.heading}\n{text}")
+
+    async def append(self, text):
+        self.text += text
+        if time.monotonic() - self.last_flush >= EDIT_INTERVAL_SECONDS:
+            await self.flush()
+
+    # Bring the follow-ups in line with the text, or with the final answer if one is given
+    async def flush(self, text=None):
+        if text is not None:
+            self.text = text
+        self.last_flush = time.monotonic()
+        if not self.text.strip():
+            return
+        for i, chunk in enumerate(split_text(self.text)):
+            if i < len(self.messages):
+                if self.messages[i].content != chunk:
+                    self.messages[i] = await self.messages[i].edit(content=chunk)
+            else:
+                self.messages.append(await self.interaction.followup.send(chunk, wait=True))
+
+    async def play(self, events):
+        try:
+            async for event in events:
+                if event.kind == 'status':
+                    await self.status(event.text)
+                elif event.kind == 'output':
+                    await self.append(event.text)
+                elif event.kind == 'result':
+                    await self.flush(event.text)
+                    await self.interaction.edit_original_response(content=self.heading)
+        finally:
+            # If Discord fails us halfway, give the job's slot back now rather than whenever it's collected
+            await events.aclose()
+
 def get_discord_token():
     if os.path.isfile('DISCORD_TOKEN.txt'):
         with open('DISCORD_TOKEN.txt', 'r') as file:
@@ -34,9 +146,11 @@ def split_text(text, max_length=1900):
 @app_commands.describe(
     search_term="Search term",
     keyword_override="A comma separated list of specific keywords to search. Don't use spaces next to the commas",
-    send_all_matches="Send all matches to OpenAI (may crash with too many matches)"
+    send_all_matches="Skip embeddings, rank the matches by keywords alone and send the best to OpenAI",
+    semantic_only="Skip keywords and search the whole history by meaning (needs the vector index)"
 )
-async def search(interaction: discord.Interaction, search_term: str, keyword_override: str = None, send_all_matches: bool = False):
+async def search(interaction: discord.Interaction, search_term: str, keyword_override: str = None, send_all_matches: bool = False, semantic_only: bool = False):
+    config = get_config()
     allowed_servers = config['allowed_servers']
     allowed_users = config['allowed_users']
 
@@ -44,19 +158,20 @@ async def search(interaction: discord.Interaction, search_term: str, keyword_ove
         await interaction.response.send_message("You aren't allowed to use this :)")
         return
 
-    await interaction.response.send_message(f"Working on answering '{search_term}', please wait about 30 seconds...")
+    jobs = get_jobs()
+    position = jobs.reserve(interaction.user.id)
+    if position is None:
+        await interaction.response.send_message(f"You already have {jobs.max_jobs_per_user} request(s) running, please wait for them to finish.")
+        return
 
     try:
-        summary = process_query(search_term, keyword_override, send_all_matches)
-
-        if len(summary) > 1900:
-            chunks = split_text(summary)
-            for chunk in chunks:
-                message = await interaction.followup.send(chunk)
-        else:
-            message = await interaction.followup.send(summary)
+        heading = f"Answering '{search_term}'"
+        await interaction.response.send_message(f"{heading}, this can take a moment...{queue_note(position)}")
+        await StreamingReply(interaction, heading).play(jobs.stream(process_query_events, search_term, keyword_override, send_all_matches, semantic_only))
     except Exception as e:
         await interaction.followup.send(f"An error occurred: {str(e)}")
+    finally:
+        jobs.release(interaction.user.id)
 
 # Create the summarize slash command
 @bot.tree.command(name="summarize", description="Summarize Discord DM conversations")
@@ -65,6 +180,7 @@ async def search(interaction: discord.Interaction, search_term: str, keyword_ove
     num_days="Number of days to summarize (default 30)",
 )
 async def summarize(interaction: discord.Interaction, start_date: str = None, num_days: int = 30):
+    config = get_config()
     allowed_servers = config['allowed_servers']
     allowed_users = config['allowed_users']
 
@@ -76,18 +192,20 @@ async def summarize(interaction: discord.Interaction, start_date: str = None, nu
         await interaction.response.send_message("The 'days' parameter cannot be greater than 61.")
         return
 
-    await interaction.response.send_message(f"Summarizing conversations from '{start_date}' for {num_days} days, please wait about 30 seconds")
+    jobs = get_jobs()
+    position = jobs.reserve(interaction.user.id)
+    if position is None:
+        await interaction.response.send_message(f"You already have {jobs.max_jobs_per_user} request(s) running, please wait for them to finish.")
+        return
 
     try:
-        summary = summarize_main(start_date, num_days, max_chunks=10, window=120000)
-        if len(summary) > 1900:
-            chunks = split_text(summary)
-            for chunk in chunks:
-                message = await interaction.followup.send(chunk)
-        else:
-            message = await interaction.followup.send(summary)
+        heading = f"Summarizing conversations from '{start_date}' for {num_days} days"
+        await interaction.response.send_message(f"{heading}, this can take a moment.{queue_note(position)}")
+        await StreamingReply(interaction, heading).play(jobs.stream(summarize_events, start_date, num_days, max_chunks=10, window=120000, use_cache=config['use_summary_cache']))
     except Exception as e:
         await interaction.followup.send(f"An error occurred: {str(e)}")
+    finally:
+        jobs.release(interaction.user.id)
 
 
 @bot.event
@@ -96,6 +214,8 @@ async def on_ready():
     await bot.tree.sync()
 
 def main():
+    # A broken config.json should stop the bot now, not on the first command
+    get_config()
     token = get_discord_token()
     if token:
         bot.run(token)
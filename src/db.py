@@ -0,0 +1,186 @@
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+DATABASE_PATH = 'database/messages.db'
+
+# Read side settings, reads are most of the traffic once the history is ingested
+READ_PRAGMAS = [
+    'PRAGMA query_only = ON',
+    'PRAGMA mmap_size = 268435456',  # 256 MiB
+    'PRAGMA cache_size = -32768',  # 32 MiB
+    'PRAGMA temp_store = MEMORY',
+]
+
+# SQLite's default limit on bound parameters is 999
+MAX_QUERY_PARAMS = 900
+
+# Discord IDs are snowflakes, everything above their low 22 bits is milliseconds since the start of 2015
+DISCORD_EPOCH_MS = 1420070400000
+SNOWFLAKE_TIME_SHIFT = 22
+UNIX_EPOCH = datetime(1970, 1, 1)
+
+# messages.time_ms for rows inserted without one, same rule as message_time_ms. Also used to fill
+# the column in when migrating. strftime('%s') reads the timestamp as UTC like the exports are.
+TIME_MS_SQL = '''CASE WHEN {message_id} >= 4194304 THEN ({message_id} >> 22) + 1420070400000
+    ELSE CAST(strftime('%s', {timestamp}) AS INTEGER) * 1000 END'''
+
+# Rows from the search queries, and the context rows that carry the token count and session stored at ingest
+Message = namedtuple('Message', 'message_id name timestamp contents attachments link time_ms')
+ContextMessage = namedtuple('ContextMessage', 'message_id name timestamp contents attachments token_count session_id time_ms')
+
+# Times are kept as integer milliseconds since 1970 UTC. Naive datetimes and dates are taken as
+# UTC, which is what the exports' timestamps are in.
+def to_time_ms(value):
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return (value - UNIX_EPOCH) // timedelta(milliseconds=1)
+
+def from_time_ms(time_ms):
+    return UNIX_EPOCH + timedelta(milliseconds=time_ms)
+
+# The time key ingest stores, read straight from the snowflake so no timestamp has to be parsed
+def message_time_ms(message_id, timestamp):
+    if message_id >= 1 << SNOWFLAKE_TIME_SHIFT:
+        return (message_id >> SNOWFLAKE_TIME_SHIFT) + DISCORD_EPOCH_MS
+    # IDs too small to be snowflakes only come from hand made exports
+    return to_time_ms(datetime.fromisoformat(timestamp))
+
+# One read connection per thread and database file, reused for the life of the thread.
+# The bot's worker threads and the CLIs keep theirs open instead of connecting per query.
+local = threading.local()
+
+# WAL lets readers carry on while an ingest writes. It's stored in the database file, so it only
+# has to be set by whoever creates or migrates it.
+def enable_wal(conn):
+    conn.execute('PRAGMA journal_mode = WAL')
+
+def write_connection(db_path=DATABASE_PATH):
+    conn = sqlite3.connect(db_path, timeout=30)
+    enable_wal(conn)
+    # Safe with WAL, only the last transactions can be lost on power failure, never corrupted
+    conn.execute('PRAGMA synchronous = NORMAL')
+    return conn
+
+def read_connection(db_path=DATABASE_PATH):
+    connections = getattr(local, 'connections', None)
+    if connections is None:
+        connections = local.connections = {}
+    key = os.path.abspath(db_path)
+    # A rebuild replaces the file, reconnect rather than keep reading the deleted one
+    inode = os.stat(db_path).st_ino
+    cached = connections.get(key)
+    if cached is not None and cached[1] == inode:
+        return cached[0]
+    if cached is not None:
+        cached[0].close()
+    conn = sqlite3.connect(db_path)
+    for pragma in READ_PRAGMAS:
+        conn.execute(pragma)
+    connections[key] = (conn, inode)
+    return conn
+
+def close_read_connections():
+    for conn, _ in getattr(local, 'connections', {}).values():
+        conn.close()
+    local.connections = {}
+
+# The queries below take a connection or a cursor
+
+def messages_by_ids(conn, message_ids):
+    message_ids = list(message_ids)
+    by_id = {}
+    for i in range(0, len(message_ids), MAX_QUERY_PARAMS):
+        batch = message_ids[i:i + MAX_QUERY_PARAMS]
+        placeholders = ", ".join("?" for _ in batch)
+        for row in conn.execute(f'''
+        SELECT message_id, name, timestamp, contents, attachments, link, time_ms
+        FROM messages
+        WHERE message_id IN ({placeholders})
+        ''', batch):
+            by_id[row[0]] = Message._make(row)
+    # Keep the order the ids were given in
+    return [by_id[message_id] for message_id in message_ids if message_id in by_id]
+
+# Fetch several disjoint time ranges, given as (start_ms, end_ms) inclusive, one query per batch of ranges.
+# Returns one list of messages per range, in the order the ranges were given.
+def messages_in_ranges(conn, ranges, batch_size=300):
+    groups = [[] for _ in ranges]
+    for offset in range(0, len(ranges), batch_size):
+        batch = ranges[offset:offset + batch_size]
+        values = ", ".join("(?, ?, ?)" for _ in batch)
+        params = [value for i, (start, end) in enumerate(batch, start=offset) for value in (i, start, end)]
+        query = f'''
+        WITH ranges (range_index, start_ms, end_ms) AS (VALUES {values})
+        SELECT r.range_index, m.message_id, m.name, m.timestamp, m.contents, m.attachments, m.token_count, m.session_id, m.time_ms
+        FROM ranges r
+        JOIN messages m ON m.time_ms >= r.start_ms AND m.time_ms <= r.end_ms
+        ORDER BY r.range_index, m.time_ms
+        '''
+        for row in conn.execute(query, params):
+            groups[row[0]].append(ContextMessage._make(row[1:]))
+    return groups
+
+# Session of each message, None for messages that haven't been put in one yet
+def session_ids(conn, message_ids):
+    message_ids = list(message_ids)
+    sessions = {}
+    for i in range(0, len(message_ids), MAX_QUERY_PARAMS):
+        batch = message_ids[i:i + MAX_QUERY_PARAMS]
+        placeholders = ", ".join("?" for _ in batch)
+        sessions.update(conn.execute(f'SELECT message_id, session_id FROM messages WHERE message_id IN ({placeholders})', batch))
+    return [sessions.get(message_id) for message_id in message_ids]
+
+# Whole sessions by ID, one list of messages per session in the order the IDs were given
+def messages_in_sessions(conn, session_ids):
+    session_ids = list(session_ids)
+    by_session = {session_id: [] for session_id in session_ids}
+    for i in range(0, len(session_ids), MAX_QUERY_PARAMS):
+        batch = session_ids[i:i + MAX_QUERY_PARAMS]
+        placeholders = ", ".join("?" for _ in batch)
+        for row in conn.execute(f'''
+        SELECT message_id, name, timestamp, contents, attachments, token_count, session_id, time_ms
+        FROM messages
+        WHERE session_id IN ({placeholders})
+        ORDER BY session_id, time_ms
+        ''', batch):
+            by_session[row[6]].append(ContextMessage._make(row))
+    return [by_session[session_id] for session_id in session_ids]
+
+# Messages from start_ms up to but not including end_ms, oldest first
+def messages_between(conn, start_ms, end_ms):
+    return list(iter_messages_between(conn, start_ms, end_ms))
+
+# messages_between as a generator, rows are only read from the cursor as they're asked for
+def iter_messages_between(conn, start_ms, end_ms):
+    rows = conn.execute('''
+    SELECT message_id, name, timestamp, contents, attachments, token_count, session_id, time_ms
+    FROM messages
+    WHERE time_ms >= ? AND time_ms < ?
+    ORDER BY time_ms ASC
+    ''', (start_ms, end_ms))
+    for row in rows:
+        yield ContextMessage._make(row)
+
+# The same messages with just enough to size them, contents only for rows without a stored token count
+def iter_message_sizes_between(conn, start_ms, end_ms):
+    rows = conn.execute('''
+    SELECT message_id, name, timestamp, CASE WHEN token_count IS NULL THEN contents END, NULL, token_count, session_id, time_ms
+    FROM messages
+    WHERE time_ms >= ? AND time_ms < ?
+    ORDER BY time_ms ASC
+    ''', (start_ms, end_ms))
+    for row in rows:
+        yield ContextMessage._make(row)
+
+# Oldest and newest message times, None for an empty database
+def time_span(conn):
+    return conn.execute('SELECT MIN(time_ms), MAX(time_ms) FROM messages').fetchone()
+
+# messages.id is AUTOINCREMENT and ingest only ever appends, so its maximum moves whenever the content does
+def database_version(conn):
+    return conn.execute('SELECT MAX(id) FROM messages').fetchone()[0]
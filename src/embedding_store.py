@@ -0,0 +1,120 @@
+import argparse
+import os
+import sqlite3
+import threading
+import numpy as np
+from tqdm import tqdm
+from src.utils import require_openai_key
+from src import openai_async
+from src import db
+
+DATABASE_PATH = 'database/messages.db'
+# Kept next to messages.db rather than in it, so re-ingesting the data packages doesn't throw embeddings away
+EMBEDDINGS_PATH = 'database/embeddings.db'
+EMBEDDING_MODEL = 'text-embedding-3-large'
+
+def connect(embeddings_path=EMBEDDINGS_PATH):
+    conn = sqlite3.connect(embeddings_path)
+    # The bot's searches store new embeddings while a backfill may be running
+    db.enable_wal(conn)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS embeddings (
+            message_id INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            vector BLOB NOT NULL,
+            PRIMARY KEY (message_id, model)
+        ) WITHOUT ROWID
+    ''')
+    return conn
+
+local = threading.local()
+
+# One connection per thread and store, kept open across searches like db.read_connection
+def thread_connection(embeddings_path=EMBEDDINGS_PATH):
+    connections = getattr(local, 'connections', None)
+    if connections is None:
+        connections = local.connections = {}
+    key = os.path.abspath(embeddings_path)
+    if key not in connections:
+        connections[key] = connect(embeddings_path)
+    return connections[key]
+
+# Vectors are stored as packed float32, a quarter of the size of their JSON form
+def encode_vector(vector):
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+def decode_vector(blob):
+    return np.frombuffer(blob, dtype=np.float32)
+
+def load_embeddings(conn, message_ids, model=EMBEDDING_MODEL):
+    message_ids = list(message_ids)
+    embeddings = {}
+    for i in range(0, len(message_ids), db.MAX_QUERY_PARAMS):
+        batch = message_ids[i:i + db.MAX_QUERY_PARAMS]
+        placeholders = ", ".join("?" for _ in batch)
+        cursor = conn.execute(f'''
+            SELECT message_id, vector FROM embeddings
+            WHERE model = ? AND message_id IN ({placeholders})
+        ''', [model, *batch])
+        for message_id, blob in cursor:
+            embeddings[message_id] = decode_vector(blob)
+    return embeddings
+
+def store_embeddings(conn, items, model=EMBEDDING_MODEL):
+    conn.executemany(
+        'INSERT OR REPLACE INTO embeddings (message_id, model, vector) VALUES (?, ?, ?)',
+        [(message_id, model, encode_vector(vector)) for message_id, vector in items]
+    )
+    conn.commit()
+
+# batch_size is the most texts per request, the requests run in parallel
+def embed_texts(client, texts, model=EMBEDDING_MODEL, batch_size=openai_async.EMBEDDING_BATCH_INPUTS):
+    return openai_async.embed(texts, model, client, max_inputs=batch_size)
+
+# Embed every message that doesn't have a stored vector yet. Each group of rows is embedded as
+# parallel requests of batch_size and committed together, so it can be resumed.
+def backfill(client, db_path=DATABASE_PATH, embeddings_path=EMBEDDINGS_PATH, model=EMBEDDING_MODEL, batch_size=500):
+    conn = connect(embeddings_path)
+    conn.execute('ATTACH DATABASE ? AS source', (db_path,))
+    missing_query = '''
+        FROM source.messages m
+        WHERE m.contents != ''
+        AND NOT EXISTS (SELECT 1 FROM embeddings e WHERE e.message_id = m.message_id AND e.model = ?)
+    '''
+    total = conn.execute(f'SELECT COUNT(*) {missing_query}', (model,)).fetchone()[0]
+    print(f"{total} messages are missing `{model}` embeddings")
+
+    # Read a page at a time after the last message embedded, so memory use doesn't grow with the history
+    group_size = batch_size * openai_async.MAX_CONCURRENT_REQUESTS
+    last_message_id = -1
+    with tqdm(total=total, desc="Embedding messages") as progress:
+        while True:
+            batch = conn.execute(f'SELECT m.message_id, m.contents {missing_query} AND m.message_id > ? ORDER BY m.message_id LIMIT ?',
+                                 (model, last_message_id, group_size)).fetchall()
+            if not batch:
+                break
+            vectors = embed_texts(client, [contents for _, contents in batch], model, batch_size)
+            store_embeddings(conn, zip((message_id for message_id, _ in batch), vectors), model)
+            last_message_id = batch[-1][0]
+            progress.update(len(batch))
+
+    conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the on-disk message embedding store")
+    parser.add_argument('--backfill', action='store_true', help='Embed every message that is missing from the store')
+    parser.add_argument('--batch-size', type=int, default=500, help='Messages per embeddings request')
+    parser.add_argument('--model', type=str, default=EMBEDDING_MODEL, help='Embedding model name')
+    args = parser.parse_args()
+
+    if args.backfill:
+        require_openai_key()
+        backfill(openai_async.get_async_client(), model=args.model, batch_size=args.batch_size)
+    else:
+        conn = connect()
+        for model, count in conn.execute('SELECT model, COUNT(*) FROM embeddings GROUP BY model'):
+            print(f"{model}: {count} stored embeddings")
+        conn.close()
+
+if __name__ == "__main__":
+    main()
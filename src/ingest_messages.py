@@ -1,15 +1,37 @@
 import json
+import re
 import sqlite3
 import argparse
-from src.utils import load_config
+import itertools
+import time
+from src.utils import fts5_available, has_fts_index, rewrite_mentions
+from src.tokens import count_message_tokens
+from src import db
 import os
 from tqdm import tqdm
 
 
-id_to_name = load_config()['id_to_name']
+# SQLite settings for loading a fresh database, trading crash safety for speed.
+# If the load dies halfway the database is rebuilt from the JSON files anyway.
+BULK_LOAD_PRAGMAS = [
+    'PRAGMA journal_mode = MEMORY',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA cache_size = -65536',  # 64 MiB
+]
+
+# A quiet spell this long ends a conversation session
+SESSION_GAP_MINUTES = 30
+# Sessions are cut at this size even without a gap, so one never swamps a search or a summary chunk
+SESSION_MAX_TOKENS = 8000
+
+# OR IGNORE skips messages that are already in the database, by the unique message_id index
+INSERT_MESSAGE_SQL = '''
+    INSERT OR IGNORE INTO messages (message_id, name, timestamp, contents, attachments, link, token_count, time_ms)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
 
 # Function to create the database
-def create_database(db_path):
+def create_database(db_path, defer_indexes=False):
     conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
     
@@ -22,51 +44,372 @@ def create_database(db_path):
             timestamp TEXT,
             contents TEXT,
             attachments TEXT,
-            link TEXT
+            link TEXT,
+            token_count INTEGER,
+            session_id INTEGER,
+            time_ms INTEGER
         )
     ''')
-    cursor.execute('CREATE INDEX idx_name ON messages (name)')
-    cursor.execute('CREATE INDEX idx_timestamp ON messages (timestamp)')
-    cursor.execute('CREATE INDEX idx_message_id ON messages (message_id)')
+
+    create_ingest_state_table(cursor)
+    create_sessions_table(cursor)
+    create_time_trigger(cursor)
+    db.enable_wal(conn)
+
+    # A bulk load builds the indexes once at the end instead of updating them on every insert
+    if not defer_indexes:
+        create_indexes(cursor)
     
     conn.commit()
     conn.close()
 
+# Highest message ID ingested from each source file, so a newer data package only costs its delta
+def create_ingest_state_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ingest_state (
+            source TEXT PRIMARY KEY,
+            last_message_id INTEGER NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    ''')
+
+# Conversations worked out from the gaps between messages, see build_sessions
+def create_sessions_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            id INTEGER PRIMARY KEY,
+            start_ms INTEGER NOT NULL,
+            end_ms INTEGER NOT NULL,
+            message_count INTEGER NOT NULL,
+            token_count INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_start ON sessions (start_ms)')
+
+# Ingest works out time_ms itself, this fills it in for rows inserted any other way
+def create_time_trigger(cursor):
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS messages_time_ms AFTER INSERT ON messages WHEN new.time_ms IS NULL BEGIN
+            UPDATE messages SET time_ms = {db.TIME_MS_SQL.format(message_id='new.message_id', timestamp='new.timestamp')} WHERE id = new.id;
+        END
+    ''')
+
+def create_indexes(cursor):
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_name ON messages (name)')
+    # Range scans by time read the columns sessioning and counting need from the index alone
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_time ON messages (time_ms, message_id, token_count, session_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_session_id ON messages (session_id, time_ms)')
+    create_message_id_index(cursor)
+
+    if fts5_available(cursor.connection):
+        if not has_fts_index(cursor.connection):
+            create_fts_index(cursor)
+            # Picks up any rows that were inserted before the triggers existed
+            cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    else:
+        print("SQLite was built without FTS5, searches will fall back to LIKE scans")
+
+def create_message_id_index(cursor):
+    index = cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND name = 'idx_message_id'").fetchone()
+    if index and 'UNIQUE' in index[0].upper():
+        return
+    # Databases from before incremental ingest may hold the same message twice, keep the first copy
+    cursor.execute('''
+        DELETE FROM messages WHERE id NOT IN (SELECT MIN(id) FROM messages GROUP BY message_id)
+    ''')
+    if cursor.rowcount > 0:
+        print(f"Removed {cursor.rowcount} duplicate messages")
+    cursor.execute('DROP INDEX IF EXISTS idx_message_id')
+    cursor.execute('CREATE UNIQUE INDEX idx_message_id ON messages (message_id)')
+
+# Bring a database from an older version of this script up to the current schema
+def migrate_database(db_path):
+    conn = db.write_connection(db_path)
+    cursor = conn.cursor()
+    create_ingest_state_table(cursor)
+    add_token_count_column(cursor)
+    add_time_column(cursor)
+    add_session_column(cursor)
+    if fts5_available(conn) and not has_fts_index(conn):
+        print("Building the full text index for the existing messages...")
+    create_indexes(cursor)
+    conn.commit()
+    conn.close()
+
+# Prompt token counts are worked out once at ingest, older databases get them filled in here
+def add_token_count_column(cursor, batch_size=10000):
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(messages)')]
+    if 'token_count' not in columns:
+        cursor.execute('ALTER TABLE messages ADD COLUMN token_count INTEGER')
+    missing = cursor.execute('SELECT COUNT(*) FROM messages WHERE token_count IS NULL').fetchone()[0]
+    if missing == 0:
+        return
+    print(f"Counting tokens for {missing} messages...")
+    last_id = 0
+    while True:
+        rows = cursor.execute('''
+            SELECT id, message_id, name, timestamp, contents FROM messages
+            WHERE token_count IS NULL AND id > ? ORDER BY id LIMIT ?
+        ''', (last_id, batch_size)).fetchall()
+        if not rows:
+            break
+        cursor.executemany('UPDATE messages SET token_count = ? WHERE id = ?',
+                           [(count_message_tokens((row[1], row[2], row[3] or '', row[4] or '')), row[0]) for row in rows])
+        last_id = rows[-1][0]
+
+# Group messages into sessions: a new one starts after SESSION_GAP_MINUTES without a message, or
+# when the current one reaches SESSION_MAX_TOKENS. Only messages without a session are new, so
+# sessioning restarts at the first session they could join and everything before it is kept.
+def build_sessions(cursor, gap_minutes=SESSION_GAP_MINUTES, max_tokens=SESSION_MAX_TOKENS, batch_size=10000):
+    earliest_new = cursor.execute('SELECT MIN(time_ms) FROM messages WHERE session_id IS NULL').fetchone()[0]
+    if earliest_new is None:
+        return 0
+    gap = gap_minutes * 60 * 1000
+    joinable = cursor.execute('SELECT MIN(start_ms) FROM sessions WHERE end_ms >= ?', (earliest_new - gap,)).fetchone()[0]
+    resume_from = min(joinable, earliest_new) if joinable is not None else earliest_new
+    cursor.execute('DELETE FROM sessions WHERE start_ms >= ?', (resume_from,))
+    next_id = (cursor.execute('SELECT MAX(id) FROM sessions').fetchone()[0] or 0) + 1
+
+    sessions = []
+    session = None
+    previous_time = None
+    last_key = (resume_from, -1)
+    while True:
+        # Paged along idx_time by (time_ms, message_id) so the updates below don't disturb the scan
+        rows = cursor.execute('''
+            SELECT time_ms, message_id, token_count FROM messages
+            WHERE (time_ms, message_id) > (?, ?)
+            ORDER BY time_ms, message_id LIMIT ?
+        ''', (last_key[0], last_key[1], batch_size)).fetchall()
+        if not rows:
+            break
+        updates = []
+        for sent, message_id, token_count in rows:
+            token_count = token_count or 0
+            # Messages sent at the same moment always share a session, so sessions never overlap
+            if session is None or (sent != previous_time and (sent - previous_time > gap or session[4] + token_count > max_tokens)):
+                session = [next_id, sent, sent, 0, 0]
+                sessions.append(session)
+                next_id += 1
+            session[2] = sent
+            session[3] += 1
+            session[4] += token_count
+            previous_time = sent
+            updates.append((session[0], message_id))
+        cursor.executemany('UPDATE messages SET session_id = ? WHERE message_id = ?', updates)
+        last_key = rows[-1][:2]
+    cursor.executemany('INSERT INTO sessions (id, start_ms, end_ms, message_count, token_count) VALUES (?, ?, ?, ?, ?)', sessions)
+    return len(sessions)
+
+def sessionize(db_path):
+    conn = db.write_connection(db_path)
+    start = time.perf_counter()
+    count = build_sessions(conn.cursor())
+    conn.commit()
+    conn.close()
+    print(f"Built {count} conversation sessions in {time.perf_counter() - start:.1f}s")
+
+# Integer time keys replace the text timestamps in every query. Older databases get the column
+# filled in from the snowflakes in one pass, and lose the text timestamp index nothing uses any more.
+def add_time_column(cursor):
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(messages)')]
+    if 'time_ms' not in columns:
+        cursor.execute('ALTER TABLE messages ADD COLUMN time_ms INTEGER')
+    cursor.execute(f"UPDATE messages SET time_ms = {db.TIME_MS_SQL.format(message_id='message_id', timestamp='timestamp')} WHERE time_ms IS NULL")
+    if cursor.rowcount > 0:
+        print(f"Worked out time keys for {cursor.rowcount} messages")
+    cursor.execute('DROP INDEX IF EXISTS idx_timestamp')
+    create_time_trigger(cursor)
+
+def add_session_column(cursor):
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(messages)')]
+    if 'session_id' not in columns:
+        # Filled in by build_sessions after the import
+        cursor.execute('ALTER TABLE messages ADD COLUMN session_id INTEGER')
+    session_columns = [row[1] for row in cursor.execute('PRAGMA table_info(sessions)')]
+    if 'start_timestamp' in session_columns:
+        # Sessions from before the integer time keys, they're rebuilt after the import
+        cursor.execute('DROP TABLE sessions')
+        cursor.execute('DROP INDEX IF EXISTS idx_session_id')
+        cursor.execute('UPDATE messages SET session_id = NULL')
+    create_sessions_table(cursor)
+
+def build_indexes(db_path):
+    conn = sqlite3.connect(db_path)
+    for pragma in BULK_LOAD_PRAGMAS:
+        conn.execute(pragma)
+    start = time.perf_counter()
+    create_indexes(conn.cursor())
+    conn.commit()
+    # Back from the bulk load journal mode so readers can share the database with later ingests
+    db.enable_wal(conn)
+    conn.close()
+    print(f"Built indexes in {time.perf_counter() - start:.1f}s")
+
+# Full text index over messages.contents, kept in sync with triggers
+def create_fts_index(cursor):
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            contents,
+            content='messages',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, contents) VALUES (new.id, new.contents);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, contents) VALUES ('delete', old.id, old.contents);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF contents ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, contents) VALUES ('delete', old.id, old.contents);
+            INSERT INTO messages_fts (rowid, contents) VALUES (new.id, new.contents);
+        END
+    ''')
+
 # Function to convert mentions
 def convert_mentions(contents):
-    for user_id, name in id_to_name.items():
-        contents = contents.replace(f'<@{user_id}>', f'@{name}')
-    return contents
+    return rewrite_mentions(contents)
 
-# Function to insert data into the database
-def insert_data(db_path, data_path):
-    with open(data_path, 'r') as f:
-        data = json.load(f)
-    
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    # Determine the name from the filename
-    name = os.path.splitext(os.path.basename(data_path))[0]
-    
+WHITESPACE = re.compile(r'\s*')
+
+# Yield the elements of a top level JSON array one at a time, only holding about one
+# read chunk plus one element in memory instead of the whole file like json.load
+def iter_json_array(f, chunk_size=1 << 16):
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    eof = False
+    expecting = '['
+
+    while True:
+        pos = WHITESPACE.match(buffer, pos).end()
+        if pos == len(buffer):
+            if eof:
+                raise ValueError(f"Unexpected end of JSON array in {getattr(f, 'name', 'input')}")
+            buffer = f.read(chunk_size)
+            eof = not buffer
+            pos = 0
+            continue
+
+        char = buffer[pos]
+        if expecting == '[':
+            if char != '[':
+                raise ValueError(f"Expected a JSON array, found {char!r}")
+            pos += 1
+            expecting = 'value or ]'
+        elif expecting == ',':
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError(f"Expected ',' or ']' in JSON array, found {char!r}")
+            pos += 1
+            expecting = 'value'
+        elif char == ']' and expecting == 'value or ]':
+            return
+        else:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+                # A value at the end of the buffer might be cut off, like 1.5 read as 1, so
+                # only trust it once the delimiter after it has been read
+                complete = eof or (end < len(buffer) and buffer[end] in ' \t\r\n,]')
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                complete = False
+            if not complete:
+                # Keep the unparsed tail and read more, growing the read so large elements stay linear
+                more = f.read(max(chunk_size, len(buffer) - pos))
+                eof = not more
+                buffer = buffer[pos:] + more
+                pos = 0
+                continue
+            yield value
+            pos = end
+            expecting = ','
+
+# Messages at or below after were ingested before, they are skipped before any per-row work
+def message_rows(data, name, after=None):
     # The global channel ID (fixed for all messages)
     channel_id = 383761744830529537
-    
-    for message in tqdm(data, desc="Inserting messages"):
+
+    for message in data:
         message_id = message['ID']
+        if after is not None and message_id <= after:
+            continue
         timestamp = message['Timestamp']
         contents = convert_mentions(message['Contents'])
         attachments = message['Attachments']
         link = f'https://discord.com/channels/@me/{channel_id}/{message_id}'
-        
+        token_count = count_message_tokens((message_id, name, timestamp, contents))
+        yield (message_id, name, timestamp, contents, attachments, link, token_count, db.message_time_ms(message_id, timestamp))
+
+def get_high_water_mark(cursor, source):
+    row = cursor.execute('SELECT last_message_id FROM ingest_state WHERE source = ?', (source,)).fetchone()
+    return row[0] if row else None
+
+# Function to insert data into the database
+def insert_data(db_path, data_path, batch_size=10000, bulk_load=False):
+    if bulk_load:
+        conn = sqlite3.connect(db_path)
+        for pragma in BULK_LOAD_PRAGMAS:
+            conn.execute(pragma)
+    else:
+        # Readers, like a running bot, keep working while the new messages go in
+        conn = db.write_connection(db_path)
+    cursor = conn.cursor()
+    
+    # Determine the name from the filename
+    name = os.path.splitext(os.path.basename(data_path))[0]
+
+    # Discord IDs are snowflakes and only ever grow, so anything at or below the mark was ingested before
+    high_water_mark = get_high_water_mark(cursor, name)
+    newest_message_id = high_water_mark
+    if high_water_mark is not None:
+        print(f"Skipping messages from {name} up to ID {high_water_mark}, already ingested")
+
+    start = time.perf_counter()
+    parsed = 0
+    inserted = 0
+    # Messages are parsed one at a time and written in batches, so memory use doesn't grow with the export
+    with open(data_path, 'r', encoding='utf-8') as f:
+        rows = message_rows(iter_json_array(f), name, after=high_water_mark)
+        with tqdm(desc="Inserting messages", unit=" messages") as progress:
+            while True:
+                batch = list(itertools.islice(rows, batch_size))
+                if not batch:
+                    break
+                parsed += len(batch)
+                progress.update(len(batch))
+                cursor.executemany(INSERT_MESSAGE_SQL, batch)
+                inserted += cursor.rowcount
+                batch_newest = max(row[0] for row in batch)
+                newest_message_id = batch_newest if newest_message_id is None else max(newest_message_id, batch_newest)
+
+    if newest_message_id is not None:
         cursor.execute('''
-            INSERT INTO messages (message_id, name, timestamp, contents, attachments, link)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (message_id, name, timestamp, contents, attachments, link))
+            INSERT OR REPLACE INTO ingest_state (source, last_message_id, updated_at)
+            VALUES (?, ?, datetime('now'))
+        ''', (name, newest_message_id))
     
     conn.commit()
-    
-    # Print database stats
+    conn.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"Inserted {inserted} of {parsed} new messages from {name} in {elapsed:.1f}s ({parsed / max(elapsed, 1e-9):.0f} rows/sec)")
+    return inserted
+
+# Print database stats
+def print_stats(db_path):
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
     cursor.execute('SELECT COUNT(*) FROM messages')
     row_count = cursor.fetchone()[0]
     
@@ -84,6 +427,8 @@ def main():
     parser = argparse.ArgumentParser(description="Ingest message data into SQLite database")
     parser.add_argument('data_path', type=str, help='Relative path to the message data JSON file')
     parser.add_argument('data_path_two', type=str, help='Relative path to the message data JSON file for your friend')
+    parser.add_argument('--batch-size', type=int, default=10000, help='Rows per executemany batch')
+    parser.add_argument('--rebuild', action='store_true', help='Delete the database and import everything from scratch')
     
     args = parser.parse_args()
     
@@ -93,14 +438,28 @@ def main():
     
     db_path = 'database/messages.db'
     
-    # Remove the existing database if it exists
-    if os.path.exists(db_path):
-        os.remove(db_path)
+    # Remove the existing database if asked to, with its write-ahead log so it can't be replayed into the new one
+    if args.rebuild:
+        for path in (db_path, db_path + '-wal', db_path + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
     
-    create_database(db_path)
-    insert_data(db_path, args.data_path)
-    insert_data(db_path, args.data_path_two)
+    start = time.perf_counter()
+    if os.path.exists(db_path):
+        # Only messages newer than what is already stored get inserted, and the triggers
+        # keep the full text index up to date for them
+        migrate_database(db_path)
+        total = insert_data(db_path, args.data_path, args.batch_size)
+        total += insert_data(db_path, args.data_path_two, args.batch_size)
+    else:
+        create_database(db_path, defer_indexes=True)
+        total = insert_data(db_path, args.data_path, args.batch_size, bulk_load=True)
+        total += insert_data(db_path, args.data_path_two, args.batch_size, bulk_load=True)
+        build_indexes(db_path)
+    sessionize(db_path)
+    elapsed = time.perf_counter() - start
+    print(f"Ingested {total} new messages in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} rows/sec including index builds)")
+    print_stats(db_path)
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,134 @@
+import contextvars
+import json
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Per-stage wall time, rows in and out and OpenAI token usage for the search and summarize
+# pipelines. Nothing is recorded unless a run is active, the CLIs start one with --profile
+# and write it out as JSON lines, one per stage and a total at the end.
+
+# USD per million tokens, (prompt, completion)
+PRICES = {
+    'gpt-4o': (2.50, 10.00),
+    'text-embedding-3-large': (0.13, 0.0),
+}
+
+current_run = contextvars.ContextVar('current_run', default=None)
+current_stage = contextvars.ContextVar('current_stage', default=None)
+
+class Stage:
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        # Seconds from the start of the run, stages running side by side overlap
+        self.started = None
+        self.seconds = 0.0
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost_usd = 0.0
+
+    def as_dict(self):
+        return {
+            'stage': self.name,
+            'started': None if self.started is None else round(self.started, 4),
+            'seconds': round(self.seconds, 4),
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'openai_calls': self.calls,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'cost_usd': round(self.cost_usd, 6),
+        }
+
+class Run:
+    def __init__(self, pipeline, details):
+        self.id = uuid.uuid4().hex[:12]
+        self.pipeline = pipeline
+        self.details = details
+        self.stages = []
+        self.start = time.perf_counter()
+        self.seconds = 0.0
+        # Usage comes in from the summarize worker threads
+        self.lock = threading.Lock()
+
+    def records(self):
+        base = {'run': self.id, 'pipeline': self.pipeline}
+        lines = [{**base, **stage.as_dict()} for stage in self.stages]
+        total = {
+            **base,
+            'stage': 'total',
+            'seconds': round(self.seconds, 4),
+            'openai_calls': sum(stage.calls for stage in self.stages),
+            'prompt_tokens': sum(stage.prompt_tokens for stage in self.stages),
+            'completion_tokens': sum(stage.completion_tokens for stage in self.stages),
+            'cost_usd': round(sum(stage.cost_usd for stage in self.stages), 6),
+            **self.details,
+        }
+        return lines + [total]
+
+# Time a whole pipeline. output is a JSON lines file to append to, '-' for stdout, or None to only collect.
+@contextmanager
+def run(pipeline, output=None, **details):
+    profile = Run(pipeline, details)
+    token = current_run.set(profile)
+    try:
+        yield profile
+    finally:
+        profile.seconds = time.perf_counter() - profile.start
+        current_run.reset(token)
+        if output:
+            write(profile, output)
+
+# Time one stage of the active run. Set rows_out on the yielded stage before leaving the block.
+@contextmanager
+def stage(name, rows_in=None):
+    record = Stage(name, rows_in)
+    profile = current_run.get()
+    token = current_stage.set(record)
+    start = time.perf_counter()
+    if profile is not None:
+        record.started = start - profile.start
+    try:
+        yield record
+    finally:
+        record.seconds = time.perf_counter() - start
+        current_stage.reset(token)
+        if profile is not None:
+            with profile.lock:
+                profile.stages.append(record)
+
+# Count the tokens an OpenAI response used against the current stage
+def record_usage(model, response):
+    record = current_stage.get()
+    profile = current_run.get()
+    usage = getattr(response, 'usage', None)
+    if record is None or profile is None or usage is None:
+        return
+    prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+    completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+    prompt_price, completion_price = PRICES.get(model, (0.0, 0.0))
+    with profile.lock:
+        record.calls += 1
+        record.prompt_tokens += prompt_tokens
+        record.completion_tokens += completion_tokens
+        record.cost_usd += (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+
+# Executor threads don't inherit the caller's context, wrap work handed to them with this
+def propagate(func):
+    context = contextvars.copy_context()
+    def wrapper(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+    return wrapper
+
+def write(profile, output):
+    lines = "".join(json.dumps(record) + "\n" for record in profile.records())
+    if output == '-':
+        sys.stdout.write(lines)
+    else:
+        with open(output, 'a') as f:
+            f.write(lines)
@@ -0,0 +1,169 @@
+import asyncio
+import threading
+from src.utils import get_openai_key, is_retryable_openai_error, retry_delay
+from src.tokens import count_tokens, truncate_to_tokens
+from src import metrics
+
+# Every OpenAI request from the pipelines goes through one AsyncOpenAI client running on a
+# background event loop. The client keeps its HTTP connections open between requests, a semaphore
+# caps how many are in flight at once, and retryable failures back off without holding a slot.
+# Synchronous code calls chat/embed/stream_chat, which block until the loop has the answer.
+# The caller's context is carried onto the loop, so metrics.record_usage lands on its stage.
+
+# Requests in flight at once across the whole process
+MAX_CONCURRENT_REQUESTS = 8
+MAX_ATTEMPTS = 6
+
+# The embeddings endpoint takes up to 2048 inputs and 300k tokens per request, and 8191 tokens
+# per input. Batches are kept smaller than that so a big embedding job runs as parallel requests.
+EMBEDDING_BATCH_INPUTS = 512
+EMBEDDING_BATCH_TOKENS = 250000
+EMBEDDING_INPUT_TOKENS = 8191
+
+# The loop, its semaphore and the client, each made once. The first calls can come from several
+# threads at the same time (summarize workers, parallel search stages), so they're made under a
+# lock, otherwise each thread could start a loop of its own and share the client's connections
+# and the semaphore across loops.
+lock = threading.Lock()
+shared = {}
+
+def get_loop():
+    with lock:
+        if 'loop' not in shared:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='openai-async', daemon=True).start()
+            shared['loop'] = loop
+        return shared['loop']
+
+# Only used by coroutines running on the loop, which binds the semaphore to it
+def get_semaphore():
+    with lock:
+        if 'semaphore' not in shared:
+            shared['semaphore'] = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        return shared['semaphore']
+
+# Retries are done here with the shared semaphore in mind, so the client's own are turned off.
+# Its connections are opened by the requests, which all run on the shared loop.
+def get_async_client():
+    with lock:
+        if 'client' not in shared:
+            openai_key = get_openai_key()
+            if not openai_key:
+                raise RuntimeError("The OPENAI_KEY environment variable is not set and OPENAI_KEY.txt is missing.")
+            import openai
+            shared['client'] = openai.AsyncOpenAI(api_key=openai_key, max_retries=0)
+        return shared['client']
+
+# Start over with a new loop, semaphore and client, for tests
+def reset():
+    with lock:
+        loop = shared.pop('loop', None)
+        shared.clear()
+    if loop is not None:
+        loop.call_soon_threadsafe(loop.stop)
+
+# Start a coroutine on the shared loop, returning a concurrent.futures.Future for its result
+def submit(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, get_loop())
+
+# Run a coroutine on the shared loop and wait for its result
+def run(coroutine):
+    return submit(coroutine).result()
+
+# Await request() under the concurrency limit, backing off exponentially on rate limits and
+# server errors. The wait between attempts happens outside the semaphore.
+async def with_backoff(request, max_attempts=MAX_ATTEMPTS, base_delay=1.0, max_delay=60.0):
+    for attempt in range(max_attempts):
+        async with get_semaphore():
+            try:
+                return await request()
+            except Exception as e:
+                if attempt == max_attempts - 1 or not is_retryable_openai_error(e):
+                    raise
+                error = type(e).__name__
+                delay = retry_delay(e, attempt, base_delay, max_delay)
+        print(f"OpenAI request failed with {error}, retrying in {delay:.1f}s ({attempt + 1}/{max_attempts})")
+        await asyncio.sleep(delay)
+
+async def achat(model, messages, client=None, **kwargs):
+    client = client or get_async_client()
+    response = await with_backoff(lambda: client.chat.completions.create(model=model, messages=messages, **kwargs))
+    metrics.record_usage(model, response)
+    return response
+
+def chat(model, messages, client=None, **kwargs):
+    return run(achat(model, messages, client, **kwargs))
+
+# Split texts into consecutive (start, end) batches that stay inside the per-request limits
+def embedding_batches(token_counts, max_inputs=EMBEDDING_BATCH_INPUTS, max_tokens=EMBEDDING_BATCH_TOKENS):
+    batches = []
+    start = 0
+    tokens = 0
+    for index, count in enumerate(token_counts):
+        if index > start and (index - start >= max_inputs or tokens + count > max_tokens):
+            batches.append((start, index))
+            start = index
+            tokens = 0
+        tokens += count
+    if start < len(token_counts):
+        batches.append((start, len(token_counts)))
+    return batches
+
+# Truncate texts that are over the per-input limit and split them into request batches. Counting
+# tokens is CPU work, so it's done on the caller's thread and the loop is left to the requests.
+def prepare_embedding(texts, max_inputs=EMBEDDING_BATCH_INPUTS, max_tokens=EMBEDDING_BATCH_TOKENS):
+    texts = list(texts)
+    token_counts = [count_tokens(text) for text in texts]
+    for i, count in enumerate(token_counts):
+        if count > EMBEDDING_INPUT_TOKENS:
+            print(f"Text {i} is {count} tokens, only its first {EMBEDDING_INPUT_TOKENS} are embedded")
+            texts[i] = truncate_to_tokens(texts[i], EMBEDDING_INPUT_TOKENS)
+            token_counts[i] = EMBEDDING_INPUT_TOKENS
+    return [texts[start:end] for start, end in embedding_batches(token_counts, max_inputs, max_tokens)]
+
+# Embed batches from prepare_embedding in parallel. Vectors come back in the order of the texts.
+async def aembed(batches, model, client=None):
+    client = client or get_async_client()
+
+    async def embed_batch(batch):
+        response = await with_backoff(lambda: client.embeddings.create(input=batch, model=model))
+        metrics.record_usage(model, response)
+        return [item.embedding for item in response.data]
+
+    if len(batches) > 1:
+        print(f"Embedding {sum(len(batch) for batch in batches)} texts in {len(batches)} parallel requests")
+    results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+    return [vector for vectors in results for vector in vectors]
+
+# Start embedding any number of texts, returning a concurrent.futures.Future for their vectors
+def submit_embed(texts, model, client=None, **kwargs):
+    return submit(aembed(prepare_embedding(texts, **kwargs), model, client))
+
+def embed(texts, model, client=None, **kwargs):
+    return submit_embed(texts, model, client, **kwargs).result()
+
+# A streamed chat completion as a plain generator of chunks. Each chunk is awaited on the loop
+# as it's asked for, and the response is closed if the caller stops early.
+def stream_chat(model, messages, client=None, **kwargs):
+    client = client or get_async_client()
+    stream = run(with_backoff(lambda: client.chat.completions.create(model=model, messages=messages, stream=True, **kwargs)))
+    chunks = stream.__aiter__()
+    done = object()
+
+    async def next_chunk():
+        try:
+            return await chunks.__anext__()
+        except StopAsyncIteration:
+            return done
+
+    try:
+        while True:
+            chunk = run(next_chunk())
+            if chunk is done:
+                return
+            # The last chunk carries the usage when stream_options asks for it
+            if getattr(chunk, 'usage', None) is not None:
+                metrics.record_usage(model, chunk)
+            yield chunk
+    finally:
+        run(stream.close())
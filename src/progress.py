@@ -0,0 +1,25 @@
+from collections import namedtuple
+
+# What the streaming pipelines yield while they work:
+#   status  a progress line, each one replaces the last
+#   output  the next piece of the answer, pieces are appended in order
+#   result  the whole answer, always the last event
+# A pipeline's generator should be consumed from one thread, its metrics stages span the yields.
+Event = namedtuple('Event', 'kind text')
+
+def status(text):
+    return Event('status', text)
+
+def output(text):
+    return Event('output', text)
+
+def result(text):
+    return Event('result', text)
+
+# For callers that only want the finished answer
+def final_result(events):
+    answer = None
+    for event in events:
+        if event.kind == 'result':
+            answer = event.text
+    return answer
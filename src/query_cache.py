@@ -0,0 +1,64 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+# In-process caches for process_query. The bot is long running, so repeated /search commands hit these.
+#
+# Layered, so a changed query can still reuse the early stages:
+#   keywords          normalized search term -> get_search_keywords result, doesn't depend on the database
+#   query_embeddings  normalized search term -> embedding of the search term
+#   relevant_ids      (search term, candidate ids, database version) -> select_relevant_messages result
+#                     (the version is db.database_version)
+#   answers           (search term, options, database version) -> the final summary
+
+MISSING = object()
+
+class TTLCache:
+    def __init__(self, maxsize, ttl_seconds):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        # Pipelines run on the bot's worker threads
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key, MISSING)
+            if entry is not MISSING and entry[0] < time.monotonic():
+                del self.entries[key]
+                entry = MISSING
+            if entry is MISSING:
+                self.misses += 1
+                return MISSING
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+keywords = TTLCache(maxsize=512, ttl_seconds=7 * 24 * 3600)
+query_embeddings = TTLCache(maxsize=512, ttl_seconds=7 * 24 * 3600)
+relevant_ids = TTLCache(maxsize=256, ttl_seconds=24 * 3600)
+answers = TTLCache(maxsize=128, ttl_seconds=24 * 3600)
+
+def normalize_search_term(search_term):
+    return " ".join(search_term.lower().split()).strip("?!. ")
+
+def candidates_key(messages):
+    digest = hashlib.sha1()
+    for message_id in sorted(msg[0] for msg in messages):
+        digest.update(str(message_id).encode())
+        digest.update(b',')
+    return digest.hexdigest()
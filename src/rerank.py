@@ -0,0 +1,163 @@
+import math
+import re
+from collections import Counter
+from datetime import datetime
+import numpy as np
+from src.similarity import top_k_indices
+from src.tokens import count_tokens
+from src.utils import rewrite_mentions
+from src import db
+
+# Local re-ranking between the keyword/embedding search and gpt-4o's relevance selection. Keyword
+# (BM25) and embedding rankings are fused with reciprocal rank fusion, then a shortlist is picked
+# from the top that skips near duplicates, doesn't let one conversation take every slot and fits
+# a token budget. Only that shortlist goes into the selection prompt.
+
+# Reciprocal rank fusion constant, 60 is the value from the original paper
+RRF_K = 60
+# Only the top of each ranking is fused, the ranks below add next to nothing to the sums
+RRF_DEPTH = 300
+# Most messages and tokens sent to gpt-4o for relevance selection
+SHORTLIST_SIZE = 100
+SHORTLIST_TOKEN_BUDGET = 6000
+# Hits this close together are one conversation, when the database has no sessions to go by
+CONVERSATION_GAP_MINUTES = 60
+MAX_PER_CONVERSATION = 3
+# Word set overlap above which two messages count as the same
+DUPLICATE_JACCARD = 0.8
+
+WORD = re.compile(r'\w+')
+
+def words(text):
+    return WORD.findall(text.lower())
+
+# Okapi BM25 of each text against the keywords, with document frequencies from the texts themselves
+def bm25_scores(keywords, texts, k1=1.2, b=0.75):
+    query_terms = set(term for keyword in keywords for term in words(keyword))
+    documents = [Counter(words(text)) for text in texts]
+    if not documents or not query_terms:
+        return [0.0] * len(documents)
+    average_length = sum(sum(document.values()) for document in documents) / len(documents) or 1
+    document_frequency = Counter(term for document in documents for term in query_terms if term in document)
+    idf = {term: math.log(1 + (len(documents) - count + 0.5) / (count + 0.5)) for term, count in document_frequency.items()}
+    scores = []
+    for document in documents:
+        length = sum(document.values())
+        score = 0.0
+        for term, weight in idf.items():
+            frequency = document.get(term, 0)
+            if frequency:
+                score += weight * frequency * (k1 + 1) / (frequency + k1 * (1 - b + b * length / average_length))
+        scores.append(score)
+    return scores
+
+# Indices of the depth best scores, best first, ties keep their original order
+def ranking(scores, depth=RRF_DEPTH):
+    return top_k_indices(np.asarray(scores, dtype=np.float64), depth).tolist()
+
+# Sum of 1 / (k + rank) over the rankings, returned as indices best first
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    fused = Counter()
+    for order in rankings:
+        for rank, index in enumerate(order):
+            fused[index] += 1.0 / (k + rank + 1)
+    return sorted(fused, key=lambda index: -fused[index])
+
+# Label each message with a conversation number, a new one starts after a quiet gap
+def conversation_ids(messages, gap_minutes=CONVERSATION_GAP_MINUTES):
+    gap = gap_minutes * 60 * 1000
+    times = [message_time(msg) for msg in messages]
+    labels = [0] * len(messages)
+    conversation = 0
+    previous = None
+    for index in sorted(range(len(messages)), key=lambda i: times[i]):
+        if previous is not None and times[index] - previous > gap:
+            conversation += 1
+        labels[index] = conversation
+        previous = times[index]
+    return labels
+
+# Search rows carry the integer time key, plain tuples only have the timestamp
+def message_time(msg):
+    time_ms = getattr(msg, 'time_ms', None)
+    if time_ms is not None:
+        return time_ms
+    return db.to_time_ms(datetime.fromisoformat(msg[2]))
+
+def is_near_duplicate(word_set, kept_word_sets, threshold=DUPLICATE_JACCARD):
+    for other in kept_word_sets:
+        # The overlap can't reach the threshold when one set is that much bigger than the other
+        if min(len(word_set), len(other)) < threshold * max(len(word_set), len(other)):
+            continue
+        union = len(word_set | other)
+        if union and len(word_set & other) / union >= threshold:
+            return True
+    return False
+
+# One message per line, numbered from 1 so the model can answer with short numbers instead of IDs
+def shortlist_line(number, msg):
+    text = " ".join(rewrite_mentions(msg[3]).split())
+    return f"{number} {msg[1]}: {text}"
+
+def format_shortlist(messages):
+    return "\n".join(shortlist_line(number, msg) for number, msg in enumerate(messages, start=1))
+
+# Pick the messages worth sending to gpt-4o, best first. Rankings come from BM25 on the keywords
+# and from the embedding similarities when they're given, otherwise the messages' own order is used.
+# sessions are the messages' session IDs from ingest, each one is a conversation.
+def shortlist(messages, keywords=(), similarities=None, sessions=None, size=SHORTLIST_SIZE, token_budget=SHORTLIST_TOKEN_BUDGET,
+              max_per_conversation=MAX_PER_CONVERSATION):
+    if not messages:
+        return []
+    rankings = []
+    if keywords:
+        rankings.append(ranking(bm25_scores(keywords, [msg[3] for msg in messages])))
+    if similarities is not None:
+        rankings.append(ranking(similarities))
+    if not rankings:
+        rankings.append(list(range(min(len(messages), RRF_DEPTH))))
+    order = reciprocal_rank_fusion(rankings)
+    if sessions is not None and None not in sessions:
+        conversations = sessions
+    else:
+        conversations = conversation_ids(messages)
+
+    picked = []
+    deferred = []
+    kept_word_sets = []
+    per_conversation = Counter()
+    used_tokens = 0
+
+    def line_tokens(index):
+        # Line numbers are at most a few digits, counting with the final number is close enough
+        return count_tokens(shortlist_line(size, messages[index])) + 1
+
+    # Add a message unless it repeats one already picked or doesn't fit in what's left of the budget
+    def admit(index):
+        nonlocal used_tokens
+        word_set = set(words(messages[index][3]))
+        if is_near_duplicate(word_set, kept_word_sets):
+            return False
+        tokens = line_tokens(index)
+        if used_tokens + tokens > token_budget:
+            return False
+        picked.append(index)
+        kept_word_sets.append(word_set)
+        used_tokens += tokens
+        return True
+
+    # Walk the fused ranking until the shortlist is full, or there are enough hits set aside to fill
+    # it. Hits over their conversation's cap are set aside before the duplicate check and only
+    # checked if they're needed, so when the hits are in a few conversations the walk still stops.
+    for index in order:
+        if len(picked) >= size or len(deferred) >= size:
+            break
+        if per_conversation[conversations[index]] >= max_per_conversation:
+            deferred.append(index)
+        elif admit(index):
+            per_conversation[conversations[index]] += 1
+    for index in deferred:
+        if len(picked) >= size:
+            break
+        admit(index)
+    return [messages[index] for index in picked]
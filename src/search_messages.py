@@ -2,28 +2,41 @@ import argparse
 from time import sleep
 import os
 import traceback
-import sqlite3
 import json
 import math
-from datetime import datetime, timedelta
-from src.utils import initialize_openai, query_messages_by_timestamp_range, trim_messages
-from src.utils import load_config
-from src.utils import estimate_tokens
+import re
+from src.utils import get_config, merge_intervals
+from src.utils import has_fts_index, format_message
+from src.tokens import fit_to_budget
+from src import query_cache
+from src import metrics
+from src import db
+from src import progress
+from src import openai_async
+from src import stage_graph
 
 
-client = initialize_openai()
-conf = load_config()
-names = sorted(list(load_config()['id_to_name'].values()))
-# print(f"Names: {names}")
-
 DATABASE_PATH = 'database/messages.db'
+# gpt-4o's 128k context, less the 2000 token answer and the instructions around the conversations
+CONVERSATION_TOKEN_BUDGET = 124000
+# Nearest messages the vector index returns for a semantic only search, before re-ranking
+CANDIDATE_COUNT = 200
+# Minutes of conversation fetched either side of each relevant message, when the database has no sessions yet
+CONTEXT_MINUTES = 60
+# Keywords per FTS query when the matches are streamed into embedding requests
+SEARCH_GROUP_SIZE = 10
+
+# The two friends, by the names config.json gives them
+def friend_names():
+    return sorted(get_config()['id_to_name'].values())
 
 def get_search_keywords(query):
+    names = friend_names()
     prompt = f"""Given the query: \'{query}\', return ONLY A JSON blob of keywords to search for specific chat history between two friends named {names[0]} and {names[1]}. This will be fed into a script to query from all the available Discord history for their DM, so pick messages based on how likely their nearby messages are have relevant content.  Sort the ~50 keywords by most likely to have correct hits that are not false positives.
     Focus on phrases and expressions that people might use in the context of the query. Exclude common words, and the names of the two friends. ONLY RESPOND WITH JSON in the form {{'keywords': ['keyword1', 'keyword2', 'etc']}}
     """
     print("Starting OpenAI call to get search keywords...")
-    response = client.chat.completions.create(
+    response = openai_async.chat(
         model="gpt-4o",
         messages=[
             {"role": "system", "content": "You are a helpful assistant."},
@@ -40,80 +53,129 @@ def get_search_keywords(query):
     return keywords
 
 
-def search_index(keywords):
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+def build_fts_query(keywords):
+    # Each keyword becomes a phrase with a prefix match on its last word, roughly what LIKE '%keyword%' finds
+    phrases = []
+    for keyword in keywords:
+        tokens = re.findall(r'\w+', keyword)
+        if tokens:
+            phrases.append(f'"{" ".join(tokens)}" *')
+    return " OR ".join(phrases)
 
-    escaped_keywords = [keyword.replace("'", "''") for keyword in keywords]
-    keyword_query = " OR ".join([f"contents LIKE '%{keyword}%'" for keyword in escaped_keywords])
+def search_fts(cursor, keywords):
+    fts_query = build_fts_query(keywords)
+    if not fts_query:
+        return []
+    query = '''
+    SELECT m.message_id, m.name, m.timestamp, m.contents, m.attachments, m.link, m.time_ms
+    FROM messages_fts
+    JOIN messages m ON m.id = messages_fts.rowid
+    WHERE messages_fts MATCH ?
+    ORDER BY messages_fts.rank
+    '''
+    return [db.Message._make(row) for row in cursor.execute(query, (fts_query,))]
 
+def search_like(cursor, keywords):
+    keyword_query = " OR ".join(["contents LIKE ?" for _ in keywords])
     query = f'''
-    SELECT message_id, name, timestamp, contents, attachments, link
+    SELECT message_id, name, timestamp, contents, attachments, link, time_ms
     FROM messages
     WHERE {keyword_query}
     '''
+    return [db.Message._make(row) for row in cursor.execute(query, [f"%{keyword}%" for keyword in keywords])]
+
+def search_index(keywords):
+    conn = db.read_connection(DATABASE_PATH)
+    cursor = conn.cursor()
 
     try:
-        cursor.execute(query)
-        results = cursor.fetchall()
+        # Ranked full text search when ingest built the index, otherwise scan with LIKE
+        if has_fts_index(conn) and build_fts_query(keywords):
+            results = search_fts(cursor, keywords)
+        else:
+            results = search_like(cursor, keywords)
     except Exception as e:
         traceback.print_exc()
-        print(f"Failed on query {query}")
+        print(f"Failed on search for keywords {keywords}")
         raise e
 
-    conn.close()
     return results
 
-def get_message_embeddings(messages):
-    max_tokens = 900000
-    token_count = 0
-    truncated_messages = []
+def get_messages_by_ids(message_ids):
+    return db.messages_by_ids(db.read_connection(DATABASE_PATH), message_ids)
 
-    try:
-        # Extract the text from the messages
-        for msg in messages:
-            text = msg[3]
-            words = text.split()
-            word_count = len(words)
-            if token_count + word_count > max_tokens:
-                break
-            truncated_messages.append(text)
-            token_count += word_count
-
-        total_characters = sum(len(text) for text in truncated_messages)
-        total_words = sum(len(text.split()) for text in truncated_messages)
-        print(f"Submitting {len(truncated_messages)} messages to `text-embedding-3-large`, with a total length of {total_characters} characters and {total_words} words.")
-
-        response = client.embeddings.create(input=truncated_messages, model="text-embedding-3-large")
-        embeddings = [item.embedding for item in response.data]
-        
-    except Exception as e:
-        traceback.print_exc()
-        print(f"failed on calculating embeddings for {len(messages)} messages")
-        raise e
-
-    return embeddings
+# search_index in pieces, a FTS query per group of keywords, yielding each group's new matches so
+# they can be embedded while the rest are still being searched
+def search_index_batches(keywords, group_size=SEARCH_GROUP_SIZE):
+    conn = db.read_connection(DATABASE_PATH)
+    cursor = conn.cursor()
+    if has_fts_index(conn) and build_fts_query(keywords):
+        search = search_fts
+        groups = [keywords[i:i + group_size] for i in range(0, len(keywords), group_size)]
+    else:
+        # The LIKE scan reads the whole table however many keywords it has, so it's done once
+        search = search_like
+        groups = [keywords]
+    seen = set()
+    for group in groups:
+        batch = [msg for msg in search(cursor, group) if msg.message_id not in seen]
+        seen.update(msg.message_id for msg in batch)
+        if batch:
+            yield batch
+
+# Look up a batch of search results' stored embeddings and send the missing ones straight off,
+# without waiting for the answer, so the next batch can be searched for in the meantime
+def request_embeddings(batch):
+    from src import embedding_store
+    conn = embedding_store.thread_connection()
+    embeddings = embedding_store.load_embeddings(conn, [msg[0] for msg in batch])
+    missing = [msg for msg in batch if msg[0] not in embeddings]
+    request = None
+    if missing:
+        request = openai_async.submit_embed([msg[3] for msg in missing], embedding_store.EMBEDDING_MODEL)
+    return batch, embeddings, missing, request
+
+# Wait for the requested embeddings and store them. Returns (message, embedding) pairs in the
+# order the batches were requested in.
+def collect_embeddings(requests):
+    from src import embedding_store
+    conn = embedding_store.thread_connection()
+    stored_count = sum(len(embeddings) for _, embeddings, _, _ in requests)
+    missing_count = sum(len(missing) for _, _, missing, _ in requests)
+    print(f"Found {stored_count} stored embeddings, {missing_count} messages need embedding")
+    pairs = []
+    for batch, embeddings, missing, request in requests:
+        if request is not None:
+            try:
+                new_embeddings = list(zip([msg[0] for msg in missing], request.result()))
+            except Exception as e:
+                traceback.print_exc()
+                print(f"failed on calculating embeddings for {len(missing)} messages")
+                raise e
+            embedding_store.store_embeddings(conn, new_embeddings)
+            embeddings.update(new_embeddings)
+        pairs.extend((msg, embeddings[msg[0]]) for msg in batch if msg[0] in embeddings)
+    return pairs
 
 def get_query_embedding(query):
-    response = client.embeddings.create(input=[query], model="text-embedding-3-large")
-    embedding = response.data[0].embedding
+    from src import embedding_store
+    key = query_cache.normalize_search_term(query)
+    embedding = query_cache.query_embeddings.get(key)
+    if embedding is query_cache.MISSING:
+        embedding = openai_async.embed([query], embedding_store.EMBEDDING_MODEL)[0]
+        query_cache.query_embeddings.set(key, embedding)
     return embedding
 
-def calculate_similarity(embeddings, query_embedding):
-    def dot_product(v1, v2):
-        return sum(x*y for x, y in zip(v1, v2))
-    similarities = [dot_product(embed, query_embedding) for embed in embeddings]
-    return similarities
-
+# The shortlist goes in as numbered lines and the model answers with the numbers, which are far
+# fewer tokens than indented JSON with full message IDs
 def select_relevant_messages(search_term, messages):
-    nmessage_texts = [msg[3] for msg in messages]
-    message_ids = [msg[0] for msg in messages]
-    messages_data = [{"id": msg[0], "author": msg[1], "text": msg[3]} for msg in messages]
+    from src import rerank
+    names = friend_names()
     prompt = f"""Given the search term: '{search_term}', select the most relevant messages from the following list. Up to 30 if they do seem relevant. 
-    The messages are between two friends named {names[0]} and {names[1]}. Return ONLY the IDs of the selected messages in JSON format:\n\n{json.dumps(messages_data, indent=2)}\n\nONLY RESPOND WITH THE MESSAGE IDs IN JSON."""
+    The messages are between two friends named {names[0]} and {names[1]}. Each line is a message number, its author and its text. Return ONLY the numbers of the selected messages as a JSON list:\n\n{rerank.format_shortlist(messages)}\n\nONLY RESPOND WITH THE MESSAGE NUMBERS IN JSON."""
     print("Starting OpenAI call to select relevant messages...")
     # print(f"Prompt for selecting relevant messages:\n{prompt}")
-    response = client.chat.completions.create(
+    response = openai_async.chat(
         model="gpt-4o",
         messages=[
             {"role": "system", "content": "You are a helpful assistant."},
@@ -126,63 +188,75 @@ def select_relevant_messages(search_term, messages):
     if raw_content.startswith("```json"):
         raw_content = raw_content[7:-3].strip()
     try:
-        selected_message_ids = json.loads(raw_content)
-        # print(f"OpenAI response JSON for {len(selected_message_ids)} relevant messages:\n", json.dumps(selected_message_ids, indent=2))
-        return selected_message_ids
+        selected_numbers = json.loads(raw_content)
     except json.JSONDecodeError as e:
         print(f"JSONDecodeError: {e}")
         print("Raw content that caused JSONDecodeError:\n", raw_content)
         return []
-
-
-def contextual_expansion(messages, minutes_nearby=60):
-    expanded_messages = []
-    for message in messages:
-        message_id, timestamp = message[0], message[2]
-        timestamp_dt = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
-        start_timestamp = (timestamp_dt - timedelta(minutes=minutes_nearby)).strftime("%Y-%m-%d %H:%M:%S")
-        end_timestamp = (timestamp_dt + timedelta(minutes=minutes_nearby)).strftime("%Y-%m-%d %H:%M:%S")
-        # print(f"Start timestamp is {start_timestamp} , end timestamp is {end_timestamp}")
-        context = query_messages_by_timestamp_range(DATABASE_PATH, start_timestamp, end_timestamp)
-        expanded_messages.append(context)
-    return expanded_messages
-
-def summarize_conversation(original_query, expanded_messages):
-    # print(f"First expanded message: {expanded_messages[0]}")
-    # conversations = "\n\n".join(["\n".join([f"User: {msg[1]}\nTimestamp: {msg[2]}\nContents: {msg[3]}\nmessage_id: {msg[0]}" for msg in messages]) for messages in expanded_messages])
-    total_tokens = 0
-    conversations = ""
-    average_word_length = 4.7  # Assuming average word length in English
-    
-    for msg_tuple in expanded_messages:
-        group_messages = "\n".join([f"User: {msg[1]}, Date: {msg[2][:10]}, Contents: {msg[3]}" for msg in msg_tuple])
-    
-        num_words = len(group_messages.split())
-        estimated_tokens = num_words * average_word_length + 100
-    
-        if total_tokens + estimated_tokens > 124000:
-            break
-    
-        conversations += group_messages + "\n\n"
-        total_tokens += estimated_tokens
-    
+    # print(f"OpenAI response JSON for {len(selected_numbers)} relevant messages:\n", json.dumps(selected_numbers, indent=2))
+    return [messages[number - 1][0] for number in selected_numbers if isinstance(number, int) and 1 <= number <= len(messages)]
+
+# BM25 on the keywords fused with the embedding similarities, cut down to what's worth sending to gpt-4o
+def rerank_candidates(messages, keywords=(), similarities=None):
+    from src import rerank
+    with metrics.stage('rerank', rows_in=len(messages)) as stage:
+        sessions = db.session_ids(db.read_connection(DATABASE_PATH), [msg[0] for msg in messages])
+        shortlist = rerank.shortlist(messages, keywords, similarities, sessions)
+        stage.rows_out = len(shortlist)
+    print(f"Shortlisted {len(shortlist)} of {len(messages)} candidates for relevance selection")
+    return shortlist
+
+
+# Each hit brings in the whole conversation session ingest put it in, hits in the same session
+# share it. Conversations come back most relevant first.
+def contextual_expansion(messages, minutes_nearby=CONTEXT_MINUTES):
+    conn = db.read_connection(DATABASE_PATH)
+    sessions = db.session_ids(conn, [msg[0] for msg in messages])
+    if messages and None not in sessions:
+        unique_sessions = list(dict.fromkeys(sessions))
+        print(f"Expanding {len(messages)} messages to {len(unique_sessions)} conversation sessions")
+        return db.messages_in_sessions(conn, unique_sessions)
+    return window_expansion(conn, messages, minutes_nearby)
+
+# For databases that haven't been sessioned yet: a window either side of each hit. Windows around
+# hits that are close together overlap, so they are merged first and each message is only fetched
+# and sent to the model once.
+def window_expansion(conn, messages, minutes_nearby):
+    nearby_ms = minutes_nearby * 60 * 1000
+    windows = [(message.time_ms - nearby_ms, message.time_ms + nearby_ms, priority) for priority, message in enumerate(messages)]
+    merged = sorted(merge_intervals(windows), key=lambda window: window[2])
+    print(f"Merged {len(windows)} context windows into {len(merged)} conversations")
+
+    return db.messages_in_ranges(conn, [(start, end) for start, end, _ in merged])
+
+# Yields the answer as gpt-4o writes it
+def stream_conversation_summary(original_query, expanded_messages):
+    names = friend_names()
+    # Already fitted to the context window by answer_from_candidates
+    conversations = "".join("\n".join(format_message(msg) for msg in msg_tuple) + "\n\n" for msg_tuple in expanded_messages)
 
     # print(f"First message or so: {conversations[:150]}")
     prompt = f"Given the original query: '{original_query}', and the following messages between two friends {names[0]} and {names[1]}, provide an answer to the search term, summarizing at least 1 but not more than 5 occurences of the search term. Make sure to provide a paragraph at the top summarizing, especially if the original query asked for it, before the links. Include links. Please return one discord link for each example to the most relevant message, considering who sent the message and what the initial query says, not hyperlinked, just raw links. Summarize the conversation's main point, don't just focus on the best message. Avoid flowery text in your descriptions. Quote messages from the conversations if they are especially funny or poignant.  Links are formatted as https://discord.com/channels/@me/383761744830529537/message_id , make sure that 383.../ is always there, or the link will not work. Do NOT use markdown formatted EVER for the message links! No parentheses or brackets around them, ever.  Include a year, month day and time of day description for each result. Here are the messages:\n:\n\n{conversations}\n\n"
 
     print("Starting OpenAI call to summarize conversation...")
     # print(f"Prompt: {prompt}")
-    response = client.chat.completions.create(
+    stream = openai_async.stream_chat(
         model="gpt-4o",
         messages=[
             {"role": "system", "content": "You are a helpful assistant."},
             {"role": "user", "content": prompt}
         ],
-        max_tokens=2000
+        max_tokens=2000,
+        stream_options={"include_usage": True},
     )
+    for chunk in stream:
+        # The last chunk carries the usage and no choices
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
     print("Finished OpenAI call to summarize conversation.")
-    summary = response.choices[0].message.content.strip()
-    return summary
+
+def summarize_conversation(original_query, expanded_messages):
+    return "".join(stream_conversation_summary(original_query, expanded_messages)).strip()
 
 def save_to_file(summary_text, query):
 
@@ -207,56 +281,193 @@ def save_to_file(summary_text, query):
 
   return file_name
 
-def process_query(search_term, keyword_override: str = None, send_all_matches=False):
-    if keyword_override:
-        keywords = [keyword.strip() for keyword in keyword_override.split(',')]
-        print(f"Overriden keywords: {keywords}")
+# Pure semantic search: nearest neighbours of the query across the whole history, no keywords involved
+def semantic_candidates(search_term, number_of_candidates=200):
+    from src import vector_index
+    index = vector_index.load_index()
+    if index is None:
+        raise RuntimeError("No vector index found, build one with `python -m src.vector_index --build`")
+    query_embedding = get_query_embedding(search_term)
+    message_ids, _ = index.search(query_embedding, number_of_candidates)
+    print(f"Vector index returned {len(message_ids)} nearest messages out of {index.count}")
+    return get_messages_by_ids(message_ids)
+
+def cached_search_keywords(search_term):
+    key = query_cache.normalize_search_term(search_term)
+    keywords = query_cache.keywords.get(key)
+    if keywords is query_cache.MISSING:
+        keywords = get_search_keywords(search_term)
+        query_cache.keywords.set(key, keywords)
     else:
-        keywords_dict = get_search_keywords(search_term)
-        keywords = keywords_dict.get("keywords", []) 
-    # Find messages related to the keywords
-    initial_results = search_index(keywords)
+        print("Using cached search keywords")
+    return keywords
+
+def cached_relevant_message_ids(search_term, messages, db_version):
+    key = (query_cache.normalize_search_term(search_term), query_cache.candidates_key(messages), db_version)
+    relevant_message_ids = query_cache.relevant_ids.get(key)
+    if relevant_message_ids is query_cache.MISSING:
+        relevant_message_ids = select_relevant_messages(search_term, messages)
+        # An unparseable reply comes back empty, try again next time rather than caching it
+        if relevant_message_ids:
+            query_cache.relevant_ids.set(key, relevant_message_ids)
+    else:
+        print("Using cached relevant message selection")
+    return relevant_message_ids
+
+def process_query(search_term, keyword_override: str = None, send_all_matches=False, semantic_only=False):
+    return progress.final_result(process_query_events(search_term, keyword_override, send_all_matches, semantic_only))
+
+# process_query as a stream of progress.Event, for callers that show the answer as it's written
+def process_query_events(search_term, keyword_override: str = None, send_all_matches=False, semantic_only=False):
+    db_version = db.database_version(db.read_connection(DATABASE_PATH))
+    key = (query_cache.normalize_search_term(search_term), repr(keyword_override), send_all_matches, semantic_only, db_version)
+    with metrics.stage('answer_cache') as stage:
+        summary = query_cache.answers.get(key)
+        stage.rows_out = int(summary is not query_cache.MISSING)
+    if summary is not query_cache.MISSING:
+        print("Returning cached answer")
+        yield progress.result(summary)
+        return
+    summary, cacheable = yield from run_query(search_term, keyword_override, send_all_matches, semantic_only, db_version)
+    if cacheable:
+        query_cache.answers.set(key, summary)
+    yield progress.result(summary)
+
+# Yields progress events and returns the answer, and whether it's worth caching. Only an answer
+# from a non-empty relevance selection is, an empty one may just be a bad reply from gpt-4o.
+def run_query(search_term, keyword_override, send_all_matches, semantic_only, db_version):
+    if semantic_only:
+        yield progress.status("Searching the whole history by meaning...")
+        with metrics.stage('semantic_candidates') as stage:
+            selected_messages = semantic_candidates(search_term, CANDIDATE_COUNT)
+            stage.rows_out = len(selected_messages)
+        if len(selected_messages) == 0:
+            print("No results found")
+            return f"No messages found for '{search_term}'", False
+        selected_messages = rerank_candidates(selected_messages)
+        return (yield from answer_from_candidates(search_term, selected_messages, db_version))
+    if not keyword_override:
+        yield progress.status("Working out what to search for...")
+    results = {}
+    for name, result in stage_graph.run(keyword_search_graph(search_term, keyword_override, send_all_matches)):
+        results[name] = result
+        if name == 'keywords':
+            yield progress.status(f"Searching for {len(result)} keywords...")
+        elif name == 'search' and result and not send_all_matches:
+            yield progress.status(f"Found {len(result)} matching messages, ranking them...")
+    keywords = results['keywords']
+    initial_results = results['search']
     print(f"{len(initial_results)} total initial matching messages from {len(keywords)} keywords")
     if len(initial_results) == 0:
-        print("No results found, exiting...")
-        exit(1)
+        print("No results found")
+        return f"No messages found for '{search_term}'", False
     if send_all_matches:
-        selected_messages = initial_results
+        # No embeddings, the keyword ranking alone decides what fits in the selection prompt
+        selected_messages = rerank_candidates(initial_results, keywords)
     else:
-        # Turn the initial search into a vector
-        query_embedding = get_query_embedding(search_term)
-        # Turn search results into a vector
-        message_embeddings = get_message_embeddings(initial_results)
+        embedded_messages = [msg for msg, _ in results['embeddings']]
+        selected_messages = rerank_candidates(embedded_messages, keywords, results['similarity'])
+    return (yield from answer_from_candidates(search_term, selected_messages, db_version))
+
+# The keyword search as a stage graph. The query embedding only needs the search term, so it's
+# fetched while gpt-4o works out the keywords. The database stages run inline on the pipeline's
+# own thread, reusing its connections, and the embedding requests for each group of keyword
+# matches are sent while the next group is searched for.
+def keyword_search_graph(search_term, keyword_override, send_all_matches):
+    def keywords_stage(stage):
+        if keyword_override:
+            keywords = [keyword.strip() for keyword in keyword_override.split(',')]
+            print(f"Overriden keywords: {keywords}")
+        else:
+            keywords = cached_search_keywords(search_term).get("keywords", [])
+        stage.rows_out = len(keywords)
+        return keywords
+
+    if send_all_matches:
+        def search_stage(stage, keywords):
+            stage.rows_in = len(keywords)
+            initial_results = search_index(keywords)
+            stage.rows_out = len(initial_results)
+            return initial_results
+        return [stage_graph.node('keywords', keywords_stage), stage_graph.node('search', search_stage, ['keywords'], inline=True)]
+
+    # Embedding requests started by the search, their tokens count against it since that's when they're sent
+    requests = []
+
+    def search_stage(stage, keywords):
+        stage.rows_in = len(keywords)
+        initial_results = []
+        for batch in search_index_batches(keywords):
+            initial_results.extend(batch)
+            requests.append(request_embeddings(batch))
+        stage.rows_out = len(initial_results)
+        return initial_results
+
+    # Messages that couldn't be embedded are left out
+    def embeddings_stage(stage, initial_results):
+        stage.rows_in = len(initial_results)
+        embedded = collect_embeddings(requests)
+        stage.rows_out = len(embedded)
+        return embedded
+
+    def query_embedding_stage(stage):
+        return get_query_embedding(search_term)
+
+    def similarity_stage(stage, embedded, query_embedding):
+        from src.similarity import calculate_similarity
+        stage.rows_in = len(embedded)
         # FInd the messages with the most similarity (vector distance) of the query
-        similarities = calculate_similarity(message_embeddings, query_embedding)
-        # Get the top N most similar messages from the search
-        number_of_potentially_relevant_messages = 200
-        top_n = sorted(range(len(similarities)), key=lambda i: similarities[i], reverse=True)[:number_of_potentially_relevant_messages]
-        print(f"Produced {len(top_n)} potentially more relevant messages")
-        selected_messages = [initial_results[i] for i in top_n]
-    relevant_message_ids = select_relevant_messages(search_term, selected_messages)
-    relevant_messages = [msg for msg in selected_messages if msg[0] in relevant_message_ids]
+        similarities = calculate_similarity([embedding for _, embedding in embedded], query_embedding)
+        stage.rows_out = len(similarities)
+        return similarities
+
+    return [
+        stage_graph.node('keywords', keywords_stage),
+        stage_graph.node('query_embedding', query_embedding_stage),
+        stage_graph.node('search', search_stage, ['keywords'], inline=True),
+        stage_graph.node('embeddings', embeddings_stage, ['search'], inline=True),
+        stage_graph.node('similarity', similarity_stage, ['embeddings', 'query_embedding'], inline=True),
+    ]
+
+# Yields progress events and the answer as it's written, returns the whole answer and whether any
+# messages were selected for it
+def answer_from_candidates(search_term, selected_messages, db_version):
+    yield progress.status(f"Picking the most relevant of {len(selected_messages)} messages...")
+    with metrics.stage('relevance', rows_in=len(selected_messages)) as stage:
+        relevant_message_ids = cached_relevant_message_ids(search_term, selected_messages, db_version)
+        relevant_messages = [msg for msg in selected_messages if msg[0] in relevant_message_ids]
+        stage.rows_out = len(relevant_messages)
     print(f"OpenAI Selected {len(relevant_messages)} relevant messages")
-    expanded_messages = contextual_expansion(relevant_messages)
-    total_expanded_messages_count = sum(len(messages) for messages in expanded_messages)
+    with metrics.stage('expansion', rows_in=len(relevant_messages)) as stage:
+        expanded_messages = contextual_expansion(relevant_messages)
+        total_expanded_messages_count = sum(len(messages) for messages in expanded_messages)
+        stage.rows_out = total_expanded_messages_count
     print(f"Expanded surrounding messages: {total_expanded_messages_count} messages")
-    estimated_tokens = estimate_tokens(expanded_messages)
-    if estimated_tokens > 128000:
-        print("### Trimmed search input, too many tokens!")
-        print(f"Estimated # of tokens before trimming: {estimated_tokens}")
-        expanded_messages = trim_messages(expanded_messages, 125000)
-        estimated_tokens = estimate_tokens(expanded_messages)
-        print(f"Estimated # of tokens after trimming: {estimated_tokens}")
-    summary = summarize_conversation(search_term, expanded_messages)
+    with metrics.stage('budget', rows_in=total_expanded_messages_count) as stage:
+        expanded_messages, used_tokens = fit_to_budget(expanded_messages, CONVERSATION_TOKEN_BUDGET)
+        kept_messages_count = sum(len(messages) for messages in expanded_messages)
+        stage.rows_out = kept_messages_count
+    if kept_messages_count < total_expanded_messages_count:
+        print(f"### Trimmed search input to the token budget, kept {kept_messages_count} messages")
+    print(f"Conversations use {used_tokens} of {CONVERSATION_TOKEN_BUDGET} tokens")
+    yield progress.status(f"Reading {len(expanded_messages)} conversations around {len(relevant_messages)} relevant messages...")
+    pieces = []
+    with metrics.stage('summarize', rows_in=kept_messages_count):
+        for piece in stream_conversation_summary(search_term, expanded_messages):
+            pieces.append(piece)
+            yield progress.output(piece)
+    summary = "".join(pieces).strip()
     save_to_file(summary, search_term)
-    return summary
+    return summary, bool(relevant_messages)
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Search Discord DMs")
     parser.add_argument('search_term', type=str, nargs='*', help='Search term')
     parser.add_argument('--no-cost', action='store_true', help='Skip ChatGPT interaction')
     parser.add_argument('--keyword-override', action='append', type=str, help='Just search specific keywords with this prompt.')
-    parser.add_argument('--send-all-matches', action='store_true', default=False, help='Send all matches to OpenAI, dont use text embeddings to do initial screening. May crash with too many matches!!')
+    parser.add_argument('--send-all-matches', action='store_true', default=False, help='Skip text embeddings, rank the matches by keywords alone before sending the best of them to OpenAI')
+    parser.add_argument('--semantic-only', action='store_true', default=False, help='Skip keyword generation and pull candidates from the vector index over the whole history')
+    parser.add_argument('--profile', nargs='?', const='-', default=None, metavar='PATH', help='Write per-stage timings, row counts and token costs as JSON lines to PATH (stdout if no PATH)')
     args = parser.parse_args()
     return args
 
@@ -266,7 +477,8 @@ def main():
 
     if args.search_term:
         search_term = ' '.join(args.search_term)
-        summary = process_query(search_term, args.keyword_override, args.send_all_matches)
+        with metrics.run('search', args.profile, candidates=CANDIDATE_COUNT, context_minutes=CONTEXT_MINUTES):
+            summary = process_query(search_term, args.keyword_override, args.send_all_matches, args.semantic_only)
         print(summary)
 
 if __name__ == "__main__":
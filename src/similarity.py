@@ -0,0 +1,31 @@
+import numpy as np
+
+# Pack embeddings into one contiguous float32 matrix, one row per message
+def embedding_matrix(embeddings):
+    if isinstance(embeddings, np.ndarray):
+        return np.ascontiguousarray(embeddings, dtype=np.float32)
+    if not embeddings:
+        return np.empty((0, 0), dtype=np.float32)
+    matrix = np.empty((len(embeddings), len(embeddings[0])), dtype=np.float32)
+    for row, embedding in enumerate(embeddings):
+        matrix[row] = embedding
+    return matrix
+
+# OpenAI embeddings are unit length, so the dot product is the cosine similarity
+def calculate_similarity(embeddings, query_embedding):
+    matrix = embedding_matrix(embeddings)
+    if matrix.size == 0:
+        return np.empty(0, dtype=np.float32)
+    return matrix @ np.asarray(query_embedding, dtype=np.float32)
+
+# Indices of the k highest similarities, best first, without sorting the whole array
+def top_k_indices(similarities, k):
+    similarities = np.asarray(similarities)
+    if k <= 0 or similarities.size == 0:
+        return np.empty(0, dtype=np.intp)
+    if k < similarities.size:
+        # In index order, so the stable sort below keeps ties in their original order
+        candidates = np.sort(np.argpartition(-similarities, k - 1)[:k])
+    else:
+        candidates = np.arange(similarities.size)
+    return candidates[np.argsort(-similarities[candidates], kind='stable')]
@@ -0,0 +1,71 @@
+import threading
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from src import metrics
+
+# A pipeline as a small graph of stages. Each stage starts as soon as the stages it needs have
+# finished, so independent stages overlap and the whole graph takes as long as its slowest chain
+# of dependent stages. Every stage is timed with metrics.stage under its name.
+
+# Worker threads shared by every graph, so their per-thread connections are reused across runs
+MAX_WORKERS = 8
+
+# func is called with the stage's metrics record, then the results of needs in order. Inline
+# stages run on the thread iterating the graph instead of a worker, e.g. to keep its connections.
+Node = namedtuple('Node', 'name func needs inline')
+
+def node(name, func, needs=(), inline=False):
+    return Node(name, func, tuple(needs), inline)
+
+lock = threading.Lock()
+shared = {}
+
+def get_executor():
+    with lock:
+        if 'executor' not in shared:
+            shared['executor'] = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='stage')
+        return shared['executor']
+
+def run_node(node, inputs):
+    with metrics.stage(node.name) as stage:
+        return node.func(stage, *inputs)
+
+# Runs the graph, yielding (name, result) as each stage finishes and returning every result by name.
+# The first stage to fail raises once the stages already running have finished. Worker stages
+# never wait on each other, only on their needs, so graphs sharing the workers can't deadlock.
+def run(nodes):
+    names = {node.name for node in nodes}
+    for node in nodes:
+        unknown = [need for need in node.needs if need not in names]
+        if unknown:
+            raise ValueError(f"Stage {node.name} needs {unknown}, which aren't in the graph")
+    results = {}
+    waiting = list(nodes)
+    running = {}
+    try:
+        while True:
+            ready = [node for node in waiting if all(need in results for need in node.needs)]
+            for node in ready:
+                waiting.remove(node)
+                if not node.inline:
+                    inputs = [results[need] for need in node.needs]
+                    running[get_executor().submit(metrics.propagate(run_node), node, inputs)] = node
+            inline = [node for node in ready if node.inline]
+            for node in inline:
+                results[node.name] = run_node(node, [results[need] for need in node.needs])
+                yield node.name, results[node.name]
+            if inline:
+                continue
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                results[node.name] = future.result()
+                yield node.name, results[node.name]
+    finally:
+        # Nothing from this graph is left running when it returns, raises or is closed early
+        wait(running)
+    if waiting:
+        raise ValueError(f"Stages {[node.name for node in waiting]} depend on each other")
+    return results
@@ -1,70 +1,109 @@
-import sqlite3
 import os
 import argparse
-import openai
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from src.utils import initialize_openai
+from src.utils import format_message
+from src.tokens import message_tokens
+from src import metrics
+from src import openai_async
+from src import db
+from src import progress
 
 DATABASE_PATH = 'database/messages.db'
+# Most day/week/month summaries one cached request may compute, the cache's version of max_chunks.
+# A cold month is about 35, anything more should be warmed with `python -m src.summary_cache --precompute`.
+MAX_STALE_PERIODS = 40
+TOO_MANY_CHUNKS = "Bridge to Enterprise: Stop whatever you are doing, if you give it any more she'll blow captain!"
 
-def fetch_messages(cursor, start_date, end_date):
-    query = '''
-    SELECT message_id, name, timestamp, contents
-    FROM messages
-    WHERE timestamp BETWEEN ? AND ?
-    ORDER BY timestamp ASC
-    '''
-    cursor.execute(query, (start_date, end_date))
-    return cursor.fetchall()
-
-def get_first_date(cursor):
-    query = '''
-    SELECT MIN(timestamp) FROM messages
-    '''
-    cursor.execute(query)
-    result = cursor.fetchone()
-    return result[0] if result else None
+# Messages from start_date up to but not including end_date, both dates or datetimes in UTC. Rows are
+# streamed from the cursor, so only what's been asked for so far is in memory.
+def fetch_messages(conn, start_date, end_date):
+    return db.iter_messages_between(conn, db.to_time_ms(start_date), db.to_time_ms(end_date))
+
+# Day of the oldest message as YYYY-MM-DD, None for an empty database
+def get_first_date(conn):
+    first, _ = db.time_span(conn)
+    return db.from_time_ms(first).strftime('%Y-%m-%d') if first is not None else None
 
 def message_link_for(message_id: str):
     return f'https://discord.com/channels/@me/383761744830529537/{message_id}'
 
-def chunk_messages(messages, chunk_size):
-    chunked = []
-    current_chunk = []
-    current_length = 0
-    total_length = 0
-
-    for msg in messages:
-        formatted_msg = f"User: {msg[1]}, Date: {msg[2][:10]}, Contents: {msg[3]}"
-        msg_length = len(formatted_msg)  # length of the formatted message
-
-        if current_length + msg_length > chunk_size:
-            chunked.append(current_chunk)
-            print(f"Chunk {len(chunked)}: {len(current_chunk)} messages, estimated size {current_length}")
-            current_chunk = [msg]
-            current_length = msg_length
-        else:
-            current_chunk.append(msg)
-            current_length += msg_length
+# Messages that haven't been put in a session yet are treated as a session each
+def session_of(msg):
+    session_id = getattr(msg, 'session_id', None)
+    return session_id if session_id is not None else ('message', msg[0])
 
-        total_length += msg_length
+# Consecutive messages grouped by session, how a chunk goes into the prompt
+def split_sessions(messages):
+    return [list(session) for _, session in itertools.groupby(messages, key=session_of)]
 
+# Pack (session, tokens, item) entries into chunks of at most chunk_size tokens, yielding each
+# (items, tokens) as soon as it's full. Whole sessions are packed into chunks so a conversation
+# isn't cut in half, only a session bigger than a chunk is split by message.
+def pack_chunks(entries, chunk_size):
+    current_chunk = []
+    current_tokens = 0
+    for _, session in itertools.groupby(entries, key=lambda entry: entry[0]):
+        # Ingest caps sessions at a few thousand tokens, so holding one is cheap
+        session = list(session)
+        if current_chunk and current_tokens + sum(tokens for _, tokens, _ in session) > chunk_size:
+            yield current_chunk, current_tokens
+            current_chunk = []
+            current_tokens = 0
+        for _, tokens, item in session:
+            if current_chunk and current_tokens + tokens > chunk_size:
+                yield current_chunk, current_tokens
+                current_chunk = []
+                current_tokens = 0
+            current_chunk.append(item)
+            current_tokens += tokens
     if current_chunk:
-        chunked.append(current_chunk)
-        print(f"Chunk {len(chunked)}: {len(current_chunk)} messages, estimated size {current_length}")
-
-    print(f"Total chunks: {len(chunked)}")
-    print(f"Total estimated message text length: {total_length}")
-
-    return chunked
+        yield current_chunk, current_tokens
 
+# chunk_size is in tokens, each chunk becomes one prompt. Chunks are yielded as they fill up, messages
+# are only pulled from the iterable as they're needed.
+def chunk_messages(messages, chunk_size):
+    count = 0
+    total_tokens = 0
+    for chunk, tokens in pack_chunks(((session_of(msg), message_tokens(msg), msg) for msg in messages), chunk_size):
+        count += 1
+        total_tokens += tokens
+        print(f"Chunk {count}: {len(chunk)} messages, {tokens} tokens")
+        yield chunk
+
+    print(f"Total chunks: {count}")
+    print(f"Total message tokens: {total_tokens}")
+
+# How many messages there are from start_date to end_date and how many chunks they make, without
+# holding on to them or reading contents that already have a token count
+def count_chunks(conn, start_date, end_date, chunk_size):
+    message_count = 0
+    chunk_count = 0
+    sizes = db.iter_message_sizes_between(conn, db.to_time_ms(start_date), db.to_time_ms(end_date))
+    for chunk, _ in pack_chunks(((session_of(msg), message_tokens(msg), None) for msg in sizes), chunk_size):
+        message_count += len(chunk)
+        chunk_count += 1
+    return message_count, chunk_count
+
+# executor.map submits every item up front, this only takes the next item once fewer than ahead are
+# in flight, so items are read just ahead of the workers. Results come back in order.
+def ordered_map(executor, func, items, ahead):
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
 def summarize_conversation(client, messages, start_date, end_date):
     conversations = "\n\n".join(
         [
             "\n".join(
                 [
-                    f"User: {msg[1]}, Date: {msg[2][:10]}, Contents: {msg[3]}"
+                    format_message(msg)
                     for msg in msg_tuple
                 ]
             )
@@ -86,18 +125,41 @@ def summarize_conversation(client, messages, start_date, end_date):
 
     print(f"Actual prompt length: {len(prompt)}")
     
-    response = client.chat.completions.create(
+    response = openai_async.chat(
         model="gpt-4o",
         messages=[
             {"role": "system", "content": "You are a helpful assistant."},
             {"role": "user", "content": prompt}
         ],
+        client=client,
         max_tokens=2048
     )
     
     summary = response.choices[0].message.content.strip()
     return summary
 
+# Merge the per-chunk summaries, already in chronological order, into one digest
+def reduce_summaries(client, summaries, start_date, end_date):
+    joined = "\n\n".join(f"Part {i + 1}:\n{summary}" for i, summary in enumerate(summaries))
+    prompt = (
+        f"The following are summaries of consecutive parts of the messages between two friends from {start_date} to {end_date}, in chronological order. "
+        "Merge them into one factual and succinct digest of the whole period, keeping it in chronological order. Start with '# <month> <year>' headings. "
+        "Keep concrete events, notable quotes and recurring topics, drop repetition between parts. Avoid general or flowery descriptions and transitional phrases. "
+        "Use proper Discord markdown formatting in the reply.\n\n Summaries follow:\n"
+        f"{joined}"
+    )
+
+    response = openai_async.chat(
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": prompt}
+        ],
+        client=client,
+        max_tokens=2048
+    )
+    return response.choices[0].message.content.strip()
+
 def save_to_file(summary_text, start_date, end_date, window_size):
   start_date_str = start_date.strftime('%Y-%m-%d')
   end_date_str = end_date.strftime('%Y-%m-%d')
@@ -125,61 +187,113 @@ def save_to_file(summary_text, start_date, end_date, window_size):
 
 
 
-def main(start_date, num_days, max_chunks, window):
-    client = initialize_openai()
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+def summarize_chunk(client, chunk, window):
+    chunk_start_date = db.from_time_ms(chunk[0].time_ms)
+    chunk_end_date = db.from_time_ms(chunk[-1].time_ms)
+    print(f"Processing chunk from {chunk_start_date} to {chunk_end_date}...")
+    print(f"First message in chunk: {chunk[0]}")
+    print(f"Last message in chunk: {chunk[-1]}")
+    summary = summarize_conversation(client, split_sessions(chunk), chunk_start_date, chunk_end_date)
+    save_to_file(summary, chunk_start_date, chunk_end_date, window)
+    print(summary)
+    return summary
+
+# Answer from the day/week/month summary cache, only summarizing periods that are missing or changed
+def summarize_from_cache(client, start_date, end_date, window, workers, reduce):
+    from src.summary_cache import SummaryCache
+    cache = SummaryCache(client, DATABASE_PATH, window=window, workers=workers)
+    try:
+        # Checked up front like max_chunks, so nothing is spent on a range we won't finish
+        stale_count = cache.stale_count(start_date.date(), end_date.date())
+        if stale_count > MAX_STALE_PERIODS:
+            print(f"######### Warning!!! {stale_count} periods need summarizing, more than the max of {MAX_STALE_PERIODS}. Warm the cache with `python -m src.summary_cache --precompute`")
+            return TOO_MANY_CHUNKS
+        summary = cache.summarize_range(start_date.date(), end_date.date(), reduce)
+    finally:
+        cache.close()
+    return summary or "No messages :("
+
+def main(start_date, num_days, max_chunks, window, workers=4, reduce=False, client=None, use_cache=False):
+    return progress.final_result(summarize_events(start_date, num_days, max_chunks, window, workers, reduce, client, use_cache))
+
+# main as a stream of progress.Event. Chunk summaries are handed out in order as soon as they're
+# written, unless they're going to be merged, then only the digest is.
+def summarize_events(start_date, num_days, max_chunks, window, workers=4, reduce=False, client=None, use_cache=False):
+    client = client or openai_async.get_async_client()
+    conn = db.read_connection(DATABASE_PATH)
 
     if start_date is None:
-        start_date = get_first_date(cursor)
+        start_date = get_first_date(conn)
         if not start_date:
             print("No messages found in the database.")
-            return "He's gone, Spock"
-        start_date = start_date.split(' ')[0]  # Extract the date part
+            yield progress.result("He's gone, Spock")
+            return
 
     current_date = datetime.strptime(start_date, '%Y-%m-%d')
     end_date = current_date + timedelta(days=num_days)
 
-    chunks_processed = 0
-
-    messages = fetch_messages(cursor, current_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
-
-    if not messages:
-        return "No messages :("
-
-    chunked_messages = chunk_messages(messages, window)
-    total_summary = ""
-    for chunk in chunked_messages:
-        chunk_start_date = datetime.strptime(chunk[0][2], '%Y-%m-%d %H:%M:%S')
-        chunk_end_date = datetime.strptime(chunk[-1][2], '%Y-%m-%d %H:%M:%S')
-        print(f"Processing chunk from {chunk_start_date} to {chunk_end_date}...")
-        print(f"First message in chunk: {chunk[0]}")
-        print(f"Last message in chunk: {chunk[-1]}")
-        summary = summarize_conversation(client, [chunk], chunk_start_date, chunk_end_date)
-        time_prefix = f"* Start of time period: {message_link_for(chunk[0][0])}\n* End of time period: {message_link_for(chunk[-1][0])}"
-        summary_text = f"{time_prefix}\n{summary}\n"
-        summary_text = summary
-        file_name = save_to_file(summary_text, chunk_start_date, chunk_end_date, window)
-        print(summary_text)
-        total_summary += summary_text
-
-        # Fallback for if we go too far, unlikely
-        chunks_processed += 1
-        if chunks_processed >= max_chunks:
-            print(f"######### Warning!!! We Exceeded the max chunk count and ended early at {chunk_end_date}")
-            return "Bridge to Enterprise: Stop whatever you are doing, if you give it any more she'll blow captain!"
-
-    conn.close()
-    return total_summary
+    if use_cache:
+        yield progress.status("Reading the summary cache...")
+        with metrics.stage('summary_cache'):
+            summary = summarize_from_cache(client, current_date, end_date, window, workers, reduce)
+        yield progress.result(summary)
+        return
+
+    # Only token counts and session IDs are read here, the messages themselves are streamed below
+    with metrics.stage('chunk') as stage:
+        message_count, chunk_count = count_chunks(conn, current_date, end_date, window)
+        stage.rows_in = message_count
+        stage.rows_out = chunk_count
+
+    if not message_count:
+        yield progress.result("No messages :(")
+        return
+
+    # Fallback for if we go too far, unlikely. Checked up front so nothing is spent on a range we won't finish
+    if chunk_count > max_chunks:
+        print(f"######### Warning!!! {chunk_count} chunks is more than the max chunk count of {max_chunks}")
+        yield progress.result(TOO_MANY_CHUNKS)
+        return
+
+    yield progress.status(f"Summarizing {message_count} messages in {chunk_count} chunks...")
+    # Map: chunks are summarized concurrently as they're read from the cursor, one more than the
+    # workers at a time, and ordered_map hands the results back in chronological order
+    summaries = []
+    with metrics.stage('summarize', rows_in=chunk_count) as stage:
+        chunks = chunk_messages(fetch_messages(conn, current_date, end_date), window)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for summary in ordered_map(executor, metrics.propagate(lambda chunk: summarize_chunk(client, chunk, window)), chunks, max(1, workers) + 1):
+                summaries.append(summary)
+                if reduce:
+                    yield progress.status(f"Summarized {len(summaries)} of {chunk_count} chunks...")
+                else:
+                    yield progress.output(summary if len(summaries) == 1 else "\n\n" + summary)
+        stage.rows_out = len(summaries)
+
+    # Reduce: optionally fold the chunk summaries into one digest
+    if reduce and len(summaries) > 1:
+        print(f"Merging {len(summaries)} chunk summaries...")
+        yield progress.status(f"Merging {len(summaries)} chunk summaries...")
+        with metrics.stage('reduce', rows_in=len(summaries)):
+            digest = reduce_summaries(client, summaries, current_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
+        yield progress.result(digest)
+        return
+
+    yield progress.result("\n\n".join(summaries))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Summarize Discord DM conversations.')
     parser.add_argument('--start-date', type=str, default=None, help='Start date for summarization in format YYYY-MM-DD')
     parser.add_argument('--max-chunks', type=int, default=10, help='Maximum number of chunks to process')
-    parser.add_argument('--window', type=int, default=120000, help='Context window size')
+    parser.add_argument('--window', type=int, default=120000, help='Context window size in tokens')
     parser.add_argument('--days', type=int, default=14, help="Number of days (default 14)")
+    parser.add_argument('--workers', type=int, default=4, help='Chunks summarized at the same time')
+    parser.add_argument('--reduce', action='store_true', help='Merge the chunk summaries into one digest')
+    parser.add_argument('--cached', action='store_true', help='Answer from the day/week/month summary cache (see src.summary_cache)')
+    parser.add_argument('--profile', nargs='?', const='-', default=None, metavar='PATH', help='Write per-stage timings, row counts and token costs as JSON lines to PATH (stdout if no PATH)')
 
     args = parser.parse_args()
 
-    main(args.start_date, args.days, args.max_chunks, args.window)
-
+    with metrics.run('summarize', args.profile, days=args.days, window=args.window, workers=args.workers):
+        summary = main(args.start_date, args.days, args.max_chunks, args.window, args.workers, args.reduce, use_cache=args.cached)
+    print(summary)
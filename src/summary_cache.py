@@ -0,0 +1,243 @@
+import argparse
+import hashlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from src import summarize_discord
+from src import metrics
+from src import db
+from src.utils import require_openai_key
+from src import openai_async
+
+DATABASE_PATH = 'database/messages.db'
+# Kept next to messages.db like the embeddings, a rebuilt database with the same messages keeps its summaries
+SUMMARIES_PATH = 'database/summaries.db'
+
+# Summaries are stored per day, per month-aligned week (starting on the 1st, 8th, 15th and 22nd,
+# the last one runs to the end of the month) and per month. Weeks are rolled up from their days
+# and months from their weeks, so every period nests exactly inside the next one up.
+WEEK_START_DAYS = (1, 8, 15, 22)
+
+def connect(summaries_path=SUMMARIES_PATH):
+    conn = sqlite3.connect(summaries_path)
+    db.enable_wal(conn)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS period_summaries (
+            period TEXT NOT NULL,
+            period_start TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (period, period_start)
+        ) WITHOUT ROWID
+    ''')
+    return conn
+
+def month_end(start):
+    return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+def period_end(period, start):
+    if period == 'day':
+        return start + timedelta(days=1)
+    if period == 'week':
+        if start.day == WEEK_START_DAYS[-1]:
+            return month_end(start)
+        return start + timedelta(days=7)
+    return month_end(start)
+
+def children(period, start):
+    end = period_end(period, start)
+    if period == 'week':
+        return [('day', start + timedelta(days=i)) for i in range((end - start).days)]
+    if period == 'month':
+        return [('week', start.replace(day=day)) for day in WEEK_START_DAYS]
+    return []
+
+# Split [start_date, end_date) into the fewest whole months, weeks and days
+def cover_range(start_date, end_date):
+    periods = []
+    current = start_date
+    while current < end_date:
+        if current.day == 1 and month_end(current) <= end_date:
+            period = 'month'
+        elif current.day in WEEK_START_DAYS and period_end('week', current) <= end_date:
+            period = 'week'
+        else:
+            period = 'day'
+        periods.append((period, current))
+        current = period_end(period, current)
+    return periods
+
+# One cheap aggregate per day that changes whenever a message is added, removed or edited
+def day_fingerprints(db_path, start_date, end_date):
+    rows = db.read_connection(db_path).execute('''
+        SELECT date(time_ms / 1000, 'unixepoch') AS day, COUNT(*), MIN(message_id), MAX(message_id),
+               SUM(message_id % 1000000007), TOTAL(length(contents))
+        FROM messages
+        WHERE time_ms >= ? AND time_ms < ?
+        GROUP BY day
+    ''', (db.to_time_ms(start_date), db.to_time_ms(end_date))).fetchall()
+    return {row[0]: hashlib.sha1(repr(row[1:]).encode()).hexdigest() for row in rows}
+
+# Days take their fingerprint from the messages, bigger periods from their children. None means no messages.
+def fingerprint(period, start, days):
+    if period == 'day':
+        return days.get(start.isoformat())
+    parts = [fingerprint(child_period, child_start, days) for child_period, child_start in children(period, start)]
+    if not any(parts):
+        return None
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+class SummaryCache:
+    def __init__(self, client, db_path=DATABASE_PATH, summaries_path=SUMMARIES_PATH, window=120000, workers=4):
+        self.client = client
+        self.db_path = db_path
+        self.conn = connect(summaries_path)
+        self.window = window
+        self.workers = workers
+
+    def close(self):
+        self.conn.close()
+
+    def load(self, period, start, expected_fingerprint):
+        row = self.conn.execute(
+            'SELECT fingerprint, summary FROM period_summaries WHERE period = ? AND period_start = ?',
+            (period, start.isoformat())
+        ).fetchone()
+        if row and row[0] == expected_fingerprint:
+            return row[1]
+        return None
+
+    def store(self, period, start, period_fingerprint, summary):
+        self.conn.execute('''
+            INSERT OR REPLACE INTO period_summaries (period, period_start, fingerprint, summary, created_at)
+            VALUES (?, ?, ?, ?, datetime('now'))
+        ''', (period, start.isoformat(), period_fingerprint, summary))
+        self.conn.commit()
+
+    def summarize_day(self, start):
+        messages = summarize_discord.fetch_messages(db.read_connection(self.db_path), start, period_end('day', start))
+        chunks = summarize_discord.chunk_messages(messages, self.window)
+        summaries = [summarize_discord.summarize_conversation(self.client, summarize_discord.split_sessions(chunk), start, start) for chunk in chunks]
+        if len(summaries) == 1:
+            return summaries[0]
+        return summarize_discord.reduce_summaries(self.client, summaries, start, start)
+
+    def summarize_rollup(self, period, start, child_summaries):
+        end = period_end(period, start) - timedelta(days=1)
+        if len(child_summaries) == 1:
+            return child_summaries[0]
+        return summarize_discord.reduce_summaries(self.client, child_summaries, start, end)
+
+    # Find what ensure() has to do without doing it: the fresh cached summaries as
+    # {(period, start): summary}, and the stale or missing periods as {level: [(start, fingerprint)]}.
+    # A stale period is rebuilt from its children, which are checked the same way.
+    def plan(self, periods):
+        summaries = {}
+        stale = {level: [] for level in ('day', 'week', 'month')}
+        if not periods:
+            return summaries, stale
+        first = min(start for _, start in periods)
+        last = max(period_end(period, start) for period, start in periods)
+        days = day_fingerprints(self.db_path, first, last)
+
+        def resolve(period, start):
+            period_fingerprint = fingerprint(period, start, days)
+            if period_fingerprint is None:
+                return
+            cached = self.load(period, start, period_fingerprint)
+            if cached is not None:
+                summaries[(period, start)] = cached
+                return
+            stale[period].append((start, period_fingerprint))
+            for child in children(period, start):
+                resolve(*child)
+        for period, start in periods:
+            resolve(period, start)
+        return summaries, stale
+
+    # How many periods summarize_range would have to summarize, each one at least a gpt-4o call
+    def stale_count(self, start_date, end_date):
+        _, stale = self.plan(cover_range(start_date, end_date))
+        return sum(len(starts) for starts in stale.values())
+
+    # Make sure every period has an up to date summary, computing the stale ones bottom up with each
+    # level in parallel. Returns {(period, start): summary}.
+    def ensure(self, periods):
+        summaries, stale = self.plan(periods)
+        for level in ('day', 'week', 'month'):
+            if not stale[level]:
+                continue
+            print(f"Summarizing {len(stale[level])} stale or missing {level} periods...")
+
+            def compute(item):
+                start, period_fingerprint = item
+                if level == 'day':
+                    summary = self.summarize_day(start)
+                else:
+                    child_summaries = [summaries[child] for child in children(level, start) if child in summaries]
+                    summary = self.summarize_rollup(level, start, child_summaries)
+                return start, period_fingerprint, summary
+
+            with metrics.stage(f'{level}_summaries', rows_in=len(stale[level])) as stage:
+                with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+                    for start, period_fingerprint, summary in executor.map(metrics.propagate(compute), stale[level]):
+                        self.store(level, start, period_fingerprint, summary)
+                        summaries[(level, start)] = summary
+                stage.rows_out = len(stale[level])
+        return summaries
+
+    def summarize_range(self, start_date, end_date, reduce=False):
+        periods = cover_range(start_date, end_date)
+        summaries = self.ensure(periods)
+        pieces = [summaries[period] for period in periods if period in summaries]
+        if not pieces:
+            return None
+        if reduce and len(pieces) > 1:
+            return summarize_discord.reduce_summaries(self.client, pieces, start_date, end_date - timedelta(days=1))
+        return "\n\n".join(pieces)
+
+def first_and_last_day(db_path):
+    first, last = db.time_span(db.read_connection(db_path))
+    if first is None:
+        return None, None
+    return db.from_time_ms(first).date(), db.from_time_ms(last).date()
+
+# Warm the cache for every month of the history, which also fills in all of their weeks and days
+def precompute(client, db_path=DATABASE_PATH, summaries_path=SUMMARIES_PATH, window=120000, workers=4):
+    first, last = first_and_last_day(db_path)
+    if first is None:
+        print("No messages found in the database.")
+        return
+    months = []
+    month = first.replace(day=1)
+    while month <= last:
+        months.append(('month', month))
+        month = month_end(month)
+    cache = SummaryCache(client, db_path, summaries_path, window, workers)
+    try:
+        summaries = cache.ensure(months)
+    finally:
+        cache.close()
+    print(f"Summary cache holds {len(summaries)} periods from {first} to {last}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute the day/week/month summary cache used by /summarize")
+    parser.add_argument('--precompute', action='store_true', help='Summarize every period that is missing or has new messages')
+    parser.add_argument('--window', type=int, default=120000, help='Context window size in tokens')
+    parser.add_argument('--workers', type=int, default=4, help='Periods summarized at the same time')
+    parser.add_argument('--profile', nargs='?', const='-', default=None, metavar='PATH', help='Write per-stage timings, row counts and token costs as JSON lines to PATH (stdout if no PATH)')
+    args = parser.parse_args()
+
+    if args.precompute:
+        require_openai_key()
+        with metrics.run('precompute', args.profile, window=args.window, workers=args.workers):
+            precompute(openai_async.get_async_client(), window=args.window, workers=args.workers)
+    else:
+        conn = connect()
+        for period, count in conn.execute('SELECT period, COUNT(*) FROM period_summaries GROUP BY period'):
+            print(f"{period}: {count} cached summaries")
+        conn.close()
+
+if __name__ == "__main__":
+    main()
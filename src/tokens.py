@@ -0,0 +1,74 @@
+import math
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import accumulate
+from src.utils import format_message
+
+# The tokenizer gpt-4o uses
+ENCODING_NAME = 'o200k_base'
+
+# tiktoken is optional, without it token counts are estimated as characters / 4
+@lru_cache(maxsize=None)
+def get_encoding():
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.get_encoding(ENCODING_NAME)
+    except Exception as e:
+        # The vocabulary is downloaded on first use, which fails offline
+        print(f"Couldn't load the {ENCODING_NAME} tokenizer ({e}), estimating tokens from characters")
+        return None
+
+def count_tokens(text):
+    encoding = get_encoding()
+    if encoding is None:
+        return math.ceil(len(text) / 4)
+    return len(encoding.encode(text, disallowed_special=()))
+
+# The start of text that fits in max_tokens
+def truncate_to_tokens(text, max_tokens):
+    encoding = get_encoding()
+    if encoding is None:
+        return text[:max_tokens * 4]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+# Tokens a message takes up in a prompt: its formatted line plus the newline after it
+def count_message_tokens(msg):
+    return count_tokens(format_message(msg)) + 1
+
+@lru_cache(maxsize=65536)
+def cached_message_tokens(message_id, name, timestamp, contents):
+    return count_message_tokens((message_id, name, timestamp, contents))
+
+# Rows from the context queries (db.ContextMessage) carry the count stored at ingest by name
+def message_tokens(msg):
+    stored = getattr(msg, 'token_count', None)
+    if isinstance(stored, int):
+        return stored
+    # Rows without a stored count, e.g. from a database that hasn't been migrated yet
+    return cached_message_tokens(msg[0], msg[1], msg[2], msg[3])
+
+# Keep whole conversations, most relevant first, while they fit in max_tokens. A conversation
+# that doesn't fit is skipped so smaller, less relevant ones can still use the room. Every message
+# is counted once, the prefix sums also give the cut if the top conversation alone is too big.
+# Returns the kept conversations and the tokens they use.
+def fit_to_budget(groups, max_tokens, group_overhead=1):
+    kept = []
+    used = 0
+    for group in groups:
+        prefix = list(accumulate(message_tokens(msg) for msg in group))
+        if not prefix:
+            continue
+        cost = prefix[-1] + group_overhead
+        if used + cost <= max_tokens:
+            kept.append(group)
+            used += cost
+        elif not kept:
+            fits = bisect_right(prefix, max_tokens - group_overhead)
+            if fits:
+                kept.append(group[:fits])
+                used = prefix[fits - 1] + group_overhead
+            break
+    return kept, used
@@ -1,8 +1,10 @@
-import openai
 import sqlite3
 import os
+import re
 import sys
 import json
+import random
+from functools import lru_cache
 
 def load_config(config_path='config.json'):
     config = {}
@@ -12,8 +14,60 @@ def load_config(config_path='config.json'):
     config['id_to_name'] = {int(k): v for k, v in conf['id_to_name'].items()}
     config['allowed_servers'] = [int(server) for server in conf.get('allowed_servers', [])]
     config['allowed_users'] = [int(user) for user in conf.get('allowed_users', [])]
+    # Optional, only needed if the DMs mention roles or channels
+    config['role_id_to_name'] = {int(k): v for k, v in conf.get('role_id_to_name', {}).items()}
+    config['channel_id_to_name'] = {int(k): v for k, v in conf.get('channel_id_to_name', {}).items()}
+    # How many /search and /summarize commands the bot runs at once, overall and per user
+    config['max_concurrent_jobs'] = int(conf.get('max_concurrent_jobs', 2))
+    config['max_jobs_per_user'] = int(conf.get('max_jobs_per_user', 1))
+    # Answer /summarize from the precomputed summary cache (python -m src.summary_cache --precompute)
+    config['use_summary_cache'] = bool(conf.get('use_summary_cache', False))
     return config
 
+# Read on first use and shared after that, so importing a module never touches config.json
+@lru_cache(maxsize=None)
+def get_config():
+    return load_config()
+
+# Every Discord mention form: <@id> and <@!id> (nickname) for users, <@&id> for roles, <#id> for channels
+MENTION_PATTERN = re.compile(r'<(@!?|@&|#)(\d+)>')
+
+# Build a function that rewrites mentions to readable names in one pass over the text.
+# Mentions of IDs that aren't in the maps are left as they are.
+def make_mention_rewriter(id_to_name, role_id_to_name=None, channel_id_to_name=None):
+    lookups = {
+        '@': ('@', id_to_name),
+        '@!': ('@', id_to_name),
+        '@&': ('@', role_id_to_name or {}),
+        '#': ('#', channel_id_to_name or {}),
+    }
+
+    def replace(match):
+        prefix, names = lookups[match.group(1)]
+        name = names.get(int(match.group(2)))
+        return match.group(0) if name is None else f'{prefix}{name}'
+
+    def rewrite(contents):
+        # Most messages mention nobody, skip the regex for them
+        if '<' not in contents:
+            return contents
+        return MENTION_PATTERN.sub(replace, contents)
+
+    return rewrite
+
+@lru_cache(maxsize=None)
+def configured_mention_rewriter():
+    config = get_config()
+    return make_mention_rewriter(config['id_to_name'], config['role_id_to_name'], config['channel_id_to_name'])
+
+# Rewrite mentions with the names from config.json, used at ingest and again when building prompts
+# so raw mentions already stored in the database read the same way
+def rewrite_mentions(contents):
+    return configured_mention_rewriter()(contents)
+
+def format_message(msg):
+    return f"User: {msg[1]}, Date: {msg[2][:10]}, Contents: {rewrite_mentions(msg[3])}"
+
 def get_openai_key():
     openai_key = os.getenv("OPENAI_KEY")
     if not openai_key:
@@ -24,56 +78,54 @@ def get_openai_key():
             pass
     return openai_key
 
-def initialize_openai():
-    openai_key = get_openai_key()
-    if not openai_key:
+# For the CLIs, stop with instructions up front rather than fail on the first request
+def require_openai_key():
+    if not get_openai_key():
         print("Error: The OPENAI_KEY environment variable is not set and OPENAI_KEY.txt is missing.")
         print("Please set the key using 'export OPENAI_KEY=your_openai_key_here' or create an OPENAI_KEY.txt file.")
         sys.exit(1)
-    client = openai.OpenAI(api_key=openai_key)
-    return client
 
-import sqlite3
+# Errors worth retrying: rate limits, timeouts, dropped connections and server side failures
+def is_retryable_openai_error(error):
+    import openai
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+# Exponential backoff with jitter for a retryable error. A Retry-After header from a rate limit
+# response wins over the computed delay.
+def retry_delay(error, attempt, base_delay=1.0, max_delay=60.0):
+    delay = min(max_delay, base_delay * 2 ** attempt) * (0.5 + random.random() / 2)
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    if retry_after:
+        try:
+            delay = min(max_delay, float(retry_after))
+        except ValueError:
+            pass
+    return delay
+
+def fts5_available(conn):
+    # Probe with a throwaway temp table, FTS5 may be compiled in or loaded as an extension
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)")
+        conn.execute("DROP TABLE temp.fts5_probe")
+        return True
+    except sqlite3.OperationalError:
+        return False
 
-def estimate_tokens(expanded_messages):
-    total_characters = 0
-    for msg_tuple in expanded_messages:
-        for msg in msg_tuple:
-            # print(f"Processing message: {msg}")
-            try:
-                user = msg[1]
-                date = msg[2][:10]
-                contents = msg[3]
-                formatted_msg = f"User: {user}, Date: {date}, Contents: {contents}"
-                msg_length = len(formatted_msg)
-                total_characters += msg_length
-            except IndexError as e:
-                print(f"Error accessing elements in message: {msg} - {e}")
-                raise
-    estimated_tokens = total_characters / 4
-    return estimated_tokens
-
-def trim_messages(messages, max_tokens):
-    while estimate_tokens(messages) > max_tokens:
-        # Reduce the list by 5%
-        reduction_count = max(1, int(len(messages) * 0.05))
-        messages = messages[:-reduction_count]
-    return messages
-
-def query_messages_by_timestamp_range(db_path, start_timestamp, end_timestamp):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    query = f'''
-    SELECT message_id, name, timestamp, contents, attachments link
-    FROM messages
-    WHERE timestamp >= ? AND timestamp <= ?
-    ORDER BY timestamp
-    '''
-
-    cursor.execute(query, (start_timestamp, end_timestamp))
-    results = cursor.fetchall()
-
-    conn.close()
-    return results
+def has_fts_index(conn):
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'").fetchone()
+    return row is not None
 
+# Merge overlapping or touching (start, end) intervals. Each interval can carry a priority, the
+# merged interval keeps the best (lowest) one of the intervals that went into it.
+def merge_intervals(intervals):
+    merged = []
+    for start, end, priority in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+            merged[-1][2] = min(merged[-1][2], priority)
+        else:
+            merged.append([start, end, priority])
+    return [tuple(interval) for interval in merged]
@@ -0,0 +1,169 @@
+import argparse
+import json
+import os
+import numpy as np
+from src import embedding_store
+from src.similarity import top_k_indices
+
+INDEX_PATH = 'database/vector_index'
+
+# IVF (inverted file) index: vectors are clustered around k-means centroids and a query only
+# scores the vectors in the few clusters whose centroids are closest to it.
+#
+# On disk the vectors, message ids and cluster assignments are flat append-only files, so
+# adding messages is an append and loading is a memory map rather than a read of every vector.
+class VectorIndex:
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.centroids = np.load(os.path.join(path, 'centroids.npy'))
+        self._map_files()
+
+    @property
+    def count(self):
+        return self.meta['count']
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _map_files(self):
+        count, dimensions = self.meta['count'], self.meta['dimensions']
+        if count == 0:
+            self.vectors = np.empty((0, dimensions), dtype=np.float32)
+            self.ids = np.empty(0, dtype=np.int64)
+            self.lists = np.empty(0, dtype=np.int32)
+            return
+        self.vectors = np.memmap(self._file('vectors.f32'), dtype=np.float32, mode='r', shape=(count, dimensions))
+        self.ids = np.memmap(self._file('ids.i64'), dtype=np.int64, mode='r', shape=(count,))
+        self.lists = np.memmap(self._file('lists.i32'), dtype=np.int32, mode='r', shape=(count,))
+
+    def assign(self, vectors):
+        return np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+    def add(self, ids, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if len(vectors) == 0:
+            return
+        count = self.meta['count']
+        files = [('vectors.f32', vectors, 4 * self.meta['dimensions']),
+                 ('ids.i64', np.asarray(ids, dtype=np.int64), 8),
+                 ('lists.i32', self.assign(vectors), 4)]
+        for name, data, row_size in files:
+            with open(self._file(name), 'ab') as f:
+                # Drop anything past the recorded count, left over from an interrupted add
+                f.truncate(count * row_size)
+                f.write(data.tobytes())
+        self.meta['count'] = count + len(vectors)
+        # meta.json is written last, so the files are only trusted up to a completed add
+        _write_meta(self.path, self.meta)
+        self._map_files()
+
+    def search(self, query_embedding, k, nprobe=None):
+        query = np.asarray(query_embedding, dtype=np.float32)
+        nprobe = nprobe or self.meta['nprobe']
+        probed = top_k_indices(self.centroids @ query, nprobe)
+        rows = np.flatnonzero(np.isin(self.lists, probed))
+        scores = self.vectors[rows] @ query
+        best = top_k_indices(scores, k)
+        return self.ids[rows[best]].tolist(), scores[best].tolist()
+
+def _write_meta(path, meta):
+    tmp_path = os.path.join(path, 'meta.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(path, 'meta.json'))
+
+# Spherical k-means, centroids stay unit length so assignment is a dot product
+def train_centroids(sample, nlist, iterations=10, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        # Reseed empty clusters so every list stays useful
+        empty = np.bincount(assignments, minlength=nlist) == 0
+        sums[empty] = sample[rng.integers(len(sample), size=int(empty.sum()))]
+        centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+    return centroids.astype(np.float32)
+
+def iter_stored_vectors(conn, model, batch_size=10000, exclude_ids=None):
+    cursor = conn.execute('SELECT message_id, vector FROM embeddings WHERE model = ?', (model,))
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        if exclude_ids is not None:
+            rows = [row for row in rows if row[0] not in exclude_ids]
+            if not rows:
+                continue
+        yield [row[0] for row in rows], np.vstack([embedding_store.decode_vector(row[1]) for row in rows])
+
+def build_index(path=INDEX_PATH, embeddings_path=embedding_store.EMBEDDINGS_PATH, model=embedding_store.EMBEDDING_MODEL, nlist=None, sample_size=50000):
+    conn = embedding_store.connect(embeddings_path)
+    total = conn.execute('SELECT COUNT(*) FROM embeddings WHERE model = ?', (model,)).fetchone()[0]
+    if total == 0:
+        conn.close()
+        raise ValueError(f"No stored `{model}` embeddings, run `python -m src.embedding_store --backfill` first")
+
+    nlist = nlist or max(1, min(4096, int(np.sqrt(total))))
+    nlist = min(nlist, total)
+    sample_rows = conn.execute('SELECT vector FROM embeddings WHERE model = ? ORDER BY RANDOM() LIMIT ?', (model, sample_size)).fetchall()
+    sample = np.vstack([embedding_store.decode_vector(row[0]) for row in sample_rows])
+    print(f"Training {nlist} clusters on {len(sample)} of {total} vectors...")
+    centroids = train_centroids(sample, min(nlist, len(sample)))
+
+    os.makedirs(path, exist_ok=True)
+    for name in ('vectors.f32', 'ids.i64', 'lists.i32'):
+        if os.path.exists(os.path.join(path, name)):
+            os.remove(os.path.join(path, name))
+    np.save(os.path.join(path, 'centroids.npy'), centroids)
+    meta = {'model': model, 'dimensions': int(centroids.shape[1]), 'count': 0,
+            'nlist': int(len(centroids)), 'nprobe': min(len(centroids), max(8, len(centroids) // 16))}
+    _write_meta(path, meta)
+
+    index = VectorIndex(path)
+    for ids, vectors in iter_stored_vectors(conn, model):
+        index.add(ids, vectors)
+    conn.close()
+    print(f"Indexed {index.count} vectors into {path}")
+    return index
+
+# Add stored embeddings that aren't in the index yet
+def update_index(path=INDEX_PATH, embeddings_path=embedding_store.EMBEDDINGS_PATH):
+    index = VectorIndex(path)
+    conn = embedding_store.connect(embeddings_path)
+    indexed_ids = set(index.ids.tolist())
+    before = index.count
+    for ids, vectors in iter_stored_vectors(conn, index.meta['model'], exclude_ids=indexed_ids):
+        index.add(ids, vectors)
+    conn.close()
+    print(f"Added {index.count - before} vectors, {index.count} total")
+    return index
+
+def load_index(path=INDEX_PATH):
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        return None
+    return VectorIndex(path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or update the approximate nearest neighbour index over stored message embeddings")
+    parser.add_argument('--build', action='store_true', help='Rebuild the index from every stored embedding')
+    parser.add_argument('--update', action='store_true', help='Add stored embeddings that are not indexed yet')
+    parser.add_argument('--nlist', type=int, default=None, help='Number of clusters, defaults to sqrt(number of vectors)')
+    args = parser.parse_args()
+
+    if args.build:
+        build_index(nlist=args.nlist)
+    elif args.update:
+        update_index()
+    else:
+        index = load_index()
+        if index is None:
+            print(f"No index at {INDEX_PATH}, build one with --build")
+        else:
+            print(f"{index.count} vectors, {index.meta['nlist']} clusters, probing {index.meta['nprobe']} per query")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+import json
+
+import pytest
+
+from src import utils
+
+# The parts of config.json the code under test reads
+CONFIG = {
+    'id_to_name': {'123123123123123123': 'Person1', '321321321321321321': 'Person2'},
+    'allowed_servers': ['111111111111111111'],
+    'allowed_users': ['333333333333333333'],
+    'max_concurrent_jobs': 2,
+    'max_jobs_per_user': 1,
+    'use_summary_cache': False,
+}
+
+
+# get_config reads config.json from the working directory once and caches it, so every test gets
+# its own file and fresh caches instead of whatever the first test happened to load
+@pytest.fixture(autouse=True)
+def config(tmp_path_factory, monkeypatch):
+    path = tmp_path_factory.mktemp('config') / 'config.json'
+    path.write_text(json.dumps(CONFIG))
+    load_config = utils.load_config
+    monkeypatch.setattr(utils, 'load_config', lambda config_path=str(path): load_config(config_path))
+    utils.get_config.cache_clear()
+    utils.configured_mention_rewriter.cache_clear()
+    yield path
+    utils.get_config.cache_clear()
+    utils.configured_mention_rewriter.cache_clear()
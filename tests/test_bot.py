@@ -0,0 +1,85 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from src import bot, progress
+
+
+class FakeMessage:
+    def __init__(self, content):
+        self.content = content
+
+    async def edit(self, content):
+        return FakeMessage(content)
+
+
+class FakeInteraction:
+    def __init__(self):
+        self.original = None
+        self.statuses = []
+
+        async def send(content, wait):
+            return FakeMessage(content)
+        self.followup = SimpleNamespace(send=send)
+
+    async def edit_original_response(self, content):
+        self.original = content
+        self.statuses.append(content)
+
+
+def pipeline(fail=False):
+    yield progress.status("Searching...")
+    yield progress.output("first part, ")
+    if fail:
+        raise RuntimeError("pipeline broke")
+    yield progress.output("second part")
+    yield progress.result("first part, second part")
+
+
+def test_streaming_reply_shows_progress_then_the_answer(monkeypatch):
+    monkeypatch.setattr(bot, 'EDIT_INTERVAL_SECONDS', 0)
+    interaction = FakeInteraction()
+    reply = bot.StreamingReply(interaction, "Answering 'x'")
+    jobs = bot.JobQueue(max_concurrent_jobs=1, max_jobs_per_user=1)
+    asyncio.run(reply.play(jobs.stream(pipeline)))
+    assert "Answering 'x'\nSearching..." in interaction.statuses
+    assert interaction.original == "Answering 'x'"
+    assert [message.content for message in reply.messages] == ["first part, second part"]
+
+
+def test_pipeline_errors_reach_the_command():
+    interaction = FakeInteraction()
+    jobs = bot.JobQueue(max_concurrent_jobs=1, max_jobs_per_user=1)
+    with pytest.raises(RuntimeError, match="pipeline broke"):
+        asyncio.run(bot.StreamingReply(interaction, "Answering 'x'").play(jobs.stream(pipeline, fail=True)))
+
+
+def test_reserve_stops_a_user_at_their_limit():
+    jobs = bot.JobQueue(max_concurrent_jobs=4, max_jobs_per_user=2)
+    assert jobs.reserve('alice') == 0
+    assert jobs.reserve('alice') == 0
+    assert jobs.reserve('alice') is None
+    # A refused job takes no slot, and other users aren't affected
+    assert jobs.active_jobs == 2
+    assert jobs.reserve('bob') == 0
+
+
+def test_jobs_past_the_global_limit_are_queued_in_order():
+    jobs = bot.JobQueue(max_concurrent_jobs=2, max_jobs_per_user=1)
+    assert [jobs.reserve(user) for user in ['a', 'b', 'c', 'd']] == [0, 0, 1, 2]
+    assert jobs.active_jobs == 4
+
+
+def test_release_gives_the_slot_back():
+    jobs = bot.JobQueue(max_concurrent_jobs=1, max_jobs_per_user=1)
+    assert jobs.reserve('alice') == 0
+    assert jobs.reserve('alice') is None
+    assert jobs.reserve('bob') == 1
+    jobs.release('alice')
+    assert jobs.jobs_by_user['alice'] == 0
+    assert jobs.active_jobs == 1
+    # Alice can run again, and queues behind Bob's job, which now has the slot
+    assert jobs.reserve('alice') == 1
+    jobs.release('bob')
+    assert jobs.reserve('carol') == 1
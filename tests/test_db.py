@@ -0,0 +1,81 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+from src import db
+from benchmarks.synthetic import snowflake_for
+from src.ingest_messages import create_database
+
+
+def make_db(db_path, count=10):
+    create_database(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.executemany('INSERT INTO messages (message_id, name, timestamp, contents, attachments, token_count) VALUES (?, ?, ?, ?, ?, ?)',
+                     [(i, 'Person1', f'2020-01-01 00:{i:02d}:00', f'text {i}', '', 5) for i in range(count)])
+    conn.commit()
+    conn.close()
+
+
+def test_messages_in_ranges(tmp_path):
+    db_path = str(tmp_path / 'messages.db')
+    make_db(db_path)
+    minute = db.to_time_ms(datetime(2020, 1, 1)), 60 * 1000
+    ranges = [(minute[0] + 7 * minute[1], minute[0] + 8 * minute[1]), (minute[0] + minute[1], minute[0] + 3 * minute[1])]
+    groups = db.messages_in_ranges(db.read_connection(db_path), ranges, batch_size=1)
+    assert [[row.message_id for row in group] for group in groups] == [[7, 8], [1, 2, 3]]
+    assert groups[0][0].token_count == 5
+    db.close_read_connections()
+
+
+def test_read_connections_are_per_thread_and_survive_a_rebuild(tmp_path):
+    db_path = str(tmp_path / 'messages.db')
+    make_db(db_path)
+    conn = db.read_connection(db_path)
+    assert db.read_connection(db_path) is conn
+    other = []
+    thread = threading.Thread(target=lambda: other.append(db.read_connection(db_path)))
+    thread.start()
+    thread.join()
+    assert other[0] is not conn
+
+    os.remove(db_path)
+    make_db(db_path, count=3)
+    assert db.database_version(db.read_connection(db_path)) == 3
+    db.close_read_connections()
+
+
+def test_readers_are_not_blocked_by_a_writer(tmp_path):
+    db_path = str(tmp_path / 'messages.db')
+    make_db(db_path)
+    writer = db.write_connection(db_path)
+    writer.execute("INSERT INTO messages (message_id, name, timestamp, contents) VALUES (100, 'Person2', '2020-01-02 00:00:00', 'new')")
+    # The write transaction is still open, readers see the last committed state
+    reader = db.read_connection(db_path)
+    assert db.database_version(reader) == 10
+    writer.commit()
+    assert db.database_version(reader) == 11
+    writer.close()
+    db.close_read_connections()
+
+
+def test_messages_in_sessions(tmp_path):
+    db_path = str(tmp_path / 'messages.db')
+    make_db(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.execute('UPDATE messages SET session_id = message_id / 5 + 1')
+    conn.commit()
+    conn.close()
+    reader = db.read_connection(db_path)
+    assert db.session_ids(reader, [7, 2, 99]) == [2, 1, None]
+    groups = db.messages_in_sessions(reader, [2, 1])
+    assert [[row.message_id for row in group] for group in groups] == [[5, 6, 7, 8, 9], [0, 1, 2, 3, 4]]
+    db.close_read_connections()
+
+
+def test_message_time_ms_reads_snowflakes():
+    sent = datetime(2021, 6, 1, 12, 30, 15)
+    assert db.message_time_ms(snowflake_for(db.to_time_ms(sent), 7), 'ignored') == db.to_time_ms(sent)
+    # Too small to be a snowflake, the timestamp is used
+    assert db.message_time_ms(5, '2021-06-01 12:30:15') == db.to_time_ms(sent)
+    assert db.from_time_ms(db.to_time_ms(sent)) == sent
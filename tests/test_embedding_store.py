@@ -0,0 +1,51 @@
+import sqlite3
+from types import SimpleNamespace
+
+from src import embedding_store, openai_async
+from src.ingest_messages import create_database
+
+
+class StubEmbeddings:
+    def __init__(self):
+        self.requests = []
+
+    async def create(self, input, model):
+        self.requests.append(list(input))
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[float(len(text)), 0.5]) for text in input])
+
+
+def test_round_trip(tmp_path):
+    conn = embedding_store.connect(str(tmp_path / 'embeddings.db'))
+    embedding_store.store_embeddings(conn, [(1, [0.25, -1.0]), (2, [3.0, 4.0])])
+    loaded = embedding_store.load_embeddings(conn, [1, 2, 3])
+    assert {message_id: vector.tolist() for message_id, vector in loaded.items()} == {1: [0.25, -1.0], 2: [3.0, 4.0]}
+    assert embedding_store.load_embeddings(conn, [1], model='other-model') == {}
+
+
+def test_backfill_only_embeds_missing(tmp_path, monkeypatch):
+    db_path = str(tmp_path / 'messages.db')
+    embeddings_path = str(tmp_path / 'embeddings.db')
+    create_database(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.executemany('INSERT INTO messages (message_id, contents) VALUES (?, ?)', [(1, 'a'), (2, 'bb'), (3, ''), (4, 'dddd')])
+    conn.commit()
+    conn.close()
+
+    store = embedding_store.connect(embeddings_path)
+    embedding_store.store_embeddings(store, [(1, [9.0, 9.0])])
+    store.close()
+
+    embeddings = StubEmbeddings()
+    client = SimpleNamespace(embeddings=embeddings)
+    # One message per page, so the backfill has to page through the missing ones
+    monkeypatch.setattr(openai_async, 'MAX_CONCURRENT_REQUESTS', 1)
+    openai_async.reset()
+    try:
+        embedding_store.backfill(client, db_path, embeddings_path, batch_size=1)
+    finally:
+        openai_async.reset()
+
+    assert embeddings.requests == [['bb'], ['dddd']]
+    store = embedding_store.connect(embeddings_path)
+    loaded = embedding_store.load_embeddings(store, [1, 2, 3, 4])
+    assert {message_id: vector.tolist() for message_id, vector in loaded.items()} == {1: [9.0, 9.0], 2: [2.0, 0.5], 4: [4.0, 0.5]}
@@ -0,0 +1,130 @@
+import io
+import json
+import sqlite3
+
+import pytest
+
+from src import ingest_messages
+from src.ingest_messages import build_indexes, build_sessions, create_database, insert_data, iter_json_array, migrate_database
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 64, 1 << 16])
+def test_iter_json_array_matches_json_load(chunk_size):
+    data = [
+        {'ID': 1, 'Timestamp': '2020-01-01 00:00:00', 'Contents': 'hi ] there, {friend}', 'Attachments': ''},
+        {'ID': 123456789012345678, 'Timestamp': '2020-01-01 00:00:01', 'Contents': 'é 中 "quoted"', 'Attachments': 'https://cdn/x.png'},
+        1.5e10, True, None, [],
+    ]
+    for text in (json.dumps(data), json.dumps(data, indent=2)):
+        assert list(iter_json_array(io.StringIO(text), chunk_size)) == data
+
+
+@pytest.mark.parametrize('text', ['', '[', '[1, 2', '{}', '[1 2]', '[1,]'])
+def test_iter_json_array_rejects_malformed_input(text):
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.StringIO(text), chunk_size=2))
+
+
+def write_export(path, message_ids):
+    messages = [{'ID': message_id, 'Timestamp': f'2020-01-01 00:00:{i:02d}', 'Contents': f'message number {message_id}', 'Attachments': ''}
+                for i, message_id in enumerate(message_ids)]
+    path.write_text(json.dumps(messages))
+    return str(path)
+
+
+def test_incremental_ingest_only_inserts_new_messages(tmp_path, monkeypatch):
+    db_path = str(tmp_path / 'messages.db')
+    create_database(db_path, defer_indexes=True)
+    assert insert_data(db_path, write_export(tmp_path / 'Person1.json', [30, 20, 10]), bulk_load=True) == 3
+    build_indexes(db_path)
+
+    # A newer data package repeats the old messages, newest first like Discord's exports
+    migrate_database(db_path)
+    counted = []
+    monkeypatch.setattr(ingest_messages, 'count_message_tokens', lambda msg: counted.append(msg[0]) or 1)
+    assert insert_data(db_path, write_export(tmp_path / 'Person1.json', [50, 40, 30, 20, 10])) == 2
+    # Messages below the mark are skipped before they are tokenized
+    assert counted == [50, 40]
+
+    conn = sqlite3.connect(db_path)
+    assert conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0] == 5
+    assert conn.execute("SELECT last_message_id FROM ingest_state WHERE source = 'Person1'").fetchone()[0] == 50
+    # The triggers indexed the new rows for full text search
+    assert conn.execute("SELECT rowid FROM messages_fts WHERE messages_fts MATCH '50'").fetchall() != []
+
+
+def test_migrate_database_dedupes_and_adds_unique_index(tmp_path):
+    db_path = str(tmp_path / 'messages.db')
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, message_id INTEGER, name TEXT, timestamp TEXT, contents TEXT, attachments TEXT, link TEXT)')
+    conn.execute('CREATE INDEX idx_message_id ON messages (message_id)')
+    conn.executemany('INSERT INTO messages (message_id, contents) VALUES (?, ?)', [(1, 'a'), (1, 'a'), (2, 'b')])
+    conn.commit()
+    conn.close()
+
+    migrate_database(db_path)
+
+    conn = sqlite3.connect(db_path)
+    assert conn.execute('SELECT message_id FROM messages ORDER BY id').fetchall() == [(1,), (2,)]
+    # The old rows got their token counts filled in
+    assert conn.execute('SELECT COUNT(*) FROM messages WHERE token_count IS NULL').fetchone()[0] == 0
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute('INSERT INTO messages (message_id) VALUES (2)')
+
+
+def session_rows(db_path):
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute('SELECT message_id, session_id FROM messages ORDER BY time_ms').fetchall()
+    sessions = conn.execute("SELECT datetime(start_ms / 1000, 'unixepoch'), datetime(end_ms / 1000, 'unixepoch'), message_count FROM sessions ORDER BY id").fetchall()
+    conn.close()
+    return rows, sessions
+
+
+def test_build_sessions_splits_on_gaps_and_extends_incrementally(tmp_path):
+    db_path = str(tmp_path / 'messages.db')
+    create_database(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.executemany('INSERT INTO messages (message_id, timestamp, token_count) VALUES (?, ?, 10)',
+                     [(1, '2020-01-01 12:00:00'), (2, '2020-01-01 12:20:00'), (3, '2020-01-01 14:00:00')])
+    assert build_sessions(conn.cursor()) == 2
+    conn.commit()
+    rows, sessions = session_rows(db_path)
+    assert [session_id for _, session_id in rows] == [1, 1, 2]
+    assert sessions == [('2020-01-01 12:00:00', '2020-01-01 12:20:00', 2), ('2020-01-01 14:00:00', '2020-01-01 14:00:00', 1)]
+
+    # A later message continues the last session, the first one is left alone
+    conn.execute("INSERT INTO messages (message_id, timestamp, token_count) VALUES (4, '2020-01-01 14:10:00', 10)")
+    assert build_sessions(conn.cursor()) == 1
+    conn.commit()
+    rows, sessions = session_rows(db_path)
+    assert [session_id for _, session_id in rows] == [1, 1, 2, 2]
+    assert sessions[1] == ('2020-01-01 14:00:00', '2020-01-01 14:10:00', 2)
+
+    # The token cap starts a new session without a gap
+    conn.execute("INSERT INTO messages (message_id, timestamp, token_count) VALUES (5, '2020-01-01 14:11:00', 10)")
+    build_sessions(conn.cursor(), max_tokens=25)
+    conn.commit()
+    rows, _ = session_rows(db_path)
+    assert [session_id for _, session_id in rows] == [1, 1, 2, 2, 3]
+    conn.close()
+
+
+def test_migrate_database_adds_time_keys(tmp_path):
+    db_path = str(tmp_path / 'messages.db')
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, message_id INTEGER, name TEXT, timestamp TEXT, contents TEXT, attachments TEXT, link TEXT)')
+    conn.execute('CREATE INDEX idx_timestamp ON messages (timestamp)')
+    snowflake = (1000 << 22) | 5
+    conn.executemany('INSERT INTO messages (message_id, timestamp, contents) VALUES (?, ?, ?)',
+                     [(snowflake, '2015-01-01 00:00:01', 'a'), (2, '2020-01-01 00:00:00', 'b')])
+    conn.commit()
+    conn.close()
+
+    migrate_database(db_path)
+
+    conn = sqlite3.connect(db_path)
+    assert conn.execute('SELECT time_ms FROM messages ORDER BY id').fetchall() == [(1420070401000,), (1577836800000,)]
+    assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'idx_timestamp'").fetchall() == []
+    # Rows inserted without a time key get one from the trigger
+    conn.execute("INSERT INTO messages (message_id, timestamp) VALUES (3, '2020-01-01 00:00:01')")
+    assert conn.execute('SELECT time_ms FROM messages WHERE message_id = 3').fetchone()[0] == 1577836801000
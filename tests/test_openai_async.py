@@ -0,0 +1,132 @@
+import threading
+
+import openai
+import pytest
+
+from benchmarks.stub_openai import embedding_for, start_in_thread
+from src import openai_async
+
+
+def stub_client(base_url):
+    return openai.AsyncOpenAI(api_key='stub', base_url=base_url, max_retries=0)
+
+
+def test_embedding_batches_respect_limits():
+    assert openai_async.embedding_batches([1, 1, 1, 1, 1], max_inputs=2) == [(0, 2), (2, 4), (4, 5)]
+    assert openai_async.embedding_batches([5, 5, 20, 1], max_tokens=10) == [(0, 2), (2, 3), (3, 4)]
+    assert openai_async.embedding_batches([]) == []
+
+
+def test_embed_runs_batches_in_parallel_and_keeps_order():
+    server, base_url = start_in_thread(dimensions=8, embedding_latency=0.1)
+    try:
+        texts = [f'message {i}' for i in range(7)]
+        vectors = openai_async.embed(texts, 'text-embedding-3-large', stub_client(base_url), max_inputs=2)
+        assert [list(vector) for vector in vectors] == [pytest.approx(embedding_for(text, 8).tolist()) for text in texts]
+        assert server.requests == 4
+        assert server.max_in_flight > 1
+    finally:
+        server.shutdown()
+
+
+def test_embedding_tokens_are_counted_off_the_loop(monkeypatch):
+    threads = []
+    count_tokens = openai_async.count_tokens
+    monkeypatch.setattr(openai_async, 'count_tokens', lambda text: threads.append(threading.current_thread().name) or count_tokens(text))
+    server, base_url = start_in_thread(dimensions=8)
+    try:
+        vectors = openai_async.embed(['a', 'b', 'c'], 'text-embedding-3-large', stub_client(base_url), max_inputs=2)
+        assert len(vectors) == 3
+        # The shared loop only awaits the requests, so other requests and streams aren't held up
+        assert threads == [threading.current_thread().name] * 3
+    finally:
+        server.shutdown()
+
+
+def test_requests_reuse_one_connection():
+    server, base_url = start_in_thread()
+    try:
+        client = stub_client(base_url)
+        for _ in range(3):
+            openai_async.chat('gpt-4o', [{'role': 'user', 'content': 'hello'}], client)
+        assert server.requests == 3
+        assert server.connections == 1
+    finally:
+        server.shutdown()
+
+
+def test_rate_limits_and_server_errors_are_retried():
+    server, base_url = start_in_thread()
+    try:
+        client = stub_client(base_url)
+        server.fail_statuses = [429, 500]
+        response = openai_async.chat('gpt-4o', [{'role': 'user', 'content': 'hello'}], client)
+        assert response.choices[0].message.content.startswith('# Summary')
+        assert server.requests == 3
+
+        # Other errors aren't worth retrying
+        server.fail_statuses = [400]
+        with pytest.raises(openai.BadRequestError):
+            openai_async.chat('gpt-4o', [{'role': 'user', 'content': 'hello'}], client)
+        assert server.requests == 4
+    finally:
+        server.shutdown()
+
+
+def test_requests_in_flight_are_bounded(monkeypatch):
+    monkeypatch.setattr(openai_async, 'MAX_CONCURRENT_REQUESTS', 2)
+    openai_async.reset()
+    server, base_url = start_in_thread(dimensions=8, embedding_latency=0.05)
+    try:
+        vectors = openai_async.embed([f'message {i}' for i in range(10)], 'text-embedding-3-large', stub_client(base_url), max_inputs=1)
+        assert len(vectors) == 10
+        assert server.max_in_flight == 2
+    finally:
+        server.shutdown()
+        openai_async.reset()
+
+
+def test_stream_chat_yields_the_whole_reply():
+    server, base_url = start_in_thread()
+    try:
+        chunks = openai_async.stream_chat('gpt-4o', [{'role': 'user', 'content': 'hello'}], stub_client(base_url),
+                                          stream_options={'include_usage': True})
+        text = "".join(chunk.choices[0].delta.content or '' for chunk in chunks if chunk.choices)
+        assert text.startswith('# Summary') and len(text.split()) == 202
+    finally:
+        server.shutdown()
+
+
+def test_first_calls_from_many_threads_share_one_loop(monkeypatch):
+    server, base_url = start_in_thread(chat_latency=0.05)
+    monkeypatch.setenv('OPENAI_KEY', 'stub')
+    monkeypatch.setenv('OPENAI_BASE_URL', base_url)
+    monkeypatch.setattr(openai_async, 'MAX_CONCURRENT_REQUESTS', 2)
+    openai_async.reset()
+    start = threading.Barrier(8)
+    loops = []
+    errors = []
+
+    def first_call():
+        start.wait()
+        try:
+            loops.append(openai_async.get_loop())
+            openai_async.chat('gpt-4o', [{'role': 'user', 'content': 'hello'}], max_tokens=10)
+        except Exception as e:
+            errors.append(e)
+
+    try:
+        threads = [threading.Thread(target=first_call) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+        assert not any(thread.is_alive() for thread in threads)
+        assert errors == []
+        assert len(set(loops)) == 1
+        # Nothing failed and had to be retried
+        assert server.requests == 8
+        assert server.max_in_flight <= 2
+    finally:
+        server.shutdown()
+        openai_async.reset()
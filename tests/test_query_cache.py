@@ -0,0 +1,49 @@
+from src import query_cache
+from src.query_cache import MISSING, TTLCache
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl_seconds=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is MISSING
+    assert cache.get('a') == 1 and cache.get('c') == 3
+
+
+def test_ttl_cache_expires_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(query_cache.time, 'monotonic', lambda: now[0])
+    cache = TTLCache(maxsize=10, ttl_seconds=5)
+    cache.set('a', [])
+    assert cache.get('a') == []
+    now[0] += 6
+    assert cache.get('a') is MISSING
+
+
+def test_normalize_search_term():
+    assert query_cache.normalize_search_term('  What did we   say about Pizza? ') == query_cache.normalize_search_term('what did we say about pizza')
+
+
+def test_answers_from_an_empty_selection_are_not_cached(tmp_path, monkeypatch):
+    from src import search_messages
+    from src.ingest_messages import create_database
+    db_path = str(tmp_path / 'messages.db')
+    create_database(db_path)
+    monkeypatch.setattr(search_messages, 'DATABASE_PATH', db_path)
+    query_cache.answers.clear()
+    runs = []
+
+    def run_query(search_term, *args):
+        runs.append(search_term)
+        return f"answer {len(runs)}", len(runs) > 1
+        yield
+
+    monkeypatch.setattr(search_messages, 'run_query', run_query)
+    # The first answer had nothing selected, so it's asked again and the second one is kept
+    assert search_messages.process_query('pizza') == 'answer 1'
+    assert search_messages.process_query('pizza') == 'answer 2'
+    assert search_messages.process_query('pizza') == 'answer 2'
+    assert len(runs) == 2
+    query_cache.answers.clear()
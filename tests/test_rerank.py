@@ -0,0 +1,48 @@
+from src.rerank import bm25_scores, format_shortlist, ranking, reciprocal_rank_fusion, shortlist
+
+
+def message(message_id, text, timestamp='2020-01-01 12:00:00'):
+    return (message_id, 'Person1', timestamp, text, '', '')
+
+
+def test_bm25_prefers_more_matching_terms():
+    scores = bm25_scores(['beach trip'], ['the beach trip was fun', 'went to the beach', 'nothing here'])
+    assert scores[0] > scores[1] > scores[2] == 0
+
+
+def test_ranking_keeps_the_top_with_ties_in_order():
+    assert ranking([0.1, 0.5, 0.2, 0.5, 0.0], depth=3) == [1, 3, 2]
+    assert ranking([0.0] * 5, depth=10) == [0, 1, 2, 3, 4]
+
+
+def test_reciprocal_rank_fusion_rewards_agreement():
+    # 1 tops two of the three rankings
+    assert reciprocal_rank_fusion([[0, 1, 2], [1, 0, 2], [1, 2, 0]]) == [1, 0, 2]
+
+
+def test_shortlist_drops_near_duplicates():
+    messages = [message(1, 'see you at the beach'), message(2, 'See you at the beach!'), message(3, 'beach tomorrow?')]
+    assert sorted(msg[0] for msg in shortlist(messages, ['beach'])) == [1, 3]
+
+
+def test_shortlist_spreads_across_conversations():
+    same_conversation = [message(i, f'beach plan number {i}', f'2020-01-01 12:0{i}:00') for i in range(5)]
+    elsewhere = [message(9, 'beach', '2020-06-01 12:00:00')]
+    picked = shortlist(same_conversation + elsewhere, ['beach'], size=4, max_per_conversation=3)
+    # The other conversation gets a slot ahead of the fourth hit from the first one
+    assert len(picked) == 4
+    assert 9 in [msg[0] for msg in picked]
+
+
+def test_shortlist_fits_token_budget():
+    messages = [message(i, f'beach {i} ' + 'word ' * 40) for i in range(20)]
+    picked = shortlist(messages, ['beach'], token_budget=200, max_per_conversation=20)
+    assert 0 < len(picked) < 20
+    assert len(format_shortlist(picked)) / 4 <= 200
+
+
+def test_shortlist_uses_sessions_for_conversations():
+    # All sent at the same time, but ingest put them in two sessions
+    messages = [message(i, f'beach plan number {i}') for i in range(4)]
+    picked = shortlist(messages, ['beach'], sessions=[1, 1, 2, 2], size=2, max_per_conversation=1)
+    assert {msg[0] // 2 for msg in picked} == {0, 1}
@@ -0,0 +1,38 @@
+import sqlite3
+
+from src.ingest_messages import create_database
+from src import search_messages
+from src.search_messages import build_fts_query, search_fts, search_like
+
+
+def make_db(tmp_path, contents):
+    db_path = str(tmp_path / 'messages.db')
+    create_database(db_path)
+    conn = sqlite3.connect(db_path)
+    for i, text in enumerate(contents):
+        conn.execute('INSERT INTO messages (message_id, name, timestamp, contents, attachments, link) VALUES (?, ?, ?, ?, ?, ?)',
+                     (i, 'Person1', f'2020-01-01 00:00:{i:02d}', text, '', ''))
+    conn.commit()
+    return conn
+
+
+def test_build_fts_query():
+    assert build_fts_query(['pizza', "don't stop", '!!!']) == '"pizza" * OR "don t stop" *'
+    assert build_fts_query(['???']) == ''
+
+
+def test_fts_matches_like(tmp_path):
+    conn = make_db(tmp_path, ['we got Pizza last night', 'pizzas are great', 'nothing here', 'PIZZA PIZZA pizza'])
+    cursor = conn.cursor()
+    like_ids = sorted(row[0] for row in search_like(cursor, ['pizza']))
+    fts_rows = search_fts(cursor, ['pizza'])
+    assert sorted(row[0] for row in fts_rows) == like_ids == [0, 1, 3]
+    # bm25 ranks the message that says it three times first
+    assert fts_rows[0][0] == 3
+
+
+def test_search_index_batches_yield_each_match_once(tmp_path, monkeypatch):
+    make_db(tmp_path, ['pizza and pasta', 'pasta only', 'pizza only', 'nothing here'])
+    monkeypatch.setattr(search_messages, 'DATABASE_PATH', str(tmp_path / 'messages.db'))
+    batches = list(search_messages.search_index_batches(['pizza', 'pasta'], group_size=1))
+    assert [sorted(msg.message_id for msg in batch) for batch in batches] == [[0, 2], [1]]
@@ -0,0 +1,17 @@
+import numpy as np
+
+from src.similarity import calculate_similarity, embedding_matrix, top_k_indices
+
+
+def test_calculate_similarity_matches_dot_product():
+    embeddings = [[1.0, 0.0], np.array([0.6, 0.8], dtype=np.float32), [0.0, -1.0]]
+    similarities = calculate_similarity(embeddings, [0.6, 0.8])
+    assert np.allclose(similarities, [0.6, 1.0, -0.8])
+    assert embedding_matrix(embeddings).flags['C_CONTIGUOUS']
+
+
+def test_top_k_indices_best_first():
+    similarities = np.array([0.1, 0.9, 0.5, 0.7, 0.3])
+    assert top_k_indices(similarities, 3).tolist() == [1, 3, 2]
+    assert top_k_indices(similarities, 10).tolist() == [1, 3, 2, 4, 0]
+    assert top_k_indices(np.array([]), 3).tolist() == []
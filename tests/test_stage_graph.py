@@ -0,0 +1,65 @@
+import threading
+import time
+
+import pytest
+
+from src import metrics, stage_graph
+
+
+def sleeper(seconds, value):
+    def func(stage, *inputs):
+        time.sleep(seconds)
+        stage.rows_out = len(inputs)
+        return value + sum(inputs)
+    return func
+
+
+def test_independent_stages_overlap():
+    nodes = [
+        stage_graph.node('slow', sleeper(0.2, 1)),
+        stage_graph.node('fast', sleeper(0.05, 10)),
+        stage_graph.node('both', sleeper(0, 100), ['slow', 'fast']),
+    ]
+    with metrics.run('graph') as profile:
+        graph = stage_graph.run(nodes)
+        finished = []
+        try:
+            while True:
+                finished.append(next(graph)[0])
+        except StopIteration as stop:
+            results = stop.value
+    assert finished == ['fast', 'slow', 'both']
+    assert results == {'slow': 1, 'fast': 10, 'both': 111}
+    # Both start at once, so the graph takes as long as its slowest chain
+    assert profile.seconds < 0.35
+    records = {record['stage']: record for record in profile.records()}
+    assert records['both']['started'] >= records['slow']['started'] + records['slow']['seconds']
+    assert records['both']['rows_out'] == 2
+
+
+def test_missing_and_circular_dependencies_are_errors():
+    with pytest.raises(ValueError):
+        list(stage_graph.run([stage_graph.node('a', sleeper(0, 1), ['nowhere'])]))
+    with pytest.raises(ValueError):
+        list(stage_graph.run([stage_graph.node('a', sleeper(0, 1), ['b']), stage_graph.node('b', sleeper(0, 1), ['a'])]))
+
+
+def test_failures_stop_the_graph():
+    def fail(stage):
+        raise RuntimeError('boom')
+    nodes = [stage_graph.node('fail', fail), stage_graph.node('after', sleeper(0, 1), ['fail'])]
+    with pytest.raises(RuntimeError):
+        list(stage_graph.run(nodes))
+
+
+def test_inline_stages_run_on_the_calling_thread_and_workers_are_shared():
+    def thread_name(stage, *inputs):
+        return threading.current_thread().name
+
+    nodes = [stage_graph.node('worker', thread_name), stage_graph.node('inline', thread_name, ['worker'], inline=True)]
+    first = dict(stage_graph.run(nodes))
+    second = dict(stage_graph.run(nodes))
+    assert first['inline'] == second['inline'] == threading.current_thread().name
+    assert first['worker'].startswith('stage')
+    # Worker threads outlive a run, so their connections are kept
+    assert stage_graph.get_executor() is stage_graph.get_executor()
@@ -0,0 +1,25 @@
+import json
+
+import openai
+
+from benchmarks.stub_openai import start_in_thread
+
+
+def test_openai_client_talks_to_stub():
+    server, base_url = start_in_thread(dimensions=8)
+    try:
+        client = openai.OpenAI(api_key='stub', base_url=base_url)
+        response = client.embeddings.create(input=['hello', 'world', 'hello'], model='text-embedding-3-large')
+        vectors = [item.embedding for item in response.data]
+        assert [len(vector) for vector in vectors] == [8, 8, 8]
+        # Same text, same vector
+        assert vectors[0] == vectors[2] != vectors[1]
+
+        response = client.chat.completions.create(
+            model='gpt-4o',
+            messages=[{'role': 'user', 'content': 'return ONLY A JSON blob of keywords'}],
+        )
+        assert len(json.loads(response.choices[0].message.content)['keywords']) == 50
+        assert response.usage.prompt_tokens > 0
+    finally:
+        server.shutdown()
@@ -0,0 +1,187 @@
+import asyncio
+import json
+import random
+import sqlite3
+from datetime import datetime
+from types import SimpleNamespace
+
+import httpx
+import openai
+
+from src import db, metrics, summarize_discord
+from src.ingest_messages import create_database
+
+
+# Stands in for the async client.chat.completions, echoing which chunk each prompt came from
+class StubChatCompletions:
+    def __init__(self, rate_limited_calls=0):
+        self.rate_limited_calls = rate_limited_calls
+        self.calls = 0
+
+    async def create(self, model, messages, max_tokens):
+        self.calls += 1
+        if self.rate_limited_calls > 0:
+            self.rate_limited_calls -= 1
+            response = httpx.Response(429, headers={'retry-after': '0'}, request=httpx.Request('POST', 'http://stub/v1/chat/completions'))
+            raise openai.RateLimitError('rate limited', response=response, body=None)
+        # Finish out of order so only the executor keeps the output chronological
+        await asyncio.sleep(random.uniform(0, 0.05))
+        prompt = messages[-1]['content']
+        if 'Summaries follow' in prompt:
+            return completion(f"digest of {prompt.count('Part ')} parts")
+        first_day = prompt.split('Date: ')[1][:10]
+        return completion(f"summary from {first_day}")
+
+
+def completion(text):
+    usage = SimpleNamespace(prompt_tokens=1000, completion_tokens=100)
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))], usage=usage)
+
+
+def make_db(tmp_path, monkeypatch):
+    db_path = str(tmp_path / 'messages.db')
+    create_database(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.executemany('INSERT INTO messages (message_id, name, timestamp, contents) VALUES (?, ?, ?, ?)',
+                     [(day, 'Person1', f'2020-01-{day:02d} 12:00:00', 'x' * 50) for day in range(1, 9)])
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(summarize_discord, 'DATABASE_PATH', db_path)
+    monkeypatch.chdir(tmp_path)
+
+
+def test_parallel_summaries_stay_chronological(tmp_path, monkeypatch):
+    make_db(tmp_path, monkeypatch)
+    completions = StubChatCompletions(rate_limited_calls=2)
+    client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+    # Each message is about 25 tokens formatted, so every chunk holds one day
+    summary = summarize_discord.main('2020-01-01', 10, max_chunks=10, window=30, workers=4, client=client)
+
+    assert summary.split('\n\n') == [f'summary from 2020-01-{day:02d}' for day in range(1, 9)]
+    assert completions.calls == 8 + 2
+
+
+def test_reduce_merges_chunk_summaries(tmp_path, monkeypatch):
+    make_db(tmp_path, monkeypatch)
+    client = SimpleNamespace(chat=SimpleNamespace(completions=StubChatCompletions()))
+
+    summary = summarize_discord.main('2020-01-01', 10, max_chunks=10, window=30, workers=3, reduce=True, client=client)
+
+    assert summary == 'digest of 8 parts'
+
+
+def test_too_many_chunks_stops_before_calling_openai(tmp_path, monkeypatch):
+    make_db(tmp_path, monkeypatch)
+    completions = StubChatCompletions()
+    client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+    summary = summarize_discord.main('2020-01-01', 10, max_chunks=3, window=30, client=client)
+
+    assert 'she\'ll blow' in summary
+    assert completions.calls == 0
+
+
+def test_cached_summaries_only_recompute_changed_periods(tmp_path, monkeypatch):
+    make_db(tmp_path, monkeypatch)
+    (tmp_path / 'database').mkdir()
+    completions = StubChatCompletions()
+    client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+    # January 1st to 8th: 8 days, rolled up into the first week, then with day 8's week into the month
+    summary = summarize_discord.main('2020-01-01', 31, max_chunks=10, window=30, client=client, use_cache=True)
+    assert summary == 'digest of 2 parts'
+    assert completions.calls == 8 + 1 + 1
+
+    summarize_discord.main('2020-01-01', 31, max_chunks=10, window=30, client=client, use_cache=True)
+    assert completions.calls == 10
+
+    # A newly ingested message only invalidates its day, week and month
+    conn = sqlite3.connect(summarize_discord.DATABASE_PATH)
+    conn.execute("INSERT INTO messages (message_id, name, timestamp, contents) VALUES (100, 'Person2', '2020-01-03 13:00:00', 'new')")
+    conn.commit()
+    conn.close()
+    summarize_discord.main('2020-01-01', 31, max_chunks=10, window=1000, client=client, use_cache=True)
+    assert completions.calls == 13
+
+    # A range that isn't a whole month is answered from the cached week and days
+    summary = summarize_discord.main('2020-01-01', 9, max_chunks=10, window=30, client=client, use_cache=True)
+    assert summary == 'digest of 7 parts\n\nsummary from 2020-01-08'
+    assert completions.calls == 13
+
+
+def test_cached_summaries_stop_before_too_many_stale_periods(tmp_path, monkeypatch):
+    make_db(tmp_path, monkeypatch)
+    (tmp_path / 'database').mkdir()
+    completions = StubChatCompletions()
+    client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+    # A cold January is 8 days, 2 weeks and the month
+    monkeypatch.setattr(summarize_discord, 'MAX_STALE_PERIODS', 10)
+    summary = summarize_discord.main('2020-01-01', 31, max_chunks=10, window=30, client=client, use_cache=True)
+    assert summary == summarize_discord.TOO_MANY_CHUNKS
+    assert completions.calls == 0
+
+    monkeypatch.setattr(summarize_discord, 'MAX_STALE_PERIODS', 11)
+    assert summarize_discord.main('2020-01-01', 31, max_chunks=10, window=30, client=client, use_cache=True) == 'digest of 2 parts'
+
+
+def test_profile_records_stages_and_worker_usage(tmp_path, monkeypatch):
+    make_db(tmp_path, monkeypatch)
+    client = SimpleNamespace(chat=SimpleNamespace(completions=StubChatCompletions()))
+
+    output = tmp_path / 'profile.jsonl'
+    with metrics.run('summarize', str(output)):
+        summarize_discord.main('2020-01-01', 10, max_chunks=10, window=30, workers=4, reduce=True, client=client)
+
+    records = {record['stage']: record for record in map(json.loads, output.read_text().splitlines())}
+    assert records['chunk']['rows_in'] == 8
+    assert records['chunk']['rows_out'] == 8
+    # Usage from the executor threads lands on the stage that started them
+    assert records['summarize']['openai_calls'] == 8
+    assert records['reduce']['openai_calls'] == 1
+    assert records['total']['prompt_tokens'] == 9 * 1000
+    assert records['total']['cost_usd'] > 0
+
+
+def test_events_stream_chunk_summaries_in_order(tmp_path, monkeypatch):
+    make_db(tmp_path, monkeypatch)
+    client = SimpleNamespace(chat=SimpleNamespace(completions=StubChatCompletions()))
+
+    events = list(summarize_discord.summarize_events('2020-01-01', 10, max_chunks=10, window=30, workers=4, client=client))
+    outputs = [event.text for event in events if event.kind == 'output']
+    assert [text.strip() for text in outputs] == [f"summary from 2020-01-{day:02d}" for day in range(1, 9)]
+    assert events[-1].kind == 'result'
+    assert events[-1].text == "".join(outputs)
+
+
+def test_chunks_keep_sessions_whole():
+    def msg(message_id, session_id, token_count=10):
+        return db.ContextMessage(message_id, 'Person1', '2020-01-01 12:00:00', 'text', '', token_count, session_id, message_id)
+
+    messages = [msg(1, 1), msg(2, 1), msg(3, 2), msg(4, 2), msg(5, 2), msg(6, 3, 50)]
+    chunks = summarize_discord.chunk_messages(messages, 35)
+    # Session 2 would fit after session 1 only by splitting it, so it starts the next chunk.
+    # Session 3 is bigger than a chunk on its own and gets one to itself.
+    assert [[m.message_id for m in chunk] for chunk in chunks] == [[1, 2], [3, 4, 5], [6]]
+
+
+def test_chunks_are_yielded_as_messages_stream_in(tmp_path, monkeypatch):
+    pulled = []
+
+    def messages():
+        for i in range(100):
+            pulled.append(i)
+            yield db.ContextMessage(i, 'Person1', '2020-01-01 12:00:00', 'text', '', 10, i, i)
+
+    chunks = summarize_discord.chunk_messages(messages(), 35)
+    assert [m.message_id for m in next(chunks)] == [0, 1, 2]
+    # Past the first chunk, only the session that didn't fit and one message to see where it ends have been read
+    assert len(pulled) == 5
+
+    # The up front count agrees with what streaming the range gives
+    make_db(tmp_path, monkeypatch)
+    conn = db.read_connection(summarize_discord.DATABASE_PATH)
+    start, end = datetime(2020, 1, 1), datetime(2020, 1, 11)
+    streamed = list(summarize_discord.chunk_messages(summarize_discord.fetch_messages(conn, start, end), 30))
+    assert summarize_discord.count_chunks(conn, start, end, 30) == (sum(len(chunk) for chunk in streamed), len(streamed)) == (8, 8)
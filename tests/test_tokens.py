@@ -0,0 +1,29 @@
+from src import db
+from src.tokens import fit_to_budget, message_tokens
+
+
+def group(message_id, *token_counts):
+    return [db.ContextMessage(message_id + i, 'Person1', '2020-01-01 00:00:00', 'text', '', count, None, 0)
+            for i, count in enumerate(token_counts)]
+
+
+def test_message_tokens_uses_stored_count():
+    assert message_tokens(db.ContextMessage(1, 'Person1', '2020-01-01 00:00:00', 'text', '', 42, None, 0)) == 42
+    # Rows without one are counted on the spot, and a search result's link is never taken for a count
+    assert message_tokens((1, 'Person1', '2020-01-01 00:00:00', 'text')) > 0
+    link = 'https://discord.com/channels/@me/1/1'
+    assert message_tokens(db.Message(1, 'Person1', '2020-01-01 00:00:00', 'text', '', link, 0)) == message_tokens((1, 'Person1', '2020-01-01 00:00:00', 'text'))
+
+
+def test_fit_to_budget_skips_groups_that_dont_fit():
+    first, too_big, small = group(0, 10, 10), group(10, 50), group(20, 5)
+    kept, used = fit_to_budget([first, too_big, small], 40)
+    # The big group is dropped but the smaller, less relevant one still fits after it
+    assert kept == [first, small]
+    assert used == 10 + 10 + 1 + 5 + 1
+
+
+def test_fit_to_budget_cuts_an_oversized_top_group():
+    kept, used = fit_to_budget([group(0, 10, 10, 10, 10), group(10, 1)], 25)
+    assert [[msg[0] for msg in g] for g in kept] == [[0, 1]]
+    assert used == 21
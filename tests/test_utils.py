@@ -0,0 +1,16 @@
+from src.utils import make_mention_rewriter, merge_intervals
+
+
+def test_mention_rewriter_handles_every_mention_form():
+    rewrite = make_mention_rewriter({111: 'Alice', 222: 'Bob'}, {333: 'mods'}, {444: 'general'})
+    assert rewrite('<@111> and <@!222> in <#444>, ping <@&333>') == '@Alice and @Bob in #general, ping @mods'
+    # Unknown IDs and text that only looks like a mention are left alone
+    assert rewrite('<@999> <@abc> <:emoji:111> a < b') == '<@999> <@abc> <:emoji:111> a < b'
+    assert rewrite('<@111><@111>') == '@Alice@Alice'
+
+
+def test_merge_intervals_keeps_best_priority():
+    intervals = [('10:00', '11:00', 2), ('10:30', '11:30', 0), ('11:30', '12:00', 5), ('13:00', '14:00', 1)]
+    assert merge_intervals(intervals) == [('10:00', '12:00', 0), ('13:00', '14:00', 1)]
+    assert merge_intervals([]) == []
+
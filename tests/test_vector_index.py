@@ -0,0 +1,34 @@
+import numpy as np
+
+from src import embedding_store, vector_index
+
+
+def random_unit_vectors(rng, count, dimensions):
+    vectors = rng.standard_normal((count, dimensions)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_build_search_and_incremental_add(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = random_unit_vectors(rng, 2000, 32)
+    embeddings_path = str(tmp_path / 'embeddings.db')
+    index_path = str(tmp_path / 'index')
+
+    conn = embedding_store.connect(embeddings_path)
+    embedding_store.store_embeddings(conn, [(i, vector) for i, vector in enumerate(vectors[:1500])])
+    index = vector_index.build_index(index_path, embeddings_path, nlist=16)
+    assert index.count == 1500
+
+    embedding_store.store_embeddings(conn, [(i, vector) for i, vector in enumerate(vectors[1500:], start=1500)])
+    conn.close()
+    vector_index.update_index(index_path, embeddings_path)
+
+    # Reloading maps the appended files from disk
+    index = vector_index.load_index(index_path)
+    assert index.count == 2000
+    hits = 0
+    for message_id in range(0, 2000, 50):
+        ids, scores = index.search(vectors[message_id], 5, nprobe=8)
+        assert scores == sorted(scores, reverse=True)
+        hits += ids[0] == message_id
+    assert hits >= 36